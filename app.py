@@ -2,6 +2,7 @@
 # ruff: noqa
 
 # Standard Library Imports
+import base64
 import calendar
 import csv
 import json
@@ -19,6 +20,7 @@ import urllib
 import uuid
 import xml.etree.ElementTree as ET
 import zipfile
+import zlib
 from collections import Counter, defaultdict
 from datetime import datetime, timedelta
 from email.mime.text import MIMEText
@@ -42,6 +44,7 @@ from flag import flag
 from flask import (
     Flask,
     Markup,
+    Response,
     abort,
     flash,
     jsonify,
@@ -53,9 +56,9 @@ from flask import (
     send_file,
     send_from_directory,
     session,
+    stream_with_context,
     url_for,
 )
-from flask_caching import Cache
 from flask_compress import Compress
 from flask_sqlalchemy import SQLAlchemy
 from flaskext.autoversion import Autoversion
@@ -65,7 +68,6 @@ from requests.adapters import HTTPAdapter, Retry
 from scgraph.geographs.marnet import marnet_geograph
 from sqlalchemy import and_, case, func, or_
 from sqlalchemy_utils import database_exists
-from timezonefinder import TimezoneFinder
 from werkzeug.exceptions import HTTPException
 from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.utils import secure_filename
@@ -81,10 +83,15 @@ logger = logging.getLogger(__name__)
 
 
 # Local Application/Library Specific Imports
-from py import geopip_country
-from py.currency import get_available_currencies, get_exchange_rate
+from py import region_index
+from py.currency import (
+    get_available_currencies,
+    get_exchange_rate,
+    get_exchange_rates,
+)
 from py.db_init import init_data, init_main
 from py.finances import get_finances
+from py.geo_kernels import path_length, to_coords
 from py.g_search import get_vessel_picture
 from py.image_generator import generate_image
 from py.sql import (
@@ -99,44 +106,33 @@ from py.sql import (
     getCurrentTrip,
     getDuplicate,
     getDynamicUserTrips,
+    getDynamicUserTripsPage,
     getLeaderboardCountries,
     getManualStationsQuery,
     getNumberStations,
     getOperators,
     getTags,
-    getTicket,
     getTickets,
+    getTicketsById,
     getTrainStations,
     getTrip,
-    getTripsCountry,
     getUniqueUserTrips,
     getUserLines,
+    getUserLinesLod,
     getUserTrips,
     initPath,
+    initPathLods,
+    initPathMeta,
     leaderboardStats,
-    newStatsOperatorKm,
-    newStatsOperatorTrips,
     publicStats,
     saveQuery,
-    statsCountries,
-    statsMaterialKm,
-    statsMaterialTrips,
-    statsRoutesKm,
-    statsRoutesTrips,
-    statsStationsKm,
-    statsStationsTrips,
-    statsYearKm,
-    statsYearTrips,
+    statsRows,
     typeAvailable,
     updatePath,
     updateTripQuery,
     upsertPercent,
 )
-from py.stats import (
-    getStatsCountries,
-    getStatsGeneral,
-    getStatsYears,
-)
+from py.stats import getStats
 from py.motis import (
     convert_motis_to_trip,
     call_motis_api,
@@ -161,10 +157,8 @@ from py.utils import (
     getIpDetails,
     getRequestData,
     hex_to_rgb,
-    interpolate_great_circle,
     interpolate_points_if_gaps,
     load_config,
-    remove_diacritics,
     rgb_to_hex,
     stringSimmilarity,
     unicodedata,
@@ -173,12 +167,13 @@ from py.utils import (
 from src.api.admin import admin_blueprint
 from src.api.feature_requests import feature_requests_blueprint
 from src.consts import DbNames, TripTypes
-from src.pg import setup_db
+from src.pg import remove_pg_session, setup_db
 from src.suspicious_activity import (
     check_denied_login,
     log_denied_login,
     log_suspicious_activity,
 )
+from src.timezones import timezone_at, to_local
 from src.utils import (
     getNameFromPath,
     processDates,
@@ -191,6 +186,7 @@ from src.utils import (
     owner_required,
     pathConn,
     readLang,
+    release_request_connections,
     sendOwnerEmail,
     sendEmail,    
     getLocalDatetime
@@ -206,7 +202,45 @@ from src.trips import (
     attach_ticket_to_trips,
     delete_ticket_from_db
 )
-from src.paths import Path
+from src.path_codec import decode_path, encode_path, is_encoded, path_to_list
+from src.paths import LOD_TOLERANCES, Path, delete_path_meta, migrate_paths
+from src.regions import delete_user_regions, sync_user_regions, traveled_polygons
+from src.trip_counts import (
+    delete_user_trip_counts,
+    get_trip_count,
+    save_trip_count,
+)
+from src.trip_revisions import (
+    delete_user_revisions,
+    get_changes,
+    get_user_revision,
+)
+from src.trip_search import (
+    delete_user_trip_search,
+    index_user_trips,
+    search_pattern,
+    update_airliner_search,
+    update_tag_search,
+    update_trip_search,
+    uses_index,
+)
+from src.tile_cache import get_tile
+from src.trip_tiles import MAX_ZOOM, delete_user_trip_tiles, get_trip_tile
+from src.stats_snapshots import (
+    FUTURE_YEAR,
+    delete_user_stats,
+    get_stats_snapshot,
+    invalidate_type_stats,
+    localize_stats,
+    save_stats_snapshot,
+)
+from src.squares import (
+    air_percentage,
+    delete_user_squares,
+    land_percentage,
+    squares_geojson,
+    user_squares,
+)
 
 app = Flask(__name__)
 Compress(app)
@@ -217,10 +251,6 @@ app.url_map.strict_slashes = False
 app.register_blueprint(admin_blueprint, url_prefix="/admin")
 app.register_blueprint(feature_requests_blueprint)
 
-app.config["CACHE_TYPE"] = "SimpleCache"
-app.config["CACHE_DEFAULT_TIMEOUT"] = 864000
-cache = Cache(app)
-
 matomo_config = load_config().get("matomo")
 
 if matomo_config:
@@ -534,51 +564,50 @@ def fetch_and_filter_flights(flight_filter_key, flight_filter_value, target_date
     flights = response.json().get("data", [])
     filtered = []
 
+    icaos = {
+        icao
+        for f in flights
+        for icao in (f.get("orig_icao"), f.get("dest_icao"))
+        if icao
+    }
     with managed_cursor(mainConn) as cursor:
-        for f in flights:
-            orig_icao = f.get("orig_icao")
-            dest_icao = f.get("dest_icao")
-            takeoff_str = f.get("datetime_takeoff")
-            landing_str = f.get("datetime_landed")
+        airports = {
+            row["ident"]: (row["latitude"], row["longitude"])
+            for row in cursor.execute(
+                f"""
+                SELECT ident, latitude, longitude FROM airports
+                WHERE ident IN ({", ".join(("?",) * len(icaos))})
+                """,
+                tuple(icaos),
+            ).fetchall()
+        }
 
-            if orig_icao and takeoff_str:
-                cursor.execute(
-                    "SELECT latitude, longitude FROM airports WHERE ident = :icao",
-                    {"icao": orig_icao},
-                )
-                orig_coords = cursor.fetchone()
-                if orig_coords:
-                    try:
-                        utc_takeoff = datetime.fromisoformat(
-                            takeoff_str.replace("Z", "+00:00")
+    for f in flights:
+        orig_icao = f.get("orig_icao")
+        dest_icao = f.get("dest_icao")
+        takeoff_str = f.get("datetime_takeoff")
+        landing_str = f.get("datetime_landed")
+
+        if orig_icao in airports and takeoff_str:
+            try:
+                utc_takeoff = datetime.fromisoformat(takeoff_str.replace("Z", "+00:00"))
+                local_takeoff = to_local(timezone_at(*airports[orig_icao]), utc_takeoff)
+
+                if local_takeoff.date() == target_date:
+                    f["datetime_takeoff_local"] = local_takeoff.isoformat()
+
+                    if dest_icao in airports and landing_str:
+                        utc_landing = datetime.fromisoformat(
+                            landing_str.replace("Z", "+00:00")
                         )
-                        local_takeoff = getLocalDatetime(
-                            orig_coords[0], orig_coords[1], utc_takeoff
+                        local_landing = to_local(
+                            timezone_at(*airports[dest_icao]), utc_landing
                         )
+                        f["datetime_landed_local"] = local_landing.isoformat()
 
-                        if local_takeoff.date() == target_date:
-                            f["datetime_takeoff_local"] = local_takeoff.isoformat()
-
-                            if dest_icao and landing_str:
-                                cursor.execute(
-                                    "SELECT latitude, longitude FROM airports WHERE ident = :icao",
-                                    {"icao": dest_icao},
-                                )
-                                dest_coords = cursor.fetchone()
-                                if dest_coords:
-                                    utc_landing = datetime.fromisoformat(
-                                        landing_str.replace("Z", "+00:00")
-                                    )
-                                    local_landing = getLocalDatetime(
-                                        dest_coords[0], dest_coords[1], utc_landing
-                                    )
-                                    f["datetime_landed_local"] = (
-                                        local_landing.isoformat()
-                                    )
-
-                            filtered.append(f)
-                    except Exception:
-                        pass
+                    filtered.append(f)
+            except Exception:
+                pass
     return {"data": filtered}, 200
 
 
@@ -942,92 +971,134 @@ def hasUncommonTrips(username):
         return cursor.fetchone()[0] == 1
 
 
-def formatTrip(trip, public=False):
-    if trip["start_datetime"] not in (1, -1) and trip["end_datetime"] not in (
-        1,
-        -1,
-    ):
-        if trip["type"] in ("poi", "accommodation", "restaurant"):
-            trip["destination_station"] = ""
-        start_datetime = datetime.strptime(trip["start_datetime"], "%Y-%m-%d %H:%M:%S")
-        end_datetime = datetime.strptime(trip["end_datetime"], "%Y-%m-%d %H:%M:%S")
-        start_date = start_datetime.date()
-        end_date = end_datetime.date()
-        if start_datetime.second == 0 and end_datetime.second == 0:
-            start_time = start_datetime.strftime("%H:%M")
-            end_time = end_datetime.strftime("%H:%M")
-
-            if trip["utc_start_datetime"] is None:
-                trip_duration = [
-                    "calc",
-                    (end_datetime - start_datetime).total_seconds(),
-                ]
-            else:
-                utc_start_datetime = datetime.strptime(
-                    trip["utc_start_datetime"], "%Y-%m-%d %H:%M:%S"
-                )
-                utc_end_datetime = datetime.strptime(
-                    trip["utc_end_datetime"], "%Y-%m-%d %H:%M:%S"
+def _get_tickets(ticket_ids):
+    """
+    Tickets by uid, with the number of trips they are shared by
+    """
+    ticket_ids = list(ticket_ids)
+    if not ticket_ids:
+        return {}
+    with managed_cursor(mainConn) as cursor:
+        tickets = cursor.execute(
+            getTicketsById.format(ticket_ids=", ".join(("?",) * len(ticket_ids))),
+            tuple(ticket_ids),
+        ).fetchall()
+    return {ticket["uid"]: ticket for ticket in tickets}
+
+
+def format_trips(trips):
+    """
+    Format trips for display. The tickets, the currency of the logged user and
+    the exchange rates are resolved for the whole batch at once.
+    """
+    user_currency = getLoggedUserCurrency()
+    tickets = _get_tickets(
+        {
+            int(trip["ticket_id"])
+            for trip in trips
+            if trip["ticket_id"] not in (None, "")
+        }
+    )
+
+    # (trip, key) receiving each converted price
+    targets = []
+    conversions = []
+    for trip in trips:
+        trip["user_currency"] = user_currency
+        if trip.get("price") not in (None, ""):
+            targets.append((trip, "price_in_user_currency"))
+            conversions.append(
+                (trip["price"], trip["currency"], user_currency, trip["purchasing_date"])
+            )
+
+        ticket = (
+            tickets.get(int(trip["ticket_id"]))
+            if trip["ticket_id"] not in (None, "")
+            else None
+        )
+        if ticket is not None:
+            trip["ticket"] = ticket["name"]
+            trip["ticket_price"] = ticket["price"] / ticket["trip_count"]
+            trip["ticket_currency"] = ticket["currency"]
+            targets.append((trip, "ticket_price_in_user_currency"))
+            conversions.append(
+                (
+                    trip["ticket_price"],
+                    trip["ticket_currency"],
+                    user_currency,
+                    ticket["purchasing_date"],
                 )
-                trip_duration = [
-                    "calc",
-                    (utc_end_datetime - utc_start_datetime).total_seconds(),
-                ]
+            )
+
+    for (trip, key), price in zip(targets, get_exchange_rates(conversions)):
+        trip[key] = price
+
+    for trip in trips:
+        trip_duration = ["", ""]
+        if trip["start_datetime"] not in (1, -1) and trip["end_datetime"] not in (
+            1,
+            -1,
+        ):
+            if trip["type"] in ("poi", "accommodation", "restaurant"):
+                trip["destination_station"] = ""
+            start_datetime = datetime.strptime(
+                trip["start_datetime"], "%Y-%m-%d %H:%M:%S"
+            )
+            end_datetime = datetime.strptime(trip["end_datetime"], "%Y-%m-%d %H:%M:%S")
+            start_date = start_datetime.date()
+            end_date = end_datetime.date()
+            if start_datetime.second == 0 and end_datetime.second == 0:
+                start_time = start_datetime.strftime("%H:%M")
+                end_time = end_datetime.strftime("%H:%M")
+
+                if trip["utc_start_datetime"] is None:
+                    trip_duration = [
+                        "calc",
+                        (end_datetime - start_datetime).total_seconds(),
+                    ]
+                else:
+                    utc_start_datetime = datetime.strptime(
+                        trip["utc_start_datetime"], "%Y-%m-%d %H:%M:%S"
+                    )
+                    utc_end_datetime = datetime.strptime(
+                        trip["utc_end_datetime"], "%Y-%m-%d %H:%M:%S"
+                    )
+                    trip_duration = [
+                        "calc",
+                        (utc_end_datetime - utc_start_datetime).total_seconds(),
+                    ]
+
+                if end_date != start_date:
+                    days_diff = end_date - start_date
+                    end_time += "(+{})".format(days_diff.days)
+            else:
+                start_time = end_time = ""
+                if trip["manual_trip_duration"] is not None:
+                    trip_duration = ["man", trip["manual_trip_duration"]]
+                elif trip["estimated_trip_duration"] is not None:
+                    trip_duration = ["est", trip["estimated_trip_duration"]]
 
-            if end_date != start_date:
-                days_diff = end_date - start_date
-                end_time += "(+{})".format(days_diff.days)
+            start_date = start_date.strftime("%Y-%m-%d")
         else:
-            start_time = end_time = ""
+            start_date = start_time = end_time = ""
             if trip["manual_trip_duration"] is not None:
                 trip_duration = ["man", trip["manual_trip_duration"]]
             elif trip["estimated_trip_duration"] is not None:
                 trip_duration = ["est", trip["estimated_trip_duration"]]
+            else:
+                start_date = start_time = end_time = ""
+                trip_duration = ["", ""]
+        if trip["operator"] is None or trip["operator"] == "":
+            trip["operator"] = ""
 
-        start_date = start_date.strftime("%Y-%m-%d")
-    else:
-        start_date = start_time = end_time = ""
-        if trip["manual_trip_duration"] is not None:
-            trip_duration = ["man", trip["manual_trip_duration"]]
-        elif trip["estimated_trip_duration"] is not None:
-            trip_duration = ["est", trip["estimated_trip_duration"]]
-        else:
-            start_date = start_time = end_time = ""
-            trip_duration = ["", ""]
-    trip["user_currency"] = getLoggedUserCurrency()
-    if trip.get("price") not in (None, ""):
-        trip["price_in_user_currency"] = get_exchange_rate(
-            base_currency=trip["currency"],
-            target_currency=trip["user_currency"],
-            date=trip["purchasing_date"],
-            price=trip["price"],
-        )
-
-    if trip["ticket_id"] not in (None, ""):
-        with managed_cursor(mainConn) as cursor:
-            cursor.execute(getTicket, (trip["ticket_id"],))
-            ticket = cursor.fetchall()[0]
-        trip["ticket"] = ticket["name"]
-        trip["ticket_price"] = ticket["price"] / ticket["trip_count"]
-        trip["ticket_currency"] = ticket["currency"]
-        trip["ticket_price_in_user_currency"] = get_exchange_rate(
-            price=trip["ticket_price"],
-            base_currency=trip["ticket_currency"],
-            target_currency=trip["user_currency"],
-            date=ticket["purchasing_date"],
-        )
-
-    if trip["operator"] is None or trip["operator"] == "":
-        trip["operator"] = ""
-
-    if trip["line_name"] is None or trip["line_name"] == "":
-        trip["line_name"] = ""
+        if trip["line_name"] is None or trip["line_name"] == "":
+            trip["line_name"] = ""
 
-    trip["start_date"] = start_date
-    trip["start_time"] = start_time
-    trip["end_time"] = end_time
-    trip["trip_duration"] = trip_duration
-    return trip
+        trip["start_date"] = start_date
+        trip["start_time"] = start_time
+        trip["end_time"] = end_time
+        trip["trip_duration"] = trip_duration
+    return trips
 
 
 def user_exists(username):
@@ -1195,6 +1266,10 @@ def before_request():
     changeLang(language, session)
 
 
+app.teardown_request(release_request_connections)
+app.teardown_request(remove_pg_session)
+
+
 @app.context_processor
 def inject_distinct_types():
     if "userinfo" not in session:
@@ -1485,6 +1560,7 @@ def attach_tag(username):
                 (tag_id, trip_id, tag_id, trip_id),
             )
         mainConn.commit()
+    update_trip_search(trip_ids)
     return ""
 
 
@@ -1508,6 +1584,7 @@ def detach_tag(username):
                 (tag_id, trip_id),
             )
         mainConn.commit()
+    update_trip_search(trip_ids)
     return ""
 
 
@@ -1586,14 +1663,9 @@ def handle_gpx_upload(username, source):
                             all_points.extend(segment.points)
 
                 # 2. Compute total distance across *all* points (including "gaps" between segments)
-                for i in range(1, len(all_points)):
-                    total_distance += getDistance(
-                        {
-                            "lat": all_points[i - 1].latitude,
-                            "lng": all_points[i - 1].longitude,
-                        },
-                        {"lat": all_points[i].latitude, "lng": all_points[i].longitude},
-                    )
+                total_distance = path_length(
+                    to_coords([(point.latitude, point.longitude) for point in all_points])
+                )
 
                 # Assign them back to your existing variables so you don't change the rest of your code.
                 points = all_points
@@ -1840,21 +1912,16 @@ def cluster_waypoints(waypoints, min_distance_meters=10):
     :param min_distance_meters: Minimum distance in meters to consider points as separate
     :return: List of simplified waypoints
     """
-    from math import asin, cos, radians, sin, sqrt
 
     def haversine(lat1, lon1, lat2, lon2):
-        """Calculate the great circle distance between two points in meters"""
-        # Convert decimal degrees to radians
-        lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-
-        # Haversine formula
-        dlon = lon2 - lon1
-        dlat = lat2 - lat1
-        a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-        c = 2 * asin(sqrt(a))
-        # Radius of earth in meters
-        r = 6371000
-        return c * r
+        """Great circle distance between two points in meters, with math rather
+        than the numpy kernel, whose overhead dominates for a single pair"""
+        lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+        a = (
+            math.sin((lat2 - lat1) / 2) ** 2
+            + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+        )
+        return 2 * math.asin(math.sqrt(a)) * 6371000
 
     if not waypoints:
         return []
@@ -2300,9 +2367,16 @@ def delete_tag(username, tag_id):
         if cursor.fetchone()["username"] != username:
             raise 401
         else:
+            trip_ids = [
+                row["trip_id"]
+                for row in cursor.execute(
+                    "SELECT trip_id FROM tags_associations WHERE tag_id = ?", (tag_id,)
+                ).fetchall()
+            ]
             cursor.execute("DELETE FROM tags WHERE uid = ?", (tag_id,))
             cursor.execute("DELETE FROM tags_associations WHERE tag_id = ?", (tag_id,))
     mainConn.commit()
+    update_trip_search(trip_ids)
     return redirect(url_for("tag_list", username=username))
 
 
@@ -2322,6 +2396,7 @@ def update_tag(username, tag_id):
                 (tag_name, tag_colour, tag_type, tag_id),
             )
     mainConn.commit()
+    update_tag_search(tag_id)
     return redirect(url_for("tag_list", username=username))
 
 
@@ -2919,50 +2994,9 @@ def countries(username, cc):
 @app.route("/<username>/countryGeoJSON/<cc>")
 @public_required
 def getCountryGeoJSON(username, cc):
-    def midpoint(point1, point2):
-        return ((point1[0] + point2[0]) / 2, (point1[1] + point2[1]) / 2)
-
-    def getPolygonFromCoordinates(cc, lat, lng):
-        return geopip_country.search(cc=cc, lat=lat, lng=lng)
-
     start_time = datetime.now()
-    # Prepare the parameters
-    if "-" in cc:
-        params = {"username": username, "country": "%" + cc.split("-")[0] + "%"}
-    else:
-        params = {"username": username, "country": "%" + cc + "%"}
-
-    with managed_cursor(mainConn) as cursor:
-        idList = [
-            row["uid"] for row in cursor.execute(getTripsCountry, params).fetchall()
-        ]
-
-    formattedGetUserLines = getUserLines.format(
-        trip_ids=", ".join(("?",) * len(idList))
-    )
-    with managed_cursor(pathConn) as cursor:
-        pathResult = cursor.execute(formattedGetUserLines, tuple(idList)).fetchall()
-
-    # Extract unique nodes
-    unique_nodes = set()
-    for path in pathResult:
-        nodes = json.loads(path[1])
-        for i in range(len(nodes) - 1):
-            start = (nodes[i][0], nodes[i][1])
-            end = (nodes[i + 1][0], nodes[i + 1][1])
-            mid = midpoint(start, end)
-            unique_nodes.add(mid)
-        unique_nodes.update((node[0], node[1]) for node in nodes)
-
-    exclude_ids = list(
-        dict.fromkeys(
-            [
-                coord["id"]
-                for lat, lng in unique_nodes
-                if (coord := getPolygonFromCoordinates(cc, lat, lng)) is not None
-            ]
-        )
-    )
+    sync_user_regions(username)
+    exclude_ids = traveled_polygons(username, cc)
 
     directory_path = "country_percent/countries/processed/"
 
@@ -2976,7 +3010,7 @@ def getCountryGeoJSON(username, cc):
             feature_id = feature["properties"].get("id")
             feature_area = feature["properties"].get("area_m2", 0)
 
-            if feature_id in exclude_ids:
+            if str(feature_id) in exclude_ids:
                 feature["properties"]["traveled"] = True
                 traveled_area += feature_area
             else:
@@ -3088,6 +3122,7 @@ def remove_polygons(cc):
 
     with open(file_path, "w") as file:
         json.dump(geojson_data, file)
+    region_index.build_index(cc)
 
     return jsonify({"success": True})
 
@@ -3523,8 +3558,8 @@ def convert_path_to_format(path, output_format):
     """
     Convert the path data to the specified format (GPX or GeoJSON).
     """
-    # Load path data from JSON
-    coordinates = json.loads(path)
+    # Decode the stored path
+    coordinates = path_to_list(path)
 
     if output_format == "gpx":
         # Create the GPX root element
@@ -3963,7 +3998,7 @@ def get_trip(trip_id):
     formattedGetUserLines = getUserLines.format(trip_ids=trip_id)
     with managed_cursor(pathConn) as cursor:
         pathResult = cursor.execute(formattedGetUserLines).fetchone()
-    path = json.loads(pathResult["path"])
+    path = path_to_list(pathResult["path"])
 
     return Trip(
         trip_id=trip_id,
@@ -4014,7 +4049,7 @@ def update_trip_values_from_form_data(trip_id, formData, update_created_ts=False
     if "path" in formData.keys():
         path = [[coord["lat"], coord["lng"]] for coord in json.loads(formData["path"])]
     else:
-        path = json.loads(pathResult["path"])
+        path = path_to_list(pathResult["path"])
 
     limits = [
         {
@@ -5037,8 +5072,16 @@ def delete_user(uid):
         )
         with managed_cursor(pathConn) as cursor:
             cursor.execute(formattedDeleteUserPath, tuple(idList)).fetchall()
+            delete_path_meta(cursor, idList)
         with managed_cursor(mainConn) as cursor:
             cursor.execute(deleteUserTrips, {"username": user.username})
+            delete_user_regions(cursor, user.username)
+            delete_user_squares(cursor, user.username)
+            delete_user_stats(cursor, user.username)
+            delete_user_trip_search(cursor, user.username)
+            delete_user_trip_counts(cursor, user.username)
+            delete_user_revisions(cursor, user.username)
+            delete_user_trip_tiles(cursor, user.username)
         authDb.session.delete(user)
 
         authDb.session.commit()
@@ -5050,75 +5093,203 @@ def delete_user(uid):
     return ""
 
 
-def fetchTripsPaths(username, lastLocal, public):
-    tripList = []
-    now = datetime.now()
-    with managed_cursor(mainConn) as cursor:
-        idList = [
-            row["uid"]
-            for row in cursor.execute(
-                "SELECT uid FROM trip WHERE username=:username", {"username": username}
-            ).fetchall()
-        ]
+# trips whose paths are read together when streaming the map data
+PATHS_STREAM_CHUNK = 200
 
+
+def requestedLod():
+    """
+    Level of simplification of the paths asked with ?lod=, 0 for the full paths,
+    see LOD_TOLERANCES
+    """
+    return min(max(request.args.get("lod", 0, type=int), 0), max(LOD_TOLERANCES))
+
+
+def iterTripsPaths(username, lastLocal, public, revision, lod=0):
+    """
+    Trips and raw stored paths of the map changed since the revision lastLocal,
+    as ("meta", {lastLocal, full}), then ("trip", trip, raw path) for each trip
+    and ("deleted", ids of the trips to remove from the map). All of them if
+    lastLocal is "all" or a timestamp of the former protocol, which the map then
+    replaces its data with.
+
+    Paths are read by chunks of PATHS_STREAM_CHUNK trips, so that only one
+    chunk of them is in memory at once, simplified to the given level.
+    """
+    since = int(lastLocal) if lastLocal.isdigit() else None
+    if since is not None and since > revision:
+        since = None
+    yield "meta", {"lastLocal": revision, "full": since is None}
+    if since == revision:
+        yield "deleted", []
+        return
+
+    changed = deleted = []
+    if since is not None:
+        changed, deleted = get_changes(username, since)
+        if not changed:
+            yield "deleted", deleted
+            return
+
+    with managed_cursor(mainConn) as cursor:
         trips = cursor.execute(
             getUniqueUserTrips,
-            {"username": username, "lastLocal": lastLocal, "public": public},
+            {
+                "username": username,
+                "since": since,
+                "public": public,
+                "min_lat": None,
+                "min_lng": None,
+                "max_lat": None,
+                "max_lng": None,
+            },
         ).fetchall()
-
     trips.reverse()
-    tripIds = [trip["uid"] for trip in trips]
-    print(public, len(tripIds))
-    formattedGetUserLines = getUserLines.format(
-        trip_ids=", ".join(("?",) * len(tripIds))
-    )
 
-    tripIds = []
-    for trip in trips:
-        tripIds.append(trip["uid"])
-    formattedGetUserLines = getUserLines.format(
-        trip_ids=", ".join(("?",) * len(tripIds))
-    )
+    shown = set()
+    grouped = set()
+    for index in range(0, len(trips), PATHS_STREAM_CHUNK):
+        chunk = trips[index : index + PATHS_STREAM_CHUNK]
+        tripIds = [trip["uid"] for trip in chunk]
+        formattedGetUserLines = getUserLinesLod.format(
+            trip_ids=", ".join(("?",) * len(tripIds))
+        )
+        with managed_cursor(pathConn) as cursor:
+            paths = {
+                path["trip_id"]: path["path"]
+                for path in cursor.execute(formattedGetUserLines, (lod, *tripIds))
+            }
 
-    tripIds = []
-    for trip in trips:
-        tripIds.append(trip["uid"])
-    formattedGetUserLines = getUserLines.format(
-        trip_ids=", ".join(("?",) * len(tripIds))
-    )
-    with managed_cursor(pathConn) as cursor:
-        pathResult = cursor.execute(formattedGetUserLines, tuple(tripIds)).fetchall()
+        for trip in chunk:
+            trip = dict(trip)
+            trip.pop("past")
+            trip.pop("plannedFuture")
+            trip.pop("current")
+            trip.pop("future")
+            trip.pop("first_uid")
+            grouped.update(int(uid) for uid in trip.pop("group_uids").split(","))
+            shown.add(trip["uid"])
+            yield "trip", trip, paths.get(trip["uid"])
+
+    # changed trips which are not shown anymore because of their new type, and
+    # the trips of the sent groups which are shown by another trip of the group
+    hidden = [trip_id for trip_id in changed if trip_id not in shown]
+    if since is not None:
+        hidden += sorted(grouped - shown - set(hidden))
+    yield "deleted", deleted + hidden
+
+
+def fetchTripsPaths(username, lastLocal, public, revision, lod=0):
+    """
+    Map data of iterTripsPaths as a single JSON object, with decoded paths
+    """
+    result = {"trips": []}
+    for item in iterTripsPaths(username, lastLocal, public, revision, lod):
+        if item[0] == "meta":
+            result.update(item[1])
+        elif item[0] == "trip":
+            _, trip, path = item
+            result["trips"].append(
+                {"trip": trip, "path": path_to_list(path) if path is not None else {}}
+            )
+        else:
+            result["deleted"] = item[1]
+    return result
 
-    paths = {path["trip_id"]: path["path"] for path in pathResult}
 
-    for trip in trips:
-        trip = dict(trip)
-        trip.pop("past")
-        trip.pop("plannedFuture")
-        trip.pop("current")
-        trip.pop("future")
+def streamTripsPaths(username, lastLocal, public, revision, lod=0):
+    """
+    Map data of iterTripsPaths as NDJSON: a line with lastLocal and full, a line
+    per trip and a last line with deleted. Paths are sent as stored, in base64,
+    in the binary format of src/path_codec, without decoding them.
+    """
+    for item in iterTripsPaths(username, lastLocal, public, revision, lod):
+        if item[0] == "trip":
+            _, trip, path = item
+            if path is not None:
+                if not is_encoded(path):
+                    path = encode_path(json.loads(path))
+                path = base64.b64encode(path).decode()
+            line = {"trip": trip, "path": path}
+        elif item[0] == "meta":
+            line = item[1]
+        else:
+            line = {"deleted": item[1]}
+        yield json.dumps(line, separators=(",", ":")) + "\n"
 
-        tripList.append(
-            {"trip": trip, "path": json.loads(paths.get(trip["uid"], "{}"))}
-        )
 
-    print(datetime.now() - now)
-    lastLocal = datetime.strftime(datetime.now(), "%Y-%m-%dT%H:%M:%S.%f")
-    return {"trips": tripList, "lastLocal": lastLocal, "idList": idList}
+def gzipStream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def tripsPathsResponse(username, lastLocal, public):
+    """
+    Answer with 304 Not Modified when the map already has this answer, which
+    only needs the revision of the user. With ?format=ndjson the answer is
+    streamed, and gzipped here as Flask-Compress would buffer it.
+    """
+    revision = get_user_revision(username)
+    ndjson = request.args.get("format") == "ndjson"
+    lod = requestedLod()
+    etag = f"{public}-{lastLocal}-{revision}-{lod}{'-ndjson' if ndjson else ''}"
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    elif ndjson:
+        lines = streamTripsPaths(username, lastLocal, public, revision, lod)
+        gzipped = "gzip" in request.accept_encodings
+        response = Response(
+            stream_with_context(gzipStream(lines) if gzipped else lines),
+            mimetype="application/x-ndjson",
+        )
+        if gzipped:
+            response.headers["Content-Encoding"] = "gzip"
+        response.headers["Vary"] = "Accept-Encoding"
+    else:
+        response = jsonify(
+            fetchTripsPaths(username, lastLocal, public, revision, lod)
+        )
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
 
 
 @app.route("/public/<username>/getTripsPaths/<lastLocal>", methods=["GET", "POST"])
 @public_required  # Public access check
 def public_getTripsPaths(username, lastLocal):
-    result = fetchTripsPaths(username, lastLocal, public=1)
-    return jsonify(result)
+    return tripsPathsResponse(username, lastLocal, public=1)
 
 
 @app.route("/<username>/getTripsPaths/<lastLocal>", methods=["GET", "POST"])
 @login_required  # Login access check
 def getTripsPaths(username, lastLocal):
-    result = fetchTripsPaths(username, lastLocal, public=0)
-    return jsonify(result)
+    return tripsPathsResponse(username, lastLocal, public=0)
+
+
+def tripTileResponse(username, public, z, x, y):
+    if z > MAX_ZOOM or x >= 2**z or y >= 2**z:
+        abort(404)
+    response = make_response(get_trip_tile(username, public, z, x, y))
+    response.mimetype = "application/vnd.mapbox-vector-tile"
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@app.route("/public/<username>/trips/<int:z>/<int:x>/<int:y>.mvt")
+@public_required
+def public_getTripsTile(username, z, x, y):
+    return tripTileResponse(username, 1, z, x, y)
+
+
+@app.route("/<username>/trips/<int:z>/<int:x>/<int:y>.mvt")
+@login_required
+def getTripsTile(username, z, x, y):
+    return tripTileResponse(username, 0, z, x, y)
 
 
 @app.route("/<username>/getCurrentTrip", methods=["GET", "POST"])
@@ -5139,20 +5310,22 @@ def getCurrentTripPath(username):
     for path in pathResult:
         paths[path["trip_id"]] = path["path"]
 
-    for tripId in tripIds:
-        with managed_cursor(mainConn) as cursor:
-            trip = formatTrip(
-                dict(cursor.execute(getTrip, {"trip_id": tripId}).fetchone())
-            )
+    with managed_cursor(mainConn) as cursor:
+        trips = [
+            dict(cursor.execute(getTrip, {"trip_id": tripId}).fetchone())
+            for tripId in tripIds
+        ]
+    for trip in format_trips(trips):
         user = User.query.filter_by(username=trip["username"]).first()
         if not session.get(user.username) and not user.is_public():
             abort(401)
+        path = path_to_list(paths[trip["uid"]])
         tripList.append(
             {
                 "time": trip["time"],
                 "trip": dict(trip),
-                "path": json.loads(paths[trip["uid"]]),
-                "distances": getDistanceFromPath(json.loads(paths[trip["uid"]])),
+                "path": path,
+                "distances": getDistanceFromPath(path),
             }
         )
     sortedTripList = sorted(tripList, key=lambda d: d["trip"]["uid"], reverse=True)
@@ -5209,38 +5382,36 @@ def get_logo_url(operator, trip):
         return None
 
 
-def processPublicTrips(tripIds):
+def processPublicTrips(tripIds, lod=0):
     user_currency = getLoggedUserCurrency()
-    for trip in tripIds.split(","):
-        with managed_cursor(mainConn) as cursor:
-            trip = cursor.execute(getTrip, {"trip_id": trip}).fetchone()
-        user = User.query.filter_by(username=trip["username"]).first()
+    tripIds = tripIds.split(",")
+    with managed_cursor(mainConn) as cursor:
+        trips = [
+            dict(cursor.execute(getTrip, {"trip_id": tripId}).fetchone())
+            for tripId in tripIds
+        ]
+    for username in {trip["username"] for trip in trips}:
+        user = User.query.filter_by(username=username).first()
         if (
             not session.get(user.username)
             and not user.is_public_trips()
             and not session.get(owner)
         ):
             abort(401)
-    tripIds = tripIds.split(",")
 
     tripList = []
 
-    formattedGetUserLines = getUserLines.format(
+    formattedGetUserLines = getUserLinesLod.format(
         trip_ids=", ".join(("?",) * len(tripIds))
     )
     with managed_cursor(pathConn) as cursor:
-        pathResult = cursor.execute(formattedGetUserLines, tuple(tripIds)).fetchall()
+        pathResult = cursor.execute(formattedGetUserLines, (lod, *tripIds)).fetchall()
     paths = {}
     for path in pathResult:
         paths[path["trip_id"]] = path["path"]
 
     total_price = 0
-    for tripId in tripIds:
-        with managed_cursor(mainConn) as cursor:
-            trip = formatTrip(
-                dict(cursor.execute(getTrip, {"trip_id": tripId}).fetchone())
-            )
-
+    for trip in format_trips(trips):
         # Process multi operator logos
         if "," in str(trip["operator"]):
             operator_names = trip["operator"]
@@ -5265,45 +5436,18 @@ def processPublicTrips(tripIds):
             trip.pop("operator_name", None)
             trip.pop("logo_url", None)
 
-        if trip["ticket_id"] not in (None, ""):
-            with managed_cursor(mainConn) as cursor:
-                cursor.execute(getTicket, (trip["ticket_id"],))
-                ticket = cursor.fetchall()[0]
-            trip["ticket"] = ticket["name"]
-            trip["ticket_price"] = ticket["price"] / ticket["trip_count"]
-            trip["ticket_currency"] = ticket["currency"]
-            trip["ticket_price_in_user_currency"] = get_exchange_rate(
-                price=trip["ticket_price"],
-                base_currency=trip["ticket_currency"],
-                target_currency=user_currency,
-                date=ticket["purchasing_date"],
-            )
-            if trip["ticket_price_in_user_currency"] is not None:
-                total_price += trip["ticket_price_in_user_currency"]
-
-        if trip["price"] not in (None, ""):
-            trip["price_in_user_currency"] = get_exchange_rate(
-                price=trip["price"],
-                base_currency=trip["currency"],
-                target_currency=user_currency,
-                date=trip["purchasing_date"],
-            )
-            trip["user_currency"] = user_currency
-            if trip["price_in_user_currency"] is not None:
-                total_price += trip["price_in_user_currency"]
-
-        user = User.query.filter_by(username=trip["username"]).first()
-        if (
-            not session.get(user.username)
-            and not user.is_public_trips()
-            and not session.get(owner)
+        for price in (
+            trip.get("ticket_price_in_user_currency"),
+            trip.get("price_in_user_currency"),
         ):
-            abort(401)
+            if price is not None:
+                total_price += price
+
         tripList.append(
             {
                 "time": trip["time"],
                 "trip": dict(trip),
-                "path": json.loads(paths[trip["uid"]]),
+                "path": path_to_list(paths[trip["uid"]]),
             }
         )
     sortedTripList = sorted(tripList, key=lambda d: d["trip"]["uid"], reverse=True)
@@ -5485,7 +5629,7 @@ def mergeTrips(username, tripIds):
 
 @app.route("/getMultiTrips/<tripIds>", methods=["GET", "POST"])
 def getMultiTrips(tripIds):
-    sortedTripList, priceDict = processPublicTrips(tripIds)
+    sortedTripList, priceDict = processPublicTrips(tripIds, requestedLod())
     userList = set()
     anonymous = {}
     for trip in sortedTripList:
@@ -5508,123 +5652,35 @@ def getMultiTrips(tripIds):
     return jsonify(sortedTripList, priceDict, colours)
 
 
-def fetch_stats(username, tripType, year=None):
+def compute_stats(username, tripType, year=None):
     stats = {}
     with managed_cursor(mainConn) as cursor:
         for avType in cursor.execute(typeAvailable, {"username": username}).fetchall():
             if avType["type"] == tripType:
-                stats["newOperators"] = {
-                    "km": getStatsGeneral(
-                        query=newStatsOperatorKm,
-                        cursor=cursor,
-                        username=username,
-                        statName="operator",
-                        tripType=tripType,
-                        year=year,
-                    ),
-                    "trips": getStatsGeneral(
-                        query=newStatsOperatorTrips,
-                        cursor=cursor,
-                        username=username,
-                        statName="operator",
-                        tripType=tripType,
-                        year=year,
-                    ),
-                }
-                stats["material"] = {
-                    "km": getStatsGeneral(
-                        query=statsMaterialKm,
-                        cursor=cursor,
-                        username=username,
-                        statName="material",
-                        tripType=tripType,
-                        year=year,
-                    ),
-                    "trips": getStatsGeneral(
-                        query=statsMaterialTrips,
-                        cursor=cursor,
-                        username=username,
-                        statName="material",
-                        tripType=tripType,
-                        year=year,
-                    ),
-                }
-                stats["countries"] = {
-                    "km": getStatsCountries(
-                        query=statsCountries,
-                        cursor=cursor,
-                        username=username,
-                        km=True,
-                        tripType=tripType,
-                        year=year,
-                    ),
-                    "trips": getStatsCountries(
-                        query=statsCountries,
-                        cursor=cursor,
-                        username=username,
-                        km=False,
-                        tripType=tripType,
-                        year=year,
-                    ),
-                }
-                stats["years"] = {
-                    "km": getStatsYears(
-                        query=statsYearKm,
-                        cursor=cursor,
-                        username=username,
-                        lang=lang[session["userinfo"]["lang"]],
-                        tripType=tripType,
-                        year=year,
-                    ),
-                    "trips": getStatsYears(
-                        query=statsYearTrips,
-                        cursor=cursor,
-                        username=username,
-                        lang=lang[session["userinfo"]["lang"]],
-                        tripType=tripType,
-                        year=year,
-                    ),
-                }
-                stats["newRoutes"] = {
-                    "km": getStatsGeneral(
-                        query=statsRoutesKm + " 10",
-                        cursor=cursor,
-                        username=username,
-                        statName="route",
-                        tripType=tripType,
-                        year=year,
-                    ),
-                    "trips": getStatsGeneral(
-                        query=statsRoutesTrips + " 10",
-                        cursor=cursor,
-                        username=username,
-                        statName="route",
-                        tripType=tripType,
-                        year=year,
-                    ),
-                }
-                stats["newStations"] = {
-                    "km": getStatsGeneral(
-                        query=statsStationsKm + " 10",
-                        cursor=cursor,
-                        username=username,
-                        statName="station",
-                        tripType=tripType,
-                        year=year,
-                    ),
-                    "trips": getStatsGeneral(
-                        query=statsStationsTrips + " 10",
-                        cursor=cursor,
-                        username=username,
-                        statName="station",
-                        tripType=tripType,
-                        year=year,
-                    ),
-                }
+                stats = getStats(
+                    query=statsRows,
+                    cursor=cursor,
+                    username=username,
+                    lang={"future": FUTURE_YEAR},
+                    tripType=tripType,
+                    year=year,
+                )
 
     return stats
 
 
+def fetch_stats(username, tripType, year=None):
+    # the stats of all users (admin) change with every trip, so they are not stored
+    if username is None:
+        stats = compute_stats(username, tripType, year)
+    else:
+        stats = get_stats_snapshot(username, tripType, year)
+        if stats is None:
+            stats = compute_stats(username, tripType, year)
+            save_stats_snapshot(username, tripType, year, stats)
+    return localize_stats(stats, lang[session["userinfo"]["lang"]])
+
+
 @app.route("/<username>/getStats/<year>/<tripType>", methods=["GET", "POST"])
 @app.route("/<username>/getStats/<tripType>", methods=["GET", "POST"])
 @public_required
@@ -5640,12 +5696,11 @@ def getTrips(username, projects):
     if projects:
         trips.reverse()
     for trip in trips:
-        trip = dict(trip)
-        trip = formatTrip(trip)
         if (projects and (trip["future"] == 1 or trip["plannedFuture"] == 1)) or (
             not projects and trip["past"] == 1
         ):
-            tripList.append(trip)
+            tripList.append(dict(trip))
+    tripList = format_trips(tripList)
 
     return json.dumps(tripList)
 
@@ -5691,48 +5746,89 @@ def get_trips_api_internal(username, is_public=False):
         else "default_column_name"
     )
 
-    count_query = getDynamicUserTrips + "SELECT COUNT(*) FROM FilteredTrips"
+    # Ensure the sort direction is safe
+    if sort_direction not in ["asc", "desc"]:
+        sort_direction = "asc"
+
+    filters = ["1"]
     if filter_types:
-        count_query += " WHERE type IN ('train', 'bus', 'air', 'ferry', 'helicopter', 'aerialway', 'tram', 'metro')"
-    if sort_column_name != "start_datetime":
-        data_query = getDynamicUserTrips + " SELECT * FROM FilteredTrips"
-        if filter_types:
-            data_query += " WHERE type IN ('train', 'bus', 'air', 'ferry', 'helicopter', 'aerialway', 'tram', 'metro')"
-        data_query += (
-            f" ORDER BY {sort_column_name} {sort_direction} LIMIT :limit OFFSET :offset"
+        filters.append(
+            "type IN ('train', 'bus', 'air', 'ferry', 'helicopter', 'aerialway', 'tram', 'metro')"
         )
+    if sort_column_name != "start_datetime":
+        order = f"{sort_column_name} {sort_direction}"
     else:
-        data_query = getDynamicUserTrips + " SELECT * FROM FilteredTrips"
-        if filter_types:
-            data_query += " WHERE type IN ('train', 'bus', 'air', 'ferry', 'helicopter', 'aerialway', 'tram', 'metro')"
-        data_query += f" ORDER BY utc_filtered_start_datetime = 1 {sort_direction}, utc_filtered_start_datetime {sort_direction}, uid {sort_direction} LIMIT :limit OFFSET :offset"
+        order = f"utc_filtered_start_datetime = 1 {sort_direction}, utc_filtered_start_datetime {sort_direction}, uid {sort_direction}"
 
-    mainConn.create_function("remove_diacritics", 1, remove_diacritics)
+    search = search_pattern(search_value)
+    if search is not None:
+        index_user_trips(username)
 
-    # Ensure the sort direction is safe
-    if sort_direction not in ["asc", "desc"]:
-        sort_direction = "asc"
+    # The page after the previous one is read from the last trip of the previous
+    # page (keyset pagination) instead of skipping all the trips before it, when
+    # the table is sorted by date. The cursor is only valid for the same filters.
+    page_state = [search_value, sort_column_name, sort_direction, filter_types, past]
+    params = {
+        "username": username,
+        "search": search,
+        "search_indexed": search is not None and uses_index(search),
+        "limit": length,
+        "offset": start,
+        "past": past,
+    }
+    count_filters = " AND ".join(filters)
+    offset = "OFFSET :offset"
+    try:
+        page_cursor = json.loads(request.form.get("cursor", "null"))
+    except ValueError:
+        page_cursor = None
+    if (
+        sort_column_name == "start_datetime"
+        and isinstance(page_cursor, dict)
+        and page_cursor.get("start") == start
+        and page_cursor.get("state") == page_state
+        and len(page_cursor.get("key") or []) == 2
+    ):
+        comparison = ">" if sort_direction == "asc" else "<"
+        filters.append(
+            f"(utc_filtered_start_datetime = 1, utc_filtered_start_datetime, uid) {comparison} (:after_start = 1, :after_start, :after_uid)"
+        )
+        params["after_start"], params["after_uid"] = page_cursor["key"]
+        offset = ""
+
+    count_query = (
+        getDynamicUserTrips
+        + f" SELECT COUNT(*) FROM FilteredTrips WHERE {count_filters}"
+    )
+    data_query = getDynamicUserTrips + getDynamicUserTripsPage.format(
+        filters=" AND ".join(filters), order=order, offset=offset
+    )
+
+    # the count without a search is stored until the trips of the user change
+    records_filtered = None
+    if search is None:
+        records_filtered = get_trip_count(username, past, filter_types)
 
     with managed_cursor(mainConn) as cursor:
-        # Fetch filtered count
-        cursor.execute(
-            count_query,
-            {"username": username, "search": f"%{search_value}%", "past": past},
-        )
-        records_filtered = cursor.fetchone()[0]
+        if records_filtered is None:
+            cursor.execute(count_query, params)
+            records_filtered = cursor.fetchone()[0]
+            if search is None:
+                save_trip_count(username, past, filter_types, records_filtered)
 
         # Fetch the actual page data
-        cursor.execute(
-            data_query,
+        cursor.execute(data_query, params)
+        trips = cursor.fetchall()
+
+    next_cursor = None
+    if sort_column_name == "start_datetime" and trips and length > 0:
+        next_cursor = json.dumps(
             {
-                "username": username,
-                "search": f"%{search_value}%",
-                "limit": length,
-                "offset": start,
-                "past": past,
-            },
+                "start": start + len(trips),
+                "key": [trips[-1]["utc_filtered_start_datetime"], trips[-1]["uid"]],
+                "state": page_state,
+            }
         )
-        trips = cursor.fetchall()
 
     # Convert trips to list of dictionaries
     trip_dicts = [dict(trip) for trip in trips]
@@ -5745,13 +5841,11 @@ def get_trips_api_internal(username, is_public=False):
     if air_trip_uids:
         with managed_cursor(pathConn) as path_cursor:
             path_cursor.execute(
-                f"SELECT trip_id, json_extract(path, '$') as path_json FROM paths WHERE trip_id IN ({','.join(['?'] * len(air_trip_uids))})",
+                f"SELECT trip_id, point_count FROM path_meta WHERE trip_id IN ({','.join(['?'] * len(air_trip_uids))})",
                 air_trip_uids,
             )
-            path_data = path_cursor.fetchall()
-            for row in path_data:
-                path_nodes = json.loads(row["path_json"]) if row["path_json"] else []
-                direct_flight_map[row["trip_id"]] = len(path_nodes) == 2
+            for row in path_cursor.fetchall():
+                direct_flight_map[row["trip_id"]] = row["point_count"] == 2
 
     # Add is_geodesic flag to each trip
     for trip in trip_dicts:
@@ -5766,7 +5860,7 @@ def get_trips_api_internal(username, is_public=False):
             trip.pop("price", None)
 
     # Format trips for display
-    trip_list = [formatTrip(trip) for trip in trip_dicts]
+    trip_list = format_trips(trip_dicts)
 
     # Return the JSON for DataTables
     return jsonify(
@@ -5775,6 +5869,7 @@ def get_trips_api_internal(username, is_public=False):
             "recordsTotal": records_filtered,
             "recordsFiltered": records_filtered,
             "data": trip_list,
+            "cursor": next_cursor,
         }
     )
 
@@ -6046,7 +6141,7 @@ def edit_copy_trip(username, tripId, edit_copy_type):
     with managed_cursor(mainConn) as cursor:
         trip = cursor.execute(getTrip, {"trip_id": tripId}).fetchone()
     with managed_cursor(pathConn) as cursor:
-        path = json.loads(
+        path = path_to_list(
             list(cursor.execute(formattedGetUserLines, (tripId,)).fetchone())[1]
         )
     user = User.query.filter_by(username=trip["username"]).first()
@@ -6198,7 +6293,7 @@ def export(username):
             )
             rowP = list(row.values())
 
-            rowP.append(polyline.encode(json.loads(paths[row["uid"]])))
+            rowP.append(polyline.encode(path_to_list(paths[row["uid"]])))
             processedRows.append(rowP)
         cw.writerows(processedRows)
         response = make_response(si.getvalue())
@@ -6939,6 +7034,7 @@ def delete_airliner():
     with managed_cursor(mainConn) as cursor:
         cursor.execute("DELETE FROM airliners WHERE iata = ?", (iata,))
         mainConn.commit()
+    update_airliner_search([iata])
 
     return jsonify({"success": True})
 
@@ -6971,6 +7067,8 @@ def airliners():
                     (iata, manufacturer, model),
                 )
             mainConn.commit()
+        invalidate_type_stats(["air", "helicopter"])
+        update_airliner_search([original_iata, iata])
 
         return jsonify({"success": True})
 
@@ -7926,7 +8024,8 @@ app.jinja_env.globals.update(getFriendsRequestsNumber=getFriendsRequestsNumber)
 @app.route("/admin/refreshCurrency", methods=["GET"])
 @owner_required
 def refreshCurrency():
-    return run_currency_update()
+    # ?full=true downloads the whole history again instead of the last day
+    return run_currency_update(incremental=request.args.get("full") != "true")
 
 
 @app.route("/ship_route", methods=["POST"])
@@ -8100,139 +8199,13 @@ def active_users():
 
 
 def generate_visited_squares_geojson(username):
-    land_squares = set()
-    air_squares = set()
-    visited_squares = {}
-    current_utc_datetime = datetime.now()
-
-    with managed_cursor(mainConn) as cursor:
-        cursor.execute(
-            """
-                SELECT uid, type
-                FROM trip
-                WHERE username = ?
-                AND start_datetime NOT IN (1)
-                AND (
-                    CASE
-                        WHEN utc_start_datetime IS NOT NULL THEN utc_start_datetime
-                        ELSE start_datetime
-                    END
-                ) < ?
-            """,
-            (username, current_utc_datetime),
-        )
-        trips = cursor.fetchall()
-
-        for trip in trips:
-            trip_id = trip["uid"]
-            trip_type = trip["type"]
-
-            with managed_cursor(pathConn) as cursor:
-                cursor.execute("SELECT path FROM paths WHERE trip_id = ?", (trip_id,))
-                paths = cursor.fetchall()
-
-            for path in paths:
-                coordinates = json.loads(path["path"])
-
-                for i in range(len(coordinates)):
-                    lat, lon = coordinates[i]
-                    square = (math.floor(lat), math.floor(lon))
-
-                    if trip_type in ("air", "helicopter"):
-                        if (
-                            visited_squares.get(square) not in ("stopped", "passed")
-                            and square not in land_squares
-                        ):
-                            visited_squares[square] = "air"
-                            air_squares.add(square)
-                    else:
-                        if visited_squares.get(square) != "stopped":
-                            visited_squares[square] = "passed"
-                        land_squares.add(square)
-                        air_squares.discard(square)
-
-                    # Override with "stopped" on first/last point
-                    if i == 0 or i == len(coordinates) - 1:
-                        visited_squares[square] = "stopped"
-                        land_squares.add(square)
-                        air_squares.discard(square)
-
-                    # Interpolate between points (only for air trips)
-                    if (
-                        trip_type in ("air", "helicopter")
-                        and len(coordinates) > 2
-                        and i < len(coordinates) - 1
-                    ):
-                        next_lat, next_lon = coordinates[i + 1]
-                        intermediates = interpolate_great_circle(
-                            (lat, lon), (next_lat, next_lon), max_distance_km=50
-                        )
-
-                        for inter_lat, inter_lon in intermediates:
-                            inter_square = (
-                                math.floor(inter_lat),
-                                math.floor(inter_lon),
-                            )
-
-                            if (
-                                visited_squares.get(inter_square)
-                                not in ("stopped", "passed")
-                                and inter_square not in land_squares
-                            ):
-                                visited_squares[inter_square] = "air"
-                                air_squares.add(inter_square)
-
-    total_squares = 180 * 360  # entire world grid
-    land_percentage = (len(land_squares) / total_squares) * 100
-    air_percentage = (len(air_squares) / total_squares) * 100
-
-    with managed_cursor(mainConn) as cursor:
-        cursor.execute(
-            upsertPercent,
-            {
-                "username": username,
-                "cc": "world_squares",
-                "percent": round(land_percentage, 2),
-            },
-        )
-    mainConn.commit()
-
-    features = []
-    for square, status in visited_squares.items():
-        lat, lon = square
-        feature = {
-            "type": "Feature",
-            "geometry": {
-                "type": "Polygon",
-                "coordinates": [
-                    [
-                        [lon, lat],
-                        [lon + 1, lat],
-                        [lon + 1, lat + 1],
-                        [lon, lat + 1],
-                        [lon, lat],
-                    ]
-                ],
-            },
-            "properties": {"status": status},
-        }
-        features.append(feature)
-
-    geojson_data = {"type": "FeatureCollection", "features": features}
-    return geojson_data, land_percentage, air_percentage
+    status = user_squares(username)
+    return squares_geojson(status), land_percentage(status), air_percentage(status)
 
 
 @app.route("/tile/<style>/<x>/<y>/<z>/")
 @app.route("/tile/<style>/<x>/<y>/<z>/<r>")
 def tiles(style, x, y, z, r="@1x"):
-    # Create a unique cache key based on the request parameters
-    cache_key = f"{style}_{x}_{y}_{z}_{r}"
-
-    # Try to get the response from cache
-    cached_response = cache.get(cache_key)
-    if cached_response:
-        return cached_response, 200, {"Content-Type": "image/png"}
-
     config = load_config()
     jawg_key = config.get("jawg", {}).get("api_key", "")
     thunderforest_key = config.get("thunderforest", {}).get("api_key", "")
@@ -8258,14 +8231,15 @@ def tiles(style, x, y, z, r="@1x"):
     if not api_url:
         return "Unknown style", 400
 
-    # Fetch from external API
-    response = requests.get(api_url)
-
-    if response.status_code == 200:
-        cache.set(cache_key, response.content)
-        return response.content, 200, {"Content-Type": "image/png"}
-    else:
+    # From the disk cache, or fetched from the external API
+    content = get_tile(f"{style}/{z}/{x}/{y}{r}", api_url)
+    if content is None:
         return f"Tile not found for style {style}", 404
+    return (
+        content,
+        200,
+        {"Content-Type": "image/png", "Cache-Control": "public, max-age=86400"},
+    )
 
 
 @app.route("/flag_sprite.png")
@@ -8733,46 +8707,37 @@ def get_bounds(username):
         return jsonify({"error": "No trips found for this user"}), 404
 
     with managed_cursor(pathConn) as path_cursor:
-        # Fetch all paths associated with the user's trips using IN
+        # Fetch the bounding boxes of the user's trips
         path_cursor.execute(
-            f"SELECT trip_id, path FROM paths WHERE trip_id IN ({','.join(['?'] * len(trip_ids))})",
+            f"SELECT trip_id, min_lat, min_lng, max_lat, max_lng FROM path_meta WHERE trip_id IN ({','.join(['?'] * len(trip_ids))}) AND point_count > 0",
             trip_ids,
         )
-        paths = path_cursor.fetchall()
+        metas = path_cursor.fetchall()
 
-    if not paths:
+    if not metas:
         return jsonify({"error": "No paths found for this user's trips"}), 404
 
-    # Process each path to update the boundary values
-    for trip_id, path_row in paths:
-        path = json.loads(path_row)  # path is a list of lists with coordinates
-        for coord in path:
-            lat, lon = coord
-            # Update bounds with coordinates, place information, and trip_id
-            if (
-                bounds["north"]["coordinates"] is None
-                or lat > bounds["north"]["coordinates"][0]
-            ):
-                bounds["north"]["coordinates"] = (lat, lon)
-                bounds["north"]["trip_id"] = trip_id
-            if (
-                bounds["west"]["coordinates"] is None
-                or lon < bounds["west"]["coordinates"][1]
-            ):
-                bounds["west"]["coordinates"] = (lat, lon)
-                bounds["west"]["trip_id"] = trip_id
-            if (
-                bounds["south"]["coordinates"] is None
-                or lat < bounds["south"]["coordinates"][0]
-            ):
-                bounds["south"]["coordinates"] = (lat, lon)
-                bounds["south"]["trip_id"] = trip_id
-            if (
-                bounds["east"]["coordinates"] is None
-                or lon > bounds["east"]["coordinates"][1]
-            ):
-                bounds["east"]["coordinates"] = (lat, lon)
-                bounds["east"]["trip_id"] = trip_id
+    # Find the trip holding each extreme, then the extreme node in its path.
+    # Each entry is (trip meta, column, max or min), column being 0 for lat, 1 for lon
+    extremes = {
+        "north": (max(metas, key=lambda meta: meta["max_lat"]), 0, max),
+        "west": (min(metas, key=lambda meta: meta["min_lng"]), 1, min),
+        "south": (min(metas, key=lambda meta: meta["min_lat"]), 0, min),
+        "east": (max(metas, key=lambda meta: meta["max_lng"]), 1, max),
+    }
+    extreme_trip_ids = list({meta["trip_id"] for meta, _, _ in extremes.values()})
+    with managed_cursor(pathConn) as path_cursor:
+        path_cursor.execute(
+            f"SELECT trip_id, path FROM paths WHERE trip_id IN ({','.join(['?'] * len(extreme_trip_ids))})",
+            extreme_trip_ids,
+        )
+        paths = {row["trip_id"]: decode_path(row["path"]) for row in path_cursor}
+
+    for direction, (meta, column, pick) in extremes.items():
+        path = paths[meta["trip_id"]]
+        index = path[:, column].argmax() if pick is max else path[:, column].argmin()
+        bounds[direction]["coordinates"] = tuple(path[index].tolist())
+        bounds[direction]["trip_id"] = meta["trip_id"]
 
     # Fetch place names for each boundary using the stored coordinates
     for direction in bounds:
@@ -8852,7 +8817,7 @@ def get_public_current_trips():
 
     result = []
     for trip in public_trips:
-        path = json.loads(paths.get(trip["uid"], "[]"))
+        path = path_to_list(paths.get(trip["uid"]))
         result.append(
             {
                 "username": trip["username"],
@@ -8926,5 +8891,8 @@ init_data(DbNames.MAIN_DB)
 authDb.create_all()
 with managed_cursor(pathConn) as cursor:
     cursor.execute(initPath)
+    cursor.execute(initPathMeta)
+    cursor.execute(initPathLods)
+migrate_paths(pathConn)
 
 setup_db()
@@ -97,8 +97,8 @@ def now_iso_date():
 
 
 def connect_readonly(path: Path):
-    """Open a read-only, immutable SQLite URI connection."""
-    uri = f"file:{path}?mode=ro&immutable=1"
+    """Open a read-only SQLite URI connection, which also sees the WAL of the live DB."""
+    uri = f"file:{path}?mode=ro"
     return sqlite3.connect(uri, uri=True)
 
 
@@ -0,0 +1,196 @@
+"""
+Batched country lookups over static/data/countries-filtered.geojson
+
+getCountriesFromPath used to run one geopip point-in-polygon search per node, and
+per fake node every 10 m on ferries. This engine works on a whole path at once:
+an STRtree over the countries finds the few segments that cross a border, exact
+point-in-polygon tests are only run on the nodes right after such a crossing, and
+every other node inherits the country of the node before it. Ferry segments that
+cross a border are cut at their intersections with the country boundaries, so the
+number of lookups depends on the number of crossings, not on the distance.
+"""
+
+import json
+
+import numpy as np
+import shapely
+
+from py.geo_kernels import segment_lengths
+
+_INSTANCE = None
+
+
+def instance():
+    """Singleton CountryEngine instance (lazy loading)"""
+    global _INSTANCE
+    if _INSTANCE is not None:
+        return _INSTANCE
+
+    _INSTANCE = CountryEngine(filename="static/data/countries-filtered.geojson")
+
+    return _INSTANCE
+
+
+def _forward_fill(values, missing=-1):
+    """Replace each `missing` value by the last non missing value before it"""
+    positions = np.where(values != missing, np.arange(len(values)), -1)
+    np.maximum.accumulate(positions, out=positions)
+    return np.where(positions >= 0, values[positions.clip(0)], missing)
+
+
+class CountryEngine:
+    def __init__(self, filename=None, geojson_dict=None):
+        if geojson_dict is None:
+            with open(filename, "r") as f:
+                geojson_dict = json.load(f)
+
+        features = [f for f in geojson_dict["features"] if f.get("geometry")]
+        geoms = np.array([shapely.geometry.shape(f["geometry"]) for f in features])
+
+        # keep the smallest feature when several of them contain a point, like
+        # geopip does
+        order = np.argsort(shapely.area(geoms), kind="stable")
+        self.geoms = geoms[order]
+        self.properties = [features[i]["properties"] for i in order]
+        # the trailing "UN" is what index -1 (no feature) maps to
+        self.codes = np.array(
+            [p.get("countryCode") or "UN" for p in self.properties] + ["UN"],
+            dtype=object,
+        )
+        self.boundaries = shapely.boundary(self.geoms)
+        shapely.prepare(self.geoms)
+        shapely.prepare(self.boundaries)
+        self.tree = shapely.STRtree(self.geoms)
+
+    def lookup(self, coords):
+        """
+        Index of the feature containing each [lat, lng] of a (n, 2) array, -1 if
+        no feature contains it
+        """
+        result = np.full(len(coords), len(self.geoms), dtype=np.int64)
+        if len(coords):
+            points = shapely.points(coords[:, 1], coords[:, 0])
+            point_idx, feature_idx = self.tree.query(points, predicate="within")
+            np.minimum.at(result, point_idx, feature_idx)
+        result[result == len(self.geoms)] = -1
+        return result
+
+    def search(self, lat, lng):
+        """Properties of the feature containing the point, None if there is none"""
+        feature = self.lookup(np.array([[lat, lng]], dtype=np.float64))[0]
+        return self.properties[feature] if feature != -1 else None
+
+    def crossings(self, coords):
+        """Boolean per segment of the path, True if it crosses a feature boundary"""
+        crossing = np.zeros(max(len(coords) - 1, 0), dtype=bool)
+        if len(crossing) == 0:
+            return crossing
+        xy = coords[:, ::-1]
+        lines = shapely.linestrings(np.stack([xy[:-1], xy[1:]], axis=1))
+        # bounding box candidates, then exact intersection with their boundaries
+        segment_idx, feature_idx = self.tree.query(lines)
+        hits = shapely.intersects(lines[segment_idx], self.boundaries[feature_idx])
+        crossing[segment_idx[hits]] = True
+        return crossing
+
+    def node_features(self, coords, crossing=None):
+        """
+        Index of the feature containing each node of the path (-1 if none),
+        looking up only the first node and the nodes ending a border crossing
+        """
+        if crossing is None:
+            crossing = self.crossings(coords)
+        needed = np.concatenate(([True], crossing))
+        features = np.full(len(coords), -1, dtype=np.int64)
+        features[needed] = self.lookup(coords[needed])
+        # a segment that crosses no boundary ends in the feature it started in
+        owner = np.maximum.accumulate(np.where(needed, np.arange(len(coords)), 0))
+        return features[owner]
+
+    def split_at_borders(self, coords, segments):
+        """
+        Cut the given segments of a path where they cross a feature boundary
+
+        Returns (segment index, start fraction, end fraction) arrays describing
+        the pieces, ordered along the path. Fractions are measured along the
+        segment in lat/lng space.
+        """
+        start = coords[segments]
+        end = coords[segments + 1]
+        lines = shapely.linestrings(np.stack([start[:, ::-1], end[:, ::-1]], axis=1))
+        line_idx, feature_idx = self.tree.query(lines)
+        intersections = shapely.intersection(
+            lines[line_idx], self.boundaries[feature_idx]
+        )
+        points, point_idx = shapely.get_coordinates(intersections, return_index=True)
+        point_line = line_idx[point_idx]
+
+        # position of each intersection along its segment
+        direction = end[point_line] - start[point_line]
+        norm = (direction**2).sum(axis=1)
+        cut = np.divide(
+            ((points[:, ::-1] - start[point_line]) * direction).sum(axis=1),
+            norm,
+            out=np.zeros(len(points)),
+            where=norm > 0,
+        ).clip(0, 1)
+
+        lines_of_cuts = np.concatenate(
+            (np.arange(len(lines)), np.arange(len(lines)), point_line)
+        )
+        cuts = np.concatenate((np.zeros(len(lines)), np.ones(len(lines)), cut))
+        order = np.lexsort((cuts, lines_of_cuts))
+        lines_of_cuts = lines_of_cuts[order]
+        cuts = cuts[order]
+
+        # consecutive cuts of the same segment delimit a piece
+        piece = (lines_of_cuts[:-1] == lines_of_cuts[1:]) & (cuts[1:] > cuts[:-1])
+        return segments[lines_of_cuts[:-1][piece]], cuts[:-1][piece], cuts[1:][piece]
+
+    def country_shares(self, coords, ferry=False):
+        """
+        Distance in meters traveled in each country along a path, as a dict in
+        order of first appearance
+
+        Each segment is attributed to the country of its end node. Nodes outside
+        of any country inherit the previous country, except on ferries where they
+        count as "UN". Ferry segments crossing a border are cut at the borders
+        and each piece is attributed to the country containing its middle.
+        """
+        if len(coords) < 2:
+            return {}
+
+        lengths = segment_lengths(coords)
+        crossing = self.crossings(coords)
+        segment_features = self.node_features(coords, crossing)[1:]
+        if not ferry:
+            segment_features = _forward_fill(segment_features)
+
+        # (segment index, feature, distance) of every piece of the path
+        keys = np.arange(len(lengths))
+        features = segment_features
+        weights = lengths
+
+        split = np.flatnonzero(crossing)
+        if ferry and len(split):
+            kept = np.ones(len(lengths), dtype=bool)
+            kept[split] = False
+            piece_keys, piece_start, piece_end = self.split_at_borders(coords, split)
+            middles = coords[piece_keys] + ((piece_start + piece_end) / 2)[:, None] * (
+                coords[piece_keys + 1] - coords[piece_keys]
+            )
+            keys = np.concatenate((keys[kept], piece_keys))
+            features = np.concatenate((features[kept], self.lookup(middles)))
+            weights = np.concatenate(
+                (weights[kept], lengths[piece_keys] * (piece_end - piece_start))
+            )
+
+        order = np.argsort(keys, kind="stable")
+        codes = self.codes[features[order]]
+        unique_codes, first, inverse = np.unique(
+            codes, return_index=True, return_inverse=True
+        )
+        totals = np.bincount(inverse, weights=weights[order])
+        return {
+            unique_codes[i]: float(totals[i]) for i in np.argsort(first, kind="stable")
+        }
@@ -1,4 +1,9 @@
+import datetime
+import math
 import sqlite3
+import time
+
+import numpy as np
 
 
 def get_available_currencies():
@@ -38,57 +43,173 @@ def get_available_currencies():
     return available_currencies
 
 
-def get_exchange_rate(price, base_currency, target_currency, date):
-    # Return the unconverted price if the base and target currencies are the same
-    if base_currency == target_currency:
-        return price
+class ExchangeRates:
+    """
+    The exchanges table, loaded once as a dense array with one row per day from
+    the first to the last rate date and one column per currency (EUR included,
+    always 1). Days without rates hold the rates of the last day before them, so
+    the rates of a date are found by indexing, with the same result as picking
+    the latest rate date on or before it (or the first one for older dates).
+    """
+
+    # how often the table is checked for new rates, in seconds
+    CHECK_INTERVAL = 600
+
+    def __init__(self, db_path="databases/main.db"):
+        self.db_path = db_path
+        self.load()
+
+    def load(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            cursor = conn.execute("SELECT * FROM exchanges ORDER BY rate_date")
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
+
+        date_column = columns.index("rate_date")
+        currency_columns = [
+            index for index, column in enumerate(columns) if index != date_column
+        ]
+        currencies = [columns[index] for index in currency_columns]
+        days = np.array(
+            [_day_number(row[date_column]) for row in rows], dtype=np.int64
+        )
+        # missing rates (NULL) become NaN
+        values = np.array(
+            [[row[index] for index in currency_columns] for row in rows], dtype=float
+        ).reshape(len(rows), len(currencies))
+        known = days >= 0
+        days, values = days[known], values[known]
+
+        if len(days):
+            first_day = int(days[0])
+            # index of the last rate date on or before each day
+            rate_row = (
+                np.searchsorted(days, np.arange(first_day, days[-1] + 1), side="right")
+                - 1
+            )
+            rates = np.column_stack((np.ones(len(rate_row)), values[rate_row]))
+        else:
+            first_day = 0
+            rates = np.zeros((0, len(currencies) + 1))
+
+        # swapped at once, so that a reload does not disturb concurrent readers
+        self._table = (
+            first_day,
+            rates,
+            {currency: index for index, currency in enumerate(["EUR"] + currencies)},
+        )
+        self._last_rate_date = rows[-1][date_column] if rows else None
+        self._checked = time.monotonic()
+
+    def refresh(self):
+        """
+        Reload the table if rates were added since it was loaded, checking at most
+        every CHECK_INTERVAL seconds
+        """
+        if time.monotonic() - self._checked < self.CHECK_INTERVAL:
+            return
+        conn = sqlite3.connect(self.db_path)
+        try:
+            last_rate_date = conn.execute(
+                "SELECT MAX(rate_date) FROM exchanges"
+            ).fetchone()[0]
+        finally:
+            conn.close()
+        if last_rate_date != self._last_rate_date:
+            self.load()
+        else:
+            self._checked = time.monotonic()
+
+    def convert(self, prices, base_currencies, target_currencies, dates):
+        """
+        Convert the prices from the base to the target currencies with the rates
+        of the dates. Returns a float array, NaN where there is no rate.
+        """
+        self.refresh()
+        first_day, rates, columns = self._table
+        prices = np.asarray(prices, dtype=float)
+        if len(rates) == 0:
+            return np.full(len(prices), np.nan)
+
+        days = np.array([_day_number(date) for date in dates], dtype=np.int64)
+        rows = np.clip(days - first_day, 0, len(rates) - 1)
+        base = np.array([columns.get(c, -1) for c in base_currencies], dtype=np.int64)
+        target = np.array(
+            [columns.get(c, -1) for c in target_currencies], dtype=np.int64
+        )
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rate = 1 / rates[rows, base] * rates[rows, target]
+        rate[(days < 0) | (base < 0) | (target < 0) | ~np.isfinite(rate)] = np.nan
+        return np.round(prices * rate, 2)
 
-    # Ensure the price is a float
-    price = float(price)
-    db_path = "databases/main.db"
 
-    # Attempt to connect to the SQLite database
+def _day_number(date):
+    """
+    Day number of a date, datetime or string starting with YYYY-MM-DD, -1 when
+    it is not a date
+    """
+    if isinstance(date, datetime.datetime):
+        return date.date().toordinal()
+    if isinstance(date, datetime.date):
+        return date.toordinal()
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-    except sqlite3.Error as e:
-        print(f"Database connection error: {e}")
-        return None
-
-    # Select the closest date for the rate, either before or after the given date
-    date_query = """
-        SELECT 
-            COALESCE(MAX(rate_date) FILTER (WHERE rate_date <= ?), MIN(rate_date) FILTER (WHERE rate_date >= ?)) AS relevant_date
-        FROM exchanges;
+        return datetime.date.fromisoformat(date[:10]).toordinal()
+    except (TypeError, ValueError):
+        return -1
+
+
+_INSTANCE = None
+
+
+def exchange_rates():
+    """Singleton ExchangeRates instance (lazy loading)"""
+    global _INSTANCE
+    if _INSTANCE is not None:
+        return _INSTANCE
+
+    _INSTANCE = ExchangeRates()
+
+    return _INSTANCE
+
+
+def reload_exchange_rates():
+    """Reload the rates, after the exchanges table was updated"""
+    if _INSTANCE is not None:
+        _INSTANCE.load()
+
+
+def get_exchange_rate(price, base_currency, target_currency, date):
+    return get_exchange_rates([(price, base_currency, target_currency, date)])[0]
+
+
+def get_exchange_rates(conversions):
     """
-    cursor.execute(date_query, (date, date))
-    relevant_date = cursor.fetchone()[0]
-
-    if relevant_date:
-        # Fetch the rates for the closest date, using SQL parameters to handle the currency codes properly
-        rate_query = f"""
-            SELECT 
-                ({"1" if base_currency == "EUR" else f'"{base_currency}"'}) AS base_rate,
-                ({"1" if target_currency == "EUR" else f'"{target_currency}"'}) AS target_rate
-            FROM exchanges
-            WHERE rate_date = ?;
-        """
-        cursor.execute(rate_query, (relevant_date,))
-        row = cursor.fetchone()
-
-        if row:
-            base_rate, target_rate = (float(row[0]), float(row[1]))
-
-            if base_currency == "EUR":
-                rate = target_rate
-            elif target_currency == "EUR":
-                rate = 1 / base_rate if base_rate != 0 else None
-            else:
-                rate = (1 / base_rate * target_rate) if base_rate != 0 else None
-
-            if rate is not None:
-                converted_price = round(price * rate, 2)
-                conn.close()
-                return converted_price
-    conn.close()
-    return None
+    Convert a batch of prices, given as (price, base_currency, target_currency,
+    date) tuples, with the rates of the closest date to each of them. Returns
+    the converted prices in the same order, None when there is no rate.
+    """
+    converted = [None] * len(conversions)
+    to_convert = []
+    for index, (price, base_currency, target_currency, date) in enumerate(conversions):
+        # Return the unconverted price if the base and target currencies are the same
+        if base_currency == target_currency:
+            converted[index] = price
+        else:
+            to_convert.append(index)
+    if not to_convert:
+        return converted
+
+    prices, base_currencies, target_currencies, dates = zip(
+        *(conversions[index] for index in to_convert)
+    )
+    results = exchange_rates().convert(
+        prices, base_currencies, target_currencies, dates
+    )
+    for index, price in zip(to_convert, results.tolist()):
+        if not math.isnan(price):
+            converted[index] = price
+    return converted
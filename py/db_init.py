@@ -182,6 +182,62 @@ def init_main(path):
         ("cc", "TEXT NOT NULL"),
         ("percent", "INTEGER NOT NULL"),
     ]
+    region_trips_columns = [
+        ("trip_id", "INTEGER NOT NULL"),
+        ("username", "TEXT NOT NULL"),
+        ("counted", "BOOL DEFAULT 0"),
+        # version of the region files, see src/regions.py
+        ("regions_version", "TEXT"),
+    ]
+    region_trip_polygons_columns = [
+        ("trip_id", "INTEGER NOT NULL"),
+        ("cc", "TEXT NOT NULL"),
+        ("polygon_id", "TEXT NOT NULL"),
+    ]
+    region_polygons_columns = [
+        ("username", "TEXT NOT NULL"),
+        ("cc", "TEXT NOT NULL"),
+        ("polygon_id", "TEXT NOT NULL"),
+        ("trips", "INTEGER NOT NULL DEFAULT 0"),
+    ]
+    trip_squares_columns = [
+        ("trip_id", "INTEGER NOT NULL"),
+        ("username", "TEXT NOT NULL"),
+        ("stopped", "BLOB"),
+        ("land", "BLOB"),
+        ("air", "BLOB"),
+    ]
+    stats_snapshots_columns = [
+        ("username", "TEXT NOT NULL"),
+        ("type", "TEXT NOT NULL"),
+        ("year", "TEXT NOT NULL"),
+        ("stats", "TEXT NOT NULL"),
+        ("valid_until", "DATETIME"),
+    ]
+    trip_counts_columns = [
+        ("username", "TEXT NOT NULL"),
+        ("past", "INTEGER NOT NULL"),
+        ("filter_types", "INTEGER NOT NULL"),
+        ("count", "INTEGER NOT NULL"),
+        ("valid_until", "DATETIME"),
+    ]
+    user_revisions_columns = [
+        ("username", "TEXT NOT NULL"),
+        ("revision", "INTEGER NOT NULL"),
+    ]
+    trip_revisions_columns = [
+        ("trip_id", "INTEGER NOT NULL"),
+        ("username", "TEXT NOT NULL"),
+        ("revision", "INTEGER NOT NULL"),
+    ]
+    trip_tile_bounds_columns = [
+        ("trip_id", "INTEGER NOT NULL"),
+        ("username", "TEXT NOT NULL"),
+        ("min_lat", "FLOAT NOT NULL"),
+        ("min_lng", "FLOAT NOT NULL"),
+        ("max_lat", "FLOAT NOT NULL"),
+        ("max_lng", "FLOAT NOT NULL"),
+    ]
     currency_columns = [
         ("rate_date", "DATE NOT NULL UNIQUE"),
         ("AUD", "FLOAT"),
@@ -302,6 +358,20 @@ def init_main(path):
         ("trip", "uid", trip_columns),
         ("manual_stations", "uid", manual_stations_columns),
         ("percents", "uid", percents_columns),
+        ("region_trips", "trip_id", region_trips_columns),
+        (
+            "region_trip_polygons",
+            "trip_id, cc, polygon_id",
+            region_trip_polygons_columns,
+        ),
+        ("region_polygons", "username, cc, polygon_id", region_polygons_columns),
+        ("trip_squares", "trip_id", trip_squares_columns),
+        ("stats_snapshots", "username, type, year", stats_snapshots_columns),
+        ("trip_counts", "username, past, filter_types", trip_counts_columns),
+        ("user_revisions", "username", user_revisions_columns),
+        ("trip_revisions", "trip_id", trip_revisions_columns),
+        ("trip_tombstones", "trip_id", trip_revisions_columns),
+        ("trip_tile_bounds", "trip_id", trip_tile_bounds_columns),
         ("exchanges", "rate_date", currency_columns),
         ("tickets", "uid", tickets_columns),
         ("tags", "tag_id", tags_columns),
@@ -320,5 +390,29 @@ def init_main(path):
     # Setup database (create tables and columns if not exist)
     db_manager.setup_database()
 
+    # full-text index of the trips, see src/trip_search.py
+    db_manager.db_connection.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS trip_search
+        USING fts5(username UNINDEXED, text, tokenize = 'trigram')
+        """
+    )
+    # changes of the trips of a user since a revision, see src/trip_revisions.py
+    for table in ("trip_revisions", "trip_tombstones"):
+        db_manager.db_connection.execute(
+            f"""
+            CREATE INDEX IF NOT EXISTS {table}_username_revision
+            ON {table} (username, revision)
+            """
+        )
+    # trips of a tile of a user, see src/trip_tiles.py
+    db_manager.db_connection.execute(
+        """
+        CREATE INDEX IF NOT EXISTS trip_tile_bounds_username
+        ON trip_tile_bounds (username)
+        """
+    )
+    db_manager.db_connection.commit()
+
     # Close the connection when all operations are done
     db_manager.close()
@@ -0,0 +1,259 @@
+"""
+Great-circle kernels over arrays of [lat, lng]
+
+Distances, cumulative distances and spherical interpolation used to be computed
+one point at a time with the math module or geopy. These functions work on a
+whole (n, 2) array of [lat, lng] in degrees at once.
+
+Run `python -m py.geo_kernels` for a micro-benchmark against the per-point
+implementations they replace.
+"""
+
+import numpy as np
+
+# radius used by getDistance since the beginning, kept for consistent lengths
+EARTH_RADIUS = 6373000.0
+# mean radius of the WGS84 ellipsoid, closest to the geodesic distances of geopy
+MEAN_EARTH_RADIUS = 6371008.8
+
+
+def to_coords(path):
+    """
+    Convert a path given as a list of [lat, lng], of (lat, lng) or of
+    {"lat", "lng"} dicts into a (n, 2) float64 array
+    """
+    if isinstance(path, np.ndarray):
+        return path.astype(np.float64, copy=False).reshape(-1, 2)
+    nodes = [
+        (node["lat"], node["lng"]) if isinstance(node, dict) else (node[0], node[1])
+        for node in path
+    ]
+    return np.array(nodes, dtype=np.float64).reshape(-1, 2)
+
+
+def central_angle(lat1, lng1, lat2, lng2):
+    """
+    Angle in radians between points given in degrees, element-wise
+    """
+    lat1, lng1, lat2, lng2 = (np.radians(value) for value in (lat1, lng1, lat2, lng2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def haversine(lat1, lng1, lat2, lng2, radius=EARTH_RADIUS):
+    """
+    Haversine distance in meters between points given in degrees, element-wise
+    """
+    return radius * central_angle(lat1, lng1, lat2, lng2)
+
+
+def segment_lengths(coords, radius=EARTH_RADIUS):
+    """
+    Length in meters of each segment of a (n, 2) array of [lat, lng]
+    """
+    return haversine(
+        coords[:-1, 0], coords[:-1, 1], coords[1:, 0], coords[1:, 1], radius
+    )
+
+
+def path_length(coords, radius=EARTH_RADIUS):
+    """
+    Total length in meters of a (n, 2) array of [lat, lng]
+    """
+    if len(coords) < 2:
+        return 0.0
+    return float(segment_lengths(coords, radius).sum())
+
+
+def cumulative_distance(coords, radius=EARTH_RADIUS):
+    """
+    Distance in meters from the first node to each node of a (n, 2) array of
+    [lat, lng]
+    """
+    if len(coords) == 0:
+        return np.zeros(0)
+    return np.concatenate(([0.0], np.cumsum(segment_lengths(coords, radius))))
+
+
+def slerp(coords, max_distance_km=50):
+    """
+    Points along the great circle of each segment of a (n, 2) array of
+    [lat, lng], splitting each segment in floor(length / max_distance_km) + 1
+    equal parts. The nodes themselves are not included.
+
+    Returns the (m, 2) array of points and the index of the segment of each
+    point.
+    """
+    if len(coords) < 2:
+        return np.zeros((0, 2)), np.zeros(0, dtype=np.int64)
+    lat1, lng1 = np.radians(coords[:-1, 0]), np.radians(coords[:-1, 1])
+    lat2, lng2 = np.radians(coords[1:, 0]), np.radians(coords[1:, 1])
+    d = central_angle(coords[:-1, 0], coords[:-1, 1], coords[1:, 0], coords[1:, 1])
+    steps = np.floor(d * MEAN_EARTH_RADIUS / 1000 / max_distance_km).astype(np.int64)
+    # antipodal points have no single great circle between them
+    steps[(d == 0) | (np.sin(d) == 0)] = 0
+
+    segment = np.repeat(np.arange(len(d)), steps)
+    step = np.arange(len(segment)) - np.repeat(np.cumsum(steps) - steps, steps) + 1
+    f = step / (steps[segment] + 1)
+    d = d[segment]
+    a = np.sin((1 - f) * d) / np.sin(d)
+    b = np.sin(f * d) / np.sin(d)
+    lat1, lng1, lat2, lng2 = (
+        lat1[segment],
+        lng1[segment],
+        lat2[segment],
+        lng2[segment],
+    )
+    x = a * np.cos(lat1) * np.cos(lng1) + b * np.cos(lat2) * np.cos(lng2)
+    y = a * np.cos(lat1) * np.sin(lng1) + b * np.cos(lat2) * np.sin(lng2)
+    z = a * np.sin(lat1) + b * np.sin(lat2)
+    points = np.degrees(
+        np.stack((np.arctan2(z, np.sqrt(x**2 + y**2)), np.arctan2(y, x)), axis=1)
+    )
+    return points, segment
+
+
+def densify(coords, max_distance_km=50):
+    """
+    Insert the slerp points of each segment of a (n, 2) array of [lat, lng]
+    between its nodes, so that no segment is longer than max_distance_km
+    """
+    points, segment = slerp(coords, max_distance_km)
+    if len(points) == 0:
+        return coords
+    # nodes sort before the points of the segment they start
+    order = np.argsort(
+        np.concatenate((np.arange(len(coords)), segment + 0.5)), kind="stable"
+    )
+    return np.concatenate((coords, points))[order]
+
+
+def simplify(coords, tolerance):
+    """
+    Douglas-Peucker simplification of a (n, 2) array of [lat, lng], keeping the
+    nodes further than tolerance degrees from the simplified line. Longitudes
+    are scaled by the cosine of the latitude so that the tolerance is about the
+    same distance everywhere.
+    """
+    if len(coords) < 3:
+        return coords
+    planar = coords * (1.0, np.cos(np.radians(coords[:, 0].mean())))
+    keep = np.zeros(len(coords), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(coords) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start = planar[first]
+        chord = planar[last] - start
+        offsets = planar[first + 1 : last] - start
+        chord_length = np.hypot(*chord)
+        if chord_length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = (
+                np.abs(chord[0] * offsets[:, 1] - chord[1] * offsets[:, 0])
+                / chord_length
+            )
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            index = first + 1 + farthest
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return coords[keep]
+
+
+if __name__ == "__main__":
+    import math
+    import timeit
+
+    from geopy.distance import geodesic
+
+    def scalar_distance(orig, dest):
+        lat1, lon1 = math.radians(orig[0]), math.radians(orig[1])
+        lat2, lon2 = math.radians(dest[0]), math.radians(dest[1])
+        a = (
+            math.sin((lat2 - lat1) / 2) ** 2
+            + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+        )
+        return EARTH_RADIUS * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+    def scalar_cumulative(path):
+        distances = [0]
+        for previous, current in zip(path[:-1], path[1:]):
+            distances.append(distances[-1] + int(scalar_distance(previous, current)))
+        return distances
+
+    def scalar_densify(path, max_distance_km=50):
+        result = [path[0]]
+        for previous, current in zip(path[:-1], path[1:]):
+            steps = int(geodesic(previous, current).km // max_distance_km)
+            lat1, lon1 = map(math.radians, previous)
+            lat2, lon2 = map(math.radians, current)
+            d = 2 * math.asin(
+                math.sqrt(
+                    math.sin((lat2 - lat1) / 2) ** 2
+                    + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+                )
+            )
+            for i in range(1, steps + 1) if d else ():
+                f = i / (steps + 1)
+                a = math.sin((1 - f) * d) / math.sin(d)
+                b = math.sin(f * d) / math.sin(d)
+                x = a * math.cos(lat1) * math.cos(lon1) + b * math.cos(lat2) * math.cos(
+                    lon2
+                )
+                y = a * math.cos(lat1) * math.sin(lon1) + b * math.cos(lat2) * math.sin(
+                    lon2
+                )
+                z = a * math.sin(lat1) + b * math.sin(lat2)
+                result.append(
+                    (
+                        math.degrees(math.atan2(z, math.sqrt(x**2 + y**2))),
+                        math.degrees(math.atan2(y, x)),
+                    )
+                )
+            result.append(current)
+        return result
+
+    rng = np.random.default_rng(0)
+    # a rail path: 5000 nodes about 200 m apart
+    rail = np.cumsum(rng.normal(0, 0.002, (5000, 2)), axis=0) + (48.0, 2.0)
+    # a flight track: 300 nodes about 100 km apart
+    flight = np.cumsum(rng.normal(0, 1.0, (300, 2)), axis=0) + (40.0, -30.0)
+    rail_list = rail.tolist()
+    flight_list = flight.tolist()
+
+    benchmarks = [
+        (
+            "cumulative distance, 5000 nodes",
+            lambda: scalar_cumulative(rail_list),
+            lambda: cumulative_distance(to_coords(rail_list)),
+        ),
+        (
+            "path length, 5000 nodes",
+            lambda: sum(
+                scalar_distance(a, b) for a, b in zip(rail_list[:-1], rail_list[1:])
+            ),
+            lambda: path_length(to_coords(rail_list)),
+        ),
+        (
+            "densify every 50 km, 300 nodes",
+            lambda: scalar_densify(flight_list),
+            lambda: densify(to_coords(flight_list)).tolist(),
+        ),
+    ]
+    for name, scalar, vectorized in benchmarks:
+        number = 20
+        scalar_time = timeit.timeit(scalar, number=number) / number
+        vectorized_time = timeit.timeit(vectorized, number=number) / number
+        print(
+            f"{name}: {scalar_time * 1000:.2f} ms -> {vectorized_time * 1000:.2f} ms"
+            f" ({scalar_time / vectorized_time:.0f}x)"
+        )
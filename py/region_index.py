@@ -0,0 +1,301 @@
+"""
+Grid index over the regional railway polygons of country_percent/countries/processed
+
+Looking up which railway polygon of a region contains a point used to go through
+geopip for every point. Each region now gets a fixed grid index, built once and
+stored in country_percent/countries/index/<cc>/, a symlink to the directory of
+its last build:
+
+    meta.json           grid origin, cell size and shape, source file stamp, total
+                        area and the properties of each feature
+    cells.npy           int32 grid: -1 if no polygon touches the cell, k >= 0 if
+                        the cell is fully inside feature k, or -(r + 2) if the
+                        cell is ambiguous, r being its row in offsets.npy
+    offsets.npy         start of the candidates of each ambiguous cell
+    candidates.npy      feature indices of the polygons touching ambiguous cells
+    shapes.bin          WKB of each feature, concatenated
+    shape_offsets.npy   start of each feature in shapes.bin
+
+The arrays are memory-mapped, so a lookup is a cell read for most points and an
+exact point-in-polygon test against the few candidates of ambiguous cells.
+
+Build every index with `python -m py.region_index`, or a few of them with
+`python -m py.region_index AT-1 BE-BRU`. Missing or outdated indexes are also
+built on first use.
+"""
+
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import shapely
+
+SOURCE_DIR = "country_percent/countries/processed"
+INDEX_DIR = "country_percent/countries/index"
+# maximum number of cells along each axis of a grid
+GRID_SIZE = 512
+# bumped when the layout of the index changes, to rebuild the existing ones
+VERSION = 2
+
+_INSTANCE = {}
+
+
+def _source_path(cc):
+    return os.path.join(SOURCE_DIR, f"{cc}.geojson")
+
+
+def _source_stamp(cc):
+    stat = os.stat(_source_path(cc))
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def build_index(cc):
+    """
+    Build the grid index of a region from its processed geojson
+    """
+    with open(_source_path(cc), "r") as f:
+        geojson_data = json.load(f)
+    features = [
+        feature for feature in geojson_data["features"] if feature.get("geometry")
+    ]
+
+    geoms = np.array([shapely.geometry.shape(f["geometry"]) for f in features])
+    if len(geoms):
+        min_x, min_y, max_x, max_y = shapely.total_bounds(geoms)
+    else:
+        min_x = min_y = max_x = max_y = 0.0
+    cell_size = max(max_x - min_x, max_y - min_y, 1e-6) / GRID_SIZE
+    nx = int(np.floor((max_x - min_x) / cell_size)) + 1
+    ny = int(np.floor((max_y - min_y) / cell_size)) + 1
+
+    # all (feature, cell) pairs where the feature touches the cell
+    xs = min_x + np.arange(nx) * cell_size
+    ys = min_y + np.arange(ny) * cell_size
+    grid_x, grid_y = np.meshgrid(xs, ys)
+    boxes = shapely.box(
+        grid_x.ravel(),
+        grid_y.ravel(),
+        grid_x.ravel() + cell_size,
+        grid_y.ravel() + cell_size,
+    )
+    shapely.prepare(geoms)
+    feature_idx, cell_idx = shapely.STRtree(boxes).query(geoms, predicate="intersects")
+    covers = shapely.contains_properly(geoms[feature_idx], boxes[cell_idx])
+
+    order = np.lexsort((feature_idx, cell_idx))
+    feature_idx = feature_idx[order]
+    cell_idx = cell_idx[order]
+    covers = covers[order]
+
+    touching = np.bincount(cell_idx, minlength=len(boxes))
+    cells = np.full(len(boxes), -1, dtype=np.int32)
+    covered = np.bincount(
+        cell_idx, weights=covers.astype(np.float64), minlength=len(boxes)
+    )
+    # a cell touched by a single feature that contains it entirely needs no test
+    full = (touching == 1) & (covered > 0)
+    cells[cell_idx[full[cell_idx]]] = feature_idx[full[cell_idx]]
+
+    ambiguous_cells = np.flatnonzero((touching > 0) & ~full)
+    cells[ambiguous_cells] = -(np.arange(len(ambiguous_cells)) + 2)
+    in_ambiguous = np.isin(cell_idx, ambiguous_cells)
+    candidates = feature_idx[in_ambiguous].astype(np.int32)
+    offsets = np.concatenate(([0], np.cumsum(touching[ambiguous_cells]))).astype(
+        np.int64
+    )
+
+    wkbs = [shapely.to_wkb(geom) for geom in geoms]
+    shape_offsets = np.concatenate(([0], np.cumsum([len(w) for w in wkbs]))).astype(
+        np.int64
+    )
+    meta = {
+        "version": VERSION,
+        "source": _source_stamp(cc),
+        "total_area_m2": geojson_data.get("total_area_m2", 0),
+        "min_x": float(min_x),
+        "min_y": float(min_y),
+        "cell_size": float(cell_size),
+        "shape": [ny, nx],
+        "properties": [feature["properties"] for feature in features],
+    }
+
+    # each build is written to its own directory, then <cc> is pointed to it, so
+    # that readers never see a partial or missing index
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=f"{cc}.", dir=INDEX_DIR)
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    np.save(os.path.join(tmp_dir, "cells.npy"), cells.reshape(ny, nx))
+    np.save(os.path.join(tmp_dir, "offsets.npy"), offsets)
+    np.save(os.path.join(tmp_dir, "candidates.npy"), candidates)
+    np.save(os.path.join(tmp_dir, "shape_offsets.npy"), shape_offsets)
+    with open(os.path.join(tmp_dir, "shapes.bin"), "wb") as f:
+        f.write(b"".join(wkbs))
+
+    index_path = os.path.join(INDEX_DIR, cc)
+    link = f"{tmp_dir}.link"
+    os.symlink(os.path.basename(tmp_dir), link)
+    previous = None
+    if os.path.islink(index_path):
+        previous = os.path.realpath(index_path)
+    elif os.path.isdir(index_path):
+        # index built before the symlinks, moved aside as a link can't replace it
+        previous = tempfile.mkdtemp(prefix=f"{cc}.", dir=INDEX_DIR)
+        os.replace(index_path, previous)
+    os.replace(link, index_path)
+    if previous is not None:
+        shutil.rmtree(previous, ignore_errors=True)
+    _INSTANCE.pop(cc, None)
+
+
+class RegionIndex:
+    def __init__(self, cc):
+        # resolved once, so that all the files come from the same build
+        path = os.path.realpath(os.path.join(INDEX_DIR, cc))
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        self.version = meta.get("version")
+        self.source = meta["source"]
+        self.total_area = meta.get("total_area_m2", 0)
+        self.min_x = meta["min_x"]
+        self.min_y = meta["min_y"]
+        self.cell_size = meta["cell_size"]
+        self.properties = meta["properties"]
+        self.cells = np.load(os.path.join(path, "cells.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.candidates = np.load(os.path.join(path, "candidates.npy"), mmap_mode="r")
+        self.shape_offsets = np.load(
+            os.path.join(path, "shape_offsets.npy"), mmap_mode="r"
+        )
+        self.shapes_path = os.path.join(path, "shapes.bin")
+        self._geoms = None
+
+    @property
+    def geoms(self):
+        # only needed for ambiguous cells, so decoded on first use
+        if self._geoms is None:
+            with open(self.shapes_path, "rb") as f:
+                data = f.read()
+            self._geoms = shapely.from_wkb(
+                np.array(
+                    [
+                        data[start:end]
+                        for start, end in zip(
+                            self.shape_offsets[:-1], self.shape_offsets[1:]
+                        )
+                    ],
+                    dtype=object,
+                )
+            )
+            shapely.prepare(self._geoms)
+        return self._geoms
+
+    def lookup(self, coords):
+        """
+        Index of the feature containing each [lat, lng] of a (n, 2) array, -1 if
+        no feature contains it
+        """
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        result = np.full(len(coords), -1, dtype=np.int64)
+        ny, nx = self.cells.shape
+        ix = np.floor((coords[:, 1] - self.min_x) / self.cell_size).astype(np.int64)
+        iy = np.floor((coords[:, 0] - self.min_y) / self.cell_size).astype(np.int64)
+        inside = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+        values = np.full(len(coords), -1, dtype=np.int64)
+        values[inside] = self.cells[iy[inside], ix[inside]]
+
+        result[values >= 0] = values[values >= 0]
+
+        # exact tests against the candidates of the ambiguous cells
+        points = np.flatnonzero(values <= -2)
+        if len(points) == 0:
+            return result
+        rows = -values[points] - 2
+        starts = self.offsets[rows]
+        counts = self.offsets[rows + 1] - starts
+        pair_points = np.repeat(points, counts)
+        pair_candidates = self.candidates[
+            np.repeat(starts, counts)
+            + np.arange(counts.sum())
+            - np.repeat(np.cumsum(counts) - counts, counts)
+        ]
+        hits = shapely.contains_xy(
+            self.geoms[pair_candidates],
+            coords[pair_points, 1],
+            coords[pair_points, 0],
+        )
+        # keep the first candidate containing the point
+        best = np.full(len(coords), len(self.properties), dtype=np.int64)
+        np.minimum.at(best, pair_points[hits], pair_candidates[hits])
+        found = best < len(self.properties)
+        result[found] = best[found]
+        return result
+
+
+def _is_current(index, cc):
+    return (
+        index is not None
+        and index.version == VERSION
+        and index.source == _source_stamp(cc)
+    )
+
+
+def instance(cc):
+    """
+    RegionIndex of a region (lazy loading), built first if missing or outdated
+    """
+    index = _INSTANCE.get(cc)
+    if _is_current(index, cc):
+        return index
+
+    try:
+        index = RegionIndex(cc)
+    except FileNotFoundError:
+        index = None
+    if not _is_current(index, cc):
+        build_index(cc)
+        index = RegionIndex(cc)
+
+    _INSTANCE[cc] = index
+    return index
+
+
+def lookup_ids(cc, coords):
+    """
+    Set of the `id` properties of the features of a region that contain at
+    least one of the given [lat, lng]
+    """
+    index = instance(cc)
+    features = np.unique(index.lookup(coords))
+    return {index.properties[feature]["id"] for feature in features if feature >= 0}
+
+
+def traveled_percent(cc, ids):
+    """
+    Share of the railway area of a region covered by the features with the given
+    ids, rounded up to an integer percent like the region page shows it
+    """
+    index = instance(cc)
+    if not index.total_area:
+        return 0
+    traveled_area = sum(
+        properties.get("area_m2", 0)
+        for properties in index.properties
+        if str(properties.get("id")) in ids
+    )
+    return math.ceil(min((traveled_area / index.total_area) * 100, 100))
+
+
+if __name__ == "__main__":
+    ccs = sys.argv[1:] or sorted(
+        name[: -len(".geojson")]
+        for name in os.listdir(SOURCE_DIR)
+        if name.endswith(".geojson")
+    )
+    for cc in ccs:
+        print(f"Building index for {cc}...")
+        build_index(cc)
@@ -1,6 +1,9 @@
 # Load SQL queries as variables
 
 initPath = open("sql/initPath.sql", "r").read()
+initPathMeta = open("sql/initPathMeta.sql", "r").read()
+initPathLods = open("sql/initPathLods.sql", "r").read()
+saveMetaQuery = open("sql/saveMeta.sql", "r").read()
 saveQuery = open("sql/save.sql", "r").read()
 getTrip = open("sql/getTrip.sql", "r").read()
 getTripsCountry = open("sql/getTripsCountry.sql", "r").read()
@@ -9,6 +12,7 @@ updatePath = open("sql/updatePath.sql", "r").read()
 deleteTripQuery = open("sql/deleteTrip.sql", "r").read()
 deletePathQuery = open("sql/deletePath.sql", "r").read()
 getUserLines = open("sql/getUserLines.sql", "r").read()
+getUserLinesLod = open("sql/getUserLinesLod.sql", "r").read()
 getUserTrips = open("sql/getUserTrips.sql", "r").read()
 getUniqueUserTrips = open("sql/getUniqueUserTrips.sql", "r").read()
 getAllTrips = open("sql/getAllTrips.sql", "r").read()
@@ -17,54 +21,14 @@ statsOperatorTrips = (
     open("sql/stats/CTEs/tripsCTE.sql", "r").read()
     + open("sql/stats/operators.sql", "r").read()
 )
-newStatsOperatorTrips = (
+statsRows = (
     open("sql/stats/CTEs/tripsCTE.sql", "r").read()
-    + open("sql/stats/newOperators.sql", "r").read()
-)
-statsCountries = (
-    open("sql/stats/CTEs/tripsCTE.sql", "r").read()
-    + open("sql/stats/countries.sql", "r").read()
-)
-statsYearTrips = (
-    open("sql/stats/CTEs/tripsCTE.sql", "r").read()
-    + open("sql/stats/year.sql", "r").read()
-)
-statsRoutesTrips = (
-    open("sql/stats/CTEs/tripsCTE.sql", "r").read()
-    + open("sql/stats/routes.sql", "r").read()
-)
-statsStationsTrips = (
-    open("sql/stats/CTEs/tripsCTE.sql", "r").read()
-    + open("sql/stats/stations.sql", "r").read()
-)
-statsMaterialKm = (
-    open("sql/stats/CTEs/kmCTE.sql", "r").read()
-    + open("sql/stats/materialType.sql", "r").read()
-)
-statsMaterialTrips = (
-    open("sql/stats/CTEs/tripsCTE.sql", "r").read()
-    + open("sql/stats/materialType.sql", "r").read()
+    + open("sql/stats/statsRows.sql", "r").read()
 )
 statsOperatorKm = (
     open("sql/stats/CTEs/kmCTE.sql", "r").read()
     + open("sql/stats/operators.sql", "r").read()
 )
-newStatsOperatorKm = (
-    open("sql/stats/CTEs/kmCTE.sql", "r").read()
-    + open("sql/stats/newOperators.sql", "r").read()
-)
-statsYearKm = (
-    open("sql/stats/CTEs/kmCTE.sql", "r").read()
-    + open("sql/stats/year.sql", "r").read()
-)
-statsRoutesKm = (
-    open("sql/stats/CTEs/kmCTE.sql", "r").read()
-    + open("sql/stats/routes.sql", "r").read()
-)
-statsStationsKm = (
-    open("sql/stats/CTEs/kmCTE.sql", "r").read()
-    + open("sql/stats/stations.sql", "r").read()
-)
 adminStats = open("sql/stats/adminStats.sql", "r").read()
 leaderboardStats = open("sql/stats/leaderboardStats.sql", "r").read()
 typeAvailable = open("sql/stats/typeAvailable.sql", "r").read()
@@ -78,10 +42,19 @@ deleteUserTrips = open("sql/deleteUserTrips.sql", "r").read()
 publicStats = open("sql/stats/publicStats.sql", "r").read()
 getLeaderboardCountries = open("sql/stats/getLeaderboardCountries.sql", "r").read()
 upsertPercent = open("sql/upsertPercent.sql", "r").read()
+getRegionTrips = open("sql/getRegionTrips.sql", "r").read()
+getRegionSyncTrips = open("sql/getRegionSyncTrips.sql", "r").read()
 distinctStatYears = open("sql/stats/distinctStatYears.sql", "r").read()
+getStatsSnapshot = open("sql/stats/getStatsSnapshot.sql", "r").read()
+saveStatsSnapshot = open("sql/stats/saveStatsSnapshot.sql", "r").read()
+statsValidUntil = open("sql/stats/statsValidUntil.sql", "r").read()
 getTickets = open("sql/getTickets.sql", "r").read()
 getTags = open("sql/getTags.sql", "r").read()
-getTicket = open("sql/getTicket.sql", "r").read()
+getTicketsById = open("sql/getTicketsById.sql", "r").read()
 getDynamicUserTrips = open("sql/getDynamicUserTrips.sql", "r").read()
+getDynamicUserTripsPage = open("sql/getDynamicUserTripsPage.sql", "r").read()
+getTripCount = open("sql/getTripCount.sql", "r").read()
+saveTripCount = open("sql/saveTripCount.sql", "r").read()
+tripCountValidUntil = open("sql/tripCountValidUntil.sql", "r").read()
 getNumberStations = open("sql/getNumberStations.sql", "r").read()
 countriesLeaderboard = open("sql/stats/countriesLeaderboard.sql", "r").read()
@@ -25,94 +25,183 @@ def getPodiumizedStats(cursor, query, username, statName, tripType, year=None):
     return stats
 
 
-def getStatsCountries(cursor, query, username, km, tripType, year=None):
-    result = cursor.execute(
-        query, {"username": username, "tripType": tripType, "year": year}
-    ).fetchall()
-    countries = {}
-    for countryList in result:
-        countryDict = json.loads(countryList[0])
-        for country in countryDict:
-            if country not in countries.keys():
-                countries[country] = {}
-                countries[country]["total"] = 0
-                countries[country]["past"] = 0
-                countries[country]["plannedFuture"] = 0
-            if km:
-                countries[country]["total"] += countryDict[country]
-                if countryList["past"] != 0:
-                    countries[country]["past"] += countryDict[country]
-                elif countryList["plannedFuture"] != 0:
-                    countries[country]["plannedFuture"] += countryDict[country]
-
-            else:
-                countries[country]["total"] += (
-                    countryList["past"] + countryList["plannedFuture"]
-                )
-                if countryList["past"] != 0:
-                    countries[country]["past"] += countryList["past"]
-                elif countryList["plannedFuture"] != 0:
-                    countries[country]["plannedFuture"] += countryList["plannedFuture"]
-
-    countries = dict(
-        sorted(
-            countries.items(),
-            key=lambda item: countries[item[0]]["total"],
-            reverse=True,
-        )
-    )
-    countriesList = []
-    for country in countries:
-        countriesList.append(
-            {
-                "country": country,
-                "past": countries[country]["past"],
-                "plannedFuture": countries[country]["plannedFuture"],
-            }
+MEASURES = ("km", "trips")
+
+
+def _splitOperators(operator):
+    """
+    Split a comma separated operator list the way the former SplitOperators
+    recursive CTE did, including a NULL operator for trips without one
+    """
+    operators = []
+    rest = operator
+    if operator is None:
+        return [None]
+    while True:
+        if "," not in rest:
+            operators.append(rest.strip(" "))
+            return operators
+        head, _, rest = rest.partition(",")
+        operators.append((head or "," + rest).strip(" "))
+        rest = rest.strip(" ")
+        if rest == "":
+            return operators
+
+
+def _addCounts(groups, key, past, plannedFuture, future=0):
+    counts = groups.setdefault(key, [0, 0, 0])
+    counts[0] += past
+    counts[1] += plannedFuture
+    counts[2] += future
+
+
+def _ranked(groups, statName, countFuture=False, showFuture=False, limit=None):
+    """
+    Rows of a section ordered by count, without the empty keys which are still
+    counted in the limit, like the per section queries with a LIMIT did
+    """
+    ranked = sorted(
+        groups.items(),
+        key=lambda item: item[1][0] + item[1][1] + (item[1][2] if countFuture else 0),
+        reverse=True,
+    )[:limit]
+    stats = []
+    for key, (past, plannedFuture, future) in ranked:
+        if not key:
+            continue
+        stat = {statName: key, "past": past, "plannedFuture": plannedFuture}
+        if showFuture:
+            stat["future"] = future
+        stat["count"] = past + plannedFuture + (future if countFuture else 0)
+        stats.append(stat)
+    return stats
+
+
+def _countriesList(countries):
+    return [
+        {"country": country, "past": past, "plannedFuture": plannedFuture}
+        for country, (past, plannedFuture, total) in sorted(
+            countries.items(), key=lambda item: item[1][2], reverse=True
         )
-    return countriesList
+    ]
 
 
-def getStatsYears(cursor, query, username, lang, tripType, year=None):
+def _yearsList(yearGroups, future, lang):
+    """
+    One entry per year between the first and last year with trips, followed by
+    the trips without a date if there are any
+    """
     years = []
-    yearsTemp = {}
-    future = None
+    if yearGroups:
+        for year in range(min(yearGroups), max(yearGroups) + 1):
+            past, plannedFuture, yearFuture = yearGroups.get(year, (0, 0, 0))
+            years.append(
+                {
+                    "year": year,
+                    "past": int(past),
+                    "plannedFuture": int(plannedFuture),
+                    "future": int(yearFuture),
+                }
+            )
+    if future > 0:
+        years.append(
+            {"year": lang["future"], "past": 0, "plannedFuture": 0, "future": future}
+        )
+    return years or ""
+
+
+def getStats(cursor, query, username, lang, tripType, year=None):
+    """
+    Compute every section of the stats page, in km and in trips, from a single
+    read of the trips of the user. The trips are classified as past, planned or
+    future once by the query, then aggregated here in one pass.
+    """
     result = cursor.execute(
         query, {"username": username, "tripType": tripType, "year": year}
     ).fetchall()
 
-    if len(result) != 0:
-        for year in result:
-            if year["year"] != "future":
-                yearsTemp[int(year["year"])] = {
-                    "past": int(year["past"]),
-                    "plannedFuture": int(year["plannedFuture"]),
-                    "future": int(year["future"]),
-                }
-            else:
-                future = year
-                result.remove(year)
-        for year in range(int(result[0]["year"]), int(result[-1]["year"]) + 1):
-            if year in yearsTemp.keys():
-                years.append(
-                    {
-                        "year": year,
-                        "past": yearsTemp[year]["past"],
-                        "plannedFuture": yearsTemp[year]["plannedFuture"],
-                        "future": yearsTemp[year]["future"],
-                    }
-                )
-            else:
-                years.append({"year": year, "past": 0, "plannedFuture": 0, "future": 0})
-        if future:
-            years.append(
-                {
-                    "year": lang["future"],
-                    "past": 0,
-                    "plannedFuture": 0,
-                    "future": future["future"],
-                }
+    operators = {measure: {} for measure in MEASURES}
+    material = {measure: {} for measure in MEASURES}
+    countries = {measure: {} for measure in MEASURES}
+    years = {measure: {} for measure in MEASURES}
+    future = {measure: 0 for measure in MEASURES}
+    routes = {measure: {} for measure in MEASURES}
+    stations = {measure: {} for measure in MEASURES}
+
+    for trip in result:
+        length = trip["trip_length"] or 0
+        flags = (trip["past"], trip["plannedFuture"], trip["future"])
+        counts = {"trips": flags, "km": tuple(length * flag for flag in flags)}
+
+        if not trip["future"]:
+            for operator in _splitOperators(trip["operator"]):
+                for measure in MEASURES:
+                    _addCounts(operators[measure], operator, *counts[measure][:2])
+
+            if trip["material_type"]:
+                for measure in MEASURES:
+                    _addCounts(
+                        material[measure], trip["material"], *counts[measure][:2]
+                    )
+
+            if trip["countries"]:
+                tripCount = trip["past"] + trip["plannedFuture"]
+                for country, km in json.loads(trip["countries"]).items():
+                    for measure, value in (("km", km), ("trips", tripCount)):
+                        shares = countries[measure].setdefault(country, [0, 0, 0])
+                        shares[2] += value
+                        if trip["past"] != 0:
+                            shares[0] += value
+                        elif trip["plannedFuture"] != 0:
+                            shares[1] += value
+
+        startYear = trip["start_year"]
+        if startYear and "1950" < startYear < "2100":
+            for measure in MEASURES:
+                _addCounts(years[measure], int(startYear), *counts[measure])
+        if trip["undated"]:
+            for measure in MEASURES:
+                future[measure] += counts[measure][2]
+
+        origin, destination = trip["origin_station"], trip["destination_station"]
+        # same text as json_array(MIN(...), MAX(...)) in SQLite, which is [null,null]
+        # when a station is missing
+        route = json.dumps(
+            [None, None]
+            if origin is None or destination is None
+            else [min(origin, destination), max(origin, destination)],
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+        for measure in MEASURES:
+            _addCounts(routes[measure], route, *counts[measure])
+            for station in {origin, destination}:
+                _addCounts(stations[measure], station, *counts[measure])
+
+    return {
+        "newOperators": {
+            measure: _ranked(operators[measure], "operator")
+            for measure in MEASURES
+        },
+        "material": {
+            measure: _ranked(material[measure], "material")
+            for measure in MEASURES
+        },
+        "countries": {
+            measure: _countriesList(countries[measure]) for measure in MEASURES
+        },
+        "years": {
+            measure: _yearsList(years[measure], future[measure], lang)
+            for measure in MEASURES
+        },
+        "newRoutes": {
+            measure: _ranked(
+                routes[measure], "route", countFuture=True, showFuture=True, limit=10
             )
-        return years
-    else:
-        return ""
+            for measure in MEASURES
+        },
+        "newStations": {
+            measure: _ranked(stations[measure], "station", countFuture=True, limit=10)
+            for measure in MEASURES
+        },
+    }
@@ -1,95 +1,104 @@
 import csv
 import io
+import logging
 import sqlite3
 import zipfile
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 
 import requests
 
+from py.currency import reload_exchange_rates
+
+logger = logging.getLogger(__name__)
+
+HISTORY_URL = "https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist.zip"
+DAILY_URL = "https://www.ecb.europa.eu/stats/eurofxref/eurofxref.zip"
+
+# Days without published rates (weekends, bank holidays) reuse the rates of the
+# day before, or of two days before
+MAX_FALLBACK_DAYS = 2
+
+SELECTED_CURRENCIES = [
+    "AUD",
+    "BGN",
+    "BRL",
+    "CAD",
+    "CHF",
+    "CNY",
+    "CZK",
+    "DKK",
+    "GBP",
+    "HKD",
+    "HUF",
+    "IDR",
+    "ILS",
+    "INR",
+    "ISK",
+    "JPY",
+    "KRW",
+    "MXN",
+    "MYR",
+    "NOK",
+    "NZD",
+    "PHP",
+    "PLN",
+    "RON",
+    "SEK",
+    "SGD",
+    "THB",
+    "TRY",
+    "USD",
+    "ZAR",
+]
 
-def fill_missing_rates(db_path, table_name):
-    # Connect to the SQLite database
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    # Identify columns with NULL values
-    cursor.execute(f"PRAGMA table_info({table_name})")
-    columns = [info[1] for info in cursor.fetchall()]
-
-    for col in columns:
-        # Fill NULL values where a previous value exists
-        update_query_with_previous = f"""
-        UPDATE {table_name}
-        SET {col} = (
-            SELECT {col}
-            FROM (
-                SELECT {col}, ROWID
-                FROM {table_name}
-                WHERE {col} IS NOT NULL
-            ) AS valid_values
-            WHERE valid_values.ROWID < {table_name}.ROWID
-            ORDER BY valid_values.ROWID DESC
-            LIMIT 1
-        )
-        WHERE {col} IS NULL AND EXISTS (
-            SELECT 1
-            FROM {table_name} as prev
-            WHERE prev.{col} IS NOT NULL AND prev.ROWID < {table_name}.ROWID
-        );
-        """
-        cursor.execute(update_query_with_previous)
-
-        # Fill remaining NULL values using the oldest non-null value if no previous values exist
-        update_query_with_oldest = f"""
-        UPDATE {table_name}
-        SET {col} = (
-            SELECT {col} FROM {table_name} WHERE {col} IS NOT NULL ORDER BY ROWID ASC LIMIT 1
-        )
-        WHERE {col} IS NULL;
-        """
-        cursor.execute(update_query_with_oldest)
 
-    # Commit changes and close the connection
-    conn.commit()
-    conn.close()
-
-
-def get_complete_days(db_path):
+def fill_missing_rates(db_path, table_name):
     """
-    Fetches a list of dates from the exchanges table where the
-    number of records for each date equals 342.
+    Replace the NULL rates of the table by the previous known rate of the same
+    currency, or by its oldest known rate if there is none before.
 
-    Parameters:
-    - db_path (str): The path to the SQLite database file.
-
-    Returns:
-    - complete_days (list of str): A list of dates (as strings) matching the criteria.
+    The table is read once in date order and the changed rows are written back in
+    a single transaction, instead of two correlated UPDATEs per column.
     """
-    # Connect to the SQLite database
-    connection = sqlite3.connect(db_path)
-    cursor = connection.cursor()
-
-    # SQL query to select rate dates having exactly 342 records
-    query = """
-        SELECT DISTINCT(rate_date)
-        FROM exchanges
-        ORDER BY rate_date DESC
-    """
-
-    # Execute the query
-    cursor.execute(query)
-
-    # Fetch all results
-    results = cursor.fetchall()
-
-    # Close the connection to the database
-    connection.close()
-
-    # Extract dates from the results
-    # Each item in results is a tuple, where the first element is the rate_date
-    complete_days = [result[0] for result in results]
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
 
-    return complete_days
+    rows = cursor.execute(f"SELECT * FROM {table_name} ORDER BY rate_date").fetchall()
+    columns = [description[0] for description in cursor.description][1:]
+
+    last_values = [None] * len(columns)
+    first_values = [None] * len(columns)
+    for row in rows:
+        for index, value in enumerate(row[1:]):
+            if value is not None and first_values[index] is None:
+                first_values[index] = value
+
+    updates = []
+    for row in rows:
+        values = list(row[1:])
+        for index, value in enumerate(values):
+            if value is None:
+                values[index] = (
+                    last_values[index]
+                    if last_values[index] is not None
+                    else first_values[index]
+                )
+            else:
+                last_values[index] = value
+        if values != list(row[1:]):
+            updates.append(values + [row[0]])
+
+    if updates:
+        with conn:
+            cursor.executemany(
+                f"""
+                UPDATE {table_name}
+                SET {", ".join(f"{column} = ?" for column in columns)}
+                WHERE rate_date = ?
+                """,
+                updates,
+            )
+    conn.close()
 
 
 def download_and_unzip(url):
@@ -100,7 +109,7 @@ def download_and_unzip(url):
     - url (str): The URL of the ZIP file to download.
 
     Returns:
-    - file_contents (dict): A dictionary with file names as keys and their contents as values.
+    - file_content (str): The content of the first file of the ZIP.
     """
     # Send a GET request to the URL
     response = requests.get(url)
@@ -128,126 +137,183 @@ def download_and_unzip(url):
         )
 
 
-# Function to generate a complete list of dates between two dates
-def generate_date_series(start_date_str, end_date_str):
-    start_date = datetime.strptime(start_date_str, "%Y-%m-%d").date()
-    end_date = datetime.strptime(end_date_str, "%Y-%m-%d").date()
+def _parse_ecb_date(value):
+    # eurofxref-hist.csv uses 2025-10-17, eurofxref.csv uses 17 October 2025
+    for date_format in ("%Y-%m-%d", "%d %B %Y"):
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            pass
+    raise ValueError(f"Unknown ECB date format: {value!r}")
+
 
-    current_date = start_date
-    while current_date <= end_date:
-        yield current_date
-        current_date += timedelta(days=1)
+def _parse_rate(value):
+    value = (value or "").strip()
+    if value in ("", "N/A"):
+        return None
+    return float(value)
 
 
-def get_rates_from_bottom_in_memory(csv_content, selected_currencies):
+def read_ecb_rates(csv_content, selected_currencies):
     """
-    Parses CSV content from a string and gets exchange rates for specific currencies
-    from bottom to top.
+    Parses an ECB reference rates CSV file, either the full history or the rates
+    of the last day.
 
     Parameters:
     - csv_content (str): The content of the CSV file as a string.
     - selected_currencies (list): A list of currency codes to retrieve rates for.
 
     Returns:
-    - all_rates (dict): A dictionary with dates as keys and another dictionary of currencies
-      and their rates as values.
-    - all_rates_dates (list): A list of dates for which rates are available.
+    - rates (list of tuple): (date, {currency: rate or None}) tuples, oldest first.
+    """
+    reader = csv.reader(io.StringIO(csv_content))
+    header = [column.strip() for column in next(reader)]
+    indexes = {currency: header.index(currency) for currency in selected_currencies}
+
+    rates = []
+    for row in reader:
+        if not row or not row[0].strip():
+            continue
+        rates.append(
+            (
+                _parse_ecb_date(row[0].strip()),
+                {
+                    currency: _parse_rate(row[index]) if index < len(row) else None
+                    for currency, index in indexes.items()
+                },
+            )
+        )
+    rates.sort(key=lambda dated_rates: dated_rates[0])
+    return rates
+
+
+def forward_fill_rates(dated_rates, selected_currencies, last_rates=None):
     """
-    all_rates_dates = []
-    all_rates = {}
-    file_like_object = io.StringIO(csv_content)
-    csv_reader = list(csv.DictReader(file_like_object))
-    for row in reversed(csv_reader):
-        rates = {}
+    Yields one row of rates per calendar day covered by the published rates.
+
+    Days without published rates take the rates of the last published day, if it
+    is at most MAX_FALLBACK_DAYS before, and are skipped otherwise. Currencies
+    without a rate on a published day keep their last known rate.
+
+    Parameters:
+    - dated_rates (iterable): (date, {currency: rate or None}) tuples, oldest first.
+    - selected_currencies (list): The currency columns of the rows.
+    - last_rates (dict): The last known rate of each currency, if any.
+
+    Yields:
+    - row (list): The date as a YYYY-MM-DD string followed by the rates.
+    """
+    last_rates = dict(last_rates or {})
+    previous_date = None
+    previous_values = None
+    for rate_date, rates in dated_rates:
+        if previous_date is not None:
+            gap_date = previous_date + timedelta(days=1)
+            while gap_date < rate_date:
+                if (gap_date - previous_date).days <= MAX_FALLBACK_DAYS:
+                    yield [gap_date.isoformat()] + previous_values
+                gap_date += timedelta(days=1)
+
         for currency in selected_currencies:
-            rates[currency] = float(row[currency]) if row[currency] != "N/A" else None
-        all_rates_dates.append(row["Date"])
-        all_rates[row["Date"]] = rates
-    return all_rates, all_rates_dates
+            if rates.get(currency) is not None:
+                last_rates[currency] = rates[currency]
+        previous_date = rate_date
+        previous_values = [last_rates.get(currency) for currency in selected_currencies]
+        yield [rate_date.isoformat()] + previous_values
 
 
-def process_currency_combinations_daily(db_path, all_rates, all_rates_dates):
-    connection = sqlite3.connect(db_path)
-    cursor = connection.cursor()
-
-    time_series = generate_date_series(all_rates_dates[0], all_rates_dates[-1])
-    complete_days = get_complete_days(db_path)
-    filtered_time_series = [
-        date
-        for date in time_series
-        if datetime.strftime(date, "%Y-%m-%d") not in complete_days
-    ]
-
-    for date in filtered_time_series:
-        rate_date = datetime.strftime(date, "%Y-%m-%d")
-
-        # Determine which date to use for rates based on availability
-        if rate_date in all_rates:
-            use_date = rate_date
-        elif datetime.strftime(date + timedelta(days=-1), "%Y-%m-%d") in all_rates:
-            use_date = datetime.strftime(date + timedelta(days=-1), "%Y-%m-%d")
-        elif datetime.strftime(date + timedelta(days=-2), "%Y-%m-%d") in all_rates:
-            use_date = datetime.strftime(date + timedelta(days=-2), "%Y-%m-%d")
-        else:
-            continue  # Skip this date if no rates are available
-
-        rates = all_rates[use_date]
-        columns = ", ".join(rates.keys())  # Get all currency column names from rates
-        placeholders = ", ".join(["?" for _ in rates])  # Create placeholders for values
-        values = [rates[currency] for currency in rates]  # Get all currency values
-        query = f"INSERT OR IGNORE INTO exchanges (rate_date, {columns}) VALUES (?, {placeholders})"
-        cursor.execute(query, [rate_date] + values)
-        connection.commit()
-    fill_missing_rates(db_path, "exchanges")
+def _last_stored_rates(cursor, selected_currencies):
+    row = cursor.execute(
+        f"""
+        SELECT rate_date, {", ".join(selected_currencies)}
+        FROM exchanges
+        ORDER BY rate_date DESC
+        LIMIT 1
+        """
+    ).fetchone()
+    if row is None:
+        return None, {}
+    return date.fromisoformat(row[0]), dict(zip(selected_currencies, row[1:]))
 
-    last_registered_date = cursor.execute(
+
+def store_rates(db_path, dated_rates, selected_currencies, last_rates=None):
+    """
+    Inserts the forward filled rates of the days not stored yet, in a single
+    transaction, and returns the last stored date.
+    """
+    connection = sqlite3.connect(db_path)
+    with connection:
+        connection.executemany(
+            f"""
+            INSERT OR IGNORE INTO exchanges (rate_date, {", ".join(selected_currencies)})
+            VALUES (?, {", ".join("?" for _ in selected_currencies)})
+            """,
+            forward_fill_rates(dated_rates, selected_currencies, last_rates),
+        )
+    last_registered_date = connection.execute(
         "SELECT rate_date FROM exchanges ORDER BY rate_date DESC LIMIT 1;"
     ).fetchone()[0]
     connection.close()
     return last_registered_date
 
 
-def run_currency_update():
+def _update_from_history(db_path, selected_currencies):
+    dated_rates = read_ecb_rates(download_and_unzip(HISTORY_URL), selected_currencies)
+    last_registered_date = store_rates(db_path, dated_rates, selected_currencies)
+    fill_missing_rates(db_path, "exchanges")
+    return last_registered_date
+
+
+def _update_from_daily(db_path, selected_currencies):
+    """
+    Adds the rates of the last published day, continuing from the last stored
+    day. Returns None when they do not follow the stored rates closely enough to
+    fill the days in between, so that the full history is needed.
+    """
+    connection = sqlite3.connect(db_path)
+    last_date, last_rates = _last_stored_rates(
+        connection.cursor(), selected_currencies
+    )
+    connection.close()
+    if last_date is None:
+        return None
+
+    dated_rates = read_ecb_rates(download_and_unzip(DAILY_URL), selected_currencies)
+    if not dated_rates:
+        return None
+    if (dated_rates[0][0] - last_date).days > MAX_FALLBACK_DAYS + 1:
+        logger.info(
+            f"Last stored rates from {last_date} are too old for the daily rates "
+            f"of {dated_rates[0][0]}, downloading the full history"
+        )
+        return None
+
+    # The stored day starts the fill, so that the days in between reuse its rates.
+    # It is already stored and ignored by the insert.
+    return store_rates(
+        db_path,
+        [(last_date, last_rates)] + dated_rates,
+        selected_currencies,
+        last_rates,
+    )
+
+
+def run_currency_update(incremental=False):
+    """
+    Updates the exchanges table from the ECB reference rates, and reloads the
+    in-memory rates.
+
+    With incremental, only the rates of the last published day are downloaded,
+    unless the table is empty or too far behind, in which case the full history
+    is used like without it.
+    """
     # Database path
     db_path = "databases/main.db"
 
-    # List of selected currencies
-    selected_currencies = [
-        "AUD",
-        "BGN",
-        "BRL",
-        "CAD",
-        "CHF",
-        "CNY",
-        "CZK",
-        "DKK",
-        "GBP",
-        "HKD",
-        "HUF",
-        "IDR",
-        "ILS",
-        "INR",
-        "ISK",
-        "JPY",
-        "KRW",
-        "MXN",
-        "MYR",
-        "NOK",
-        "NZD",
-        "PHP",
-        "PLN",
-        "RON",
-        "SEK",
-        "SGD",
-        "THB",
-        "TRY",
-        "USD",
-        "ZAR",
-    ]
-
-    url = "https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist.zip"
-    unzipped_file = download_and_unzip(url)
-    all_rates, all_rates_dates = get_rates_from_bottom_in_memory(
-        unzipped_file, selected_currencies
-    )
-    return process_currency_combinations_daily(db_path, all_rates, all_rates_dates)
+    last_registered_date = None
+    if incremental:
+        last_registered_date = _update_from_daily(db_path, SELECTED_CURRENCIES)
+    if last_registered_date is None:
+        last_registered_date = _update_from_history(db_path, SELECTED_CURRENCIES)
+    reload_exchange_rates()
+    return last_registered_date
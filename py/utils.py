@@ -1,16 +1,15 @@
 import imghdr
 import json
-import math
 import os
 import time
 import unicodedata
 from urllib.request import urlopen
 
+import numpy as np
 import pycountry
 import yaml
-from geopy.distance import geodesic
 
-from py import geopip_perso
+from py import country_engine, geo_kernels
 
 
 def remove_accents(input_str):
@@ -49,7 +48,7 @@ def stringSimmilarity(a, b):
 
 
 def getCountryFromCoordinates(lat, lng):
-    country = geopip_perso.search(lat=lat, lng=lng)
+    country = country_engine.instance().search(lat=lat, lng=lng)
     if not country:
         country = {"countryCode": "UN"}
     return country
@@ -193,76 +192,26 @@ def validate_png_file(file):
 
 
 def getDistance(orig, dest):
-    R = 6373000.0
-    lat1 = math.radians(orig["lat"])
-    lon1 = math.radians(orig["lng"])
-    lat2 = math.radians(dest["lat"])
-    lon2 = math.radians(dest["lng"])
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = (
-        math.sin(dlat / 2) ** 2
-        + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
+    return float(
+        geo_kernels.haversine(orig["lat"], orig["lng"], dest["lat"], dest["lng"])
     )
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    distance = R * c
-    return distance
 
 
 def getCountriesFromPath(path, type):
-    countries = {}
-    country = None
+    engine = country_engine.instance()
+    coords = geo_kernels.to_coords(path)
 
     if type in ["air", "helicopter"]:
-        total_distance = 0
-        for index in range(1, len(path)):
-            total_distance += getDistance(path[index - 1], path[index])
-
-        start_country_data = getCountryFromCoordinates(
-            lat=path[0]["lat"], lng=path[0]["lng"]
-        )
-        end_country_data = getCountryFromCoordinates(
-            lat=path[-1]["lat"], lng=path[-1]["lng"]
-        )
-
-        start_country = (
-            start_country_data["countryCode"] if start_country_data else "UN"
-        )
-        end_country = end_country_data["countryCode"] if end_country_data else "UN"
+        total_distance = geo_kernels.path_length(coords)
+        start_country, end_country = engine.codes[engine.lookup(coords[[0, -1]])]
 
+        countries = {}
         countries[start_country] = total_distance / 2
         countries[end_country] = countries.get(end_country, 0) + total_distance / 2
 
         return json.dumps(countries)
 
-    for index in range(1, len(path)):
-        segment_distance = getDistance(path[index - 1], path[index])
-
-        if type == "ferry" and segment_distance > 10:
-            num_fake_points = int(segment_distance / 10)
-            interpolated_points = interpolate_points(
-                path[index - 1], path[index], num_fake_points
-            )
-        else:
-            interpolated_points = [path[index]]
-
-        segment_countries = {}
-        for node in interpolated_points:
-            precountry = getCountryFromCoordinates(lat=node["lat"], lng=node["lng"])
-            if precountry is not None:
-                country = precountry["countryCode"]
-            else:
-                if type == "ferry":
-                    country = "UN"
-                else:
-                    if country is None:
-                        country = "UN"
-            segment_countries[country] = segment_countries.get(country, 0) + 1
-
-        for country, count in segment_countries.items():
-            if country not in countries:
-                countries[country] = 0
-            countries[country] += (segment_distance * count) / len(interpolated_points)
+    countries = engine.country_shares(coords, ferry=type == "ferry")
 
     if countries == {}:
         country = getCountryFromCoordinates(lat=path[0]["lat"], lng=path[0]["lng"])[
@@ -274,87 +223,14 @@ def getCountriesFromPath(path, type):
 
 
 def getDistanceFromPath(path):
-    distances = path.copy()
-    for index, node in enumerate(path):
-        if index == 0:
-            distances[index] = 0
-        else:
-            previousDistance = distances[index - 1]
-            previousNode = {"lat": path[index - 1][0], "lng": path[index - 1][1]}
-            currentNode = {"lat": path[index][0], "lng": path[index][1]}
-            currentDistance = previousDistance + int(
-                getDistance(previousNode, currentNode)
-            )
-            distances[index] = currentDistance
-    return distances
-
-
-def interpolate_points(point1, point2, num_points):
-    """Interpolate num_points between point1 and point2."""
-    lat_diff = point2["lat"] - point1["lat"]
-    lng_diff = point2["lng"] - point1["lng"]
-
-    interpolated = []
-    for i in range(1, num_points + 1):
-        fraction = i / (num_points + 1)
-        interpolated.append(
-            {
-                "lat": point1["lat"] + fraction * lat_diff,
-                "lng": point1["lng"] + fraction * lng_diff,
-            }
-        )
-    return interpolated
-
-
-def to_radians(deg):
-    return deg * math.pi / 180
-
-
-def to_degrees(rad):
-    return rad * 180 / math.pi
-
-
-def interpolate_great_circle(start, end, max_distance_km=50):
-    """Interpolates (lat, lon) points along the great-circle path using spherical interpolation."""
-    distance_km = geodesic(start, end).km
-    num_steps = int(distance_km // max_distance_km)
-
-    if num_steps < 1:
-        return []
-
-    lat1, lon1 = map(to_radians, start)
-    lat2, lon2 = map(to_radians, end)
-
-    delta_lon = lon2 - lon1
-
-    # Compute angular distance between points
-    d = 2 * math.asin(
-        math.sqrt(
-            math.sin((lat2 - lat1) / 2) ** 2
-            + math.cos(lat1) * math.cos(lat2) * math.sin(delta_lon / 2) ** 2
-        )
-    )
-
-    if d == 0:
+    """
+    Distance in meters from the start of the path to each of its nodes, each
+    segment being truncated to the meter
+    """
+    if len(path) == 0:
         return []
-
-    points = []
-
-    for i in range(1, num_steps + 1):
-        f = i / (num_steps + 1)
-        A = math.sin((1 - f) * d) / math.sin(d)
-        B = math.sin(f * d) / math.sin(d)
-
-        x = A * math.cos(lat1) * math.cos(lon1) + B * math.cos(lat2) * math.cos(lon2)
-        y = A * math.cos(lat1) * math.sin(lon1) + B * math.cos(lat2) * math.sin(lon2)
-        z = A * math.sin(lat1) + B * math.sin(lat2)
-
-        interp_lat = math.atan2(z, math.sqrt(x**2 + y**2))
-        interp_lon = math.atan2(y, x)
-
-        points.append((to_degrees(interp_lat), to_degrees(interp_lon)))
-
-    return points
+    lengths = geo_kernels.segment_lengths(geo_kernels.to_coords(path))
+    return [0] + np.cumsum(lengths.astype(np.int64)).tolist()
 
 
 def interpolate_points_if_gaps(points, max_distance_km=50):
@@ -362,23 +238,6 @@ def interpolate_points_if_gaps(points, max_distance_km=50):
     if not points or len(points) < 2:
         return points
 
-    print(len(points))
-
-    interpolated = [points[0]]
-
-    for i in range(1, len(points)):
-        prev = points[i - 1]
-        curr = points[i]
-        distance = geodesic(prev, curr).km
-
-        if distance > max_distance_km:
-            # Add intermediate points
-            intermediate = interpolate_great_circle(
-                prev, curr, max_distance_km=max_distance_km
-            )
-            interpolated.extend(intermediate)
-
-        interpolated.append(curr)
-    print(len(interpolated))
-
-    return interpolated
+    return geo_kernels.densify(
+        geo_kernels.to_coords(points), max_distance_km=max_distance_km
+    ).tolist()
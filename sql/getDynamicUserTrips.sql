@@ -3,6 +3,7 @@ WITH UTC_Filtered AS (
         COALESCE(utc_start_datetime, start_datetime) AS utc_filtered_start_datetime,
         COALESCE(utc_end_datetime, end_datetime) AS utc_filtered_end_datetime
     FROM trip
+    WHERE username = :username
 ),
 Subquery AS (
     SELECT 
@@ -14,17 +15,9 @@ Subquery AS (
             THEN (julianday(utc_filtered_end_datetime) - julianday(utc_filtered_start_datetime)) * 86400
             ELSE COALESCE(manual_trip_duration, estimated_trip_duration)
         END AS trip_duration_seconds,
-        o.short_name AS operator_name,
         time(start_datetime) AS start_time,
-        time(end_datetime) AS end_time,
-        (SELECT l.logo_url
-         FROM operator_logos l
-         WHERE l.operator_id = o.uid
-           AND (l.effective_date <= t.utc_filtered_start_datetime OR l.effective_date IS NULL OR t.utc_filtered_start_datetime IN (1, -1))
-         ORDER BY l.effective_date DESC
-         LIMIT 1) AS logo_url
+        time(end_datetime) AS end_time
     FROM UTC_Filtered t
-    LEFT JOIN operators o ON o.short_name = TRIM(SUBSTR(t.operator, 1, INSTR(t.operator || ',', ',') - 1))
 ),
 FilteredTrips AS (
     SELECT Subquery.*, airliners.*,
@@ -54,21 +47,17 @@ FilteredTrips AS (
     WHERE Subquery.username = :username
       AND past = :past
       AND (
-          remove_diacritics(LOWER(origin_station)) LIKE remove_diacritics(LOWER(:search)) OR
-          remove_diacritics(LOWER(destination_station)) LIKE remove_diacritics(LOWER(:search)) OR
-          remove_diacritics(LOWER(operator)) LIKE remove_diacritics(LOWER(:search)) OR
-          remove_diacritics(LOWER(countries)) LIKE remove_diacritics(LOWER(:search)) OR
-          remove_diacritics(LOWER(line_name)) LIKE remove_diacritics(LOWER(:search)) OR
-          remove_diacritics(LOWER(start_datetime)) LIKE remove_diacritics(LOWER(:search)) OR
-          remove_diacritics(LOWER(end_datetime)) LIKE remove_diacritics(LOWER(:search)) OR
-          remove_diacritics(LOWER(Subquery.type)) LIKE remove_diacritics(LOWER(:search)) OR
-          remove_diacritics(LOWER(Subquery.notes)) LIKE remove_diacritics(LOWER(:search)) OR
-          remove_diacritics(LOWER(Subquery.reg)) LIKE remove_diacritics(LOWER(:search)) OR
-          remove_diacritics(LOWER(material_type)) LIKE remove_diacritics(LOWER(:search)) OR 
-          remove_diacritics(LOWER(airliners.iata)) LIKE remove_diacritics(LOWER(:search)) OR 
-          remove_diacritics(LOWER(airliners.manufacturer)) LIKE remove_diacritics(LOWER(:search)) OR 
-          remove_diacritics(LOWER(airliners.model)) LIKE remove_diacritics(LOWER(:search)) OR 
-          remove_diacritics(LOWER(tags.name)) LIKE remove_diacritics(LOWER(:search))
+          :search IS NULL
+          -- trigram index for 3 characters or more, see src/trip_search.py
+          OR (:search_indexed = 1 AND Subquery.uid IN (
+              SELECT rowid FROM trip_search
+              WHERE text LIKE :search AND username = :username
+          ))
+          -- otherwise only the texts of the trips of the user, by rowid
+          OR (:search_indexed = 0 AND EXISTS (
+              SELECT 1 FROM trip_search
+              WHERE trip_search.rowid = Subquery.uid AND text LIKE :search
+          ))
       )
     GROUP BY Subquery.uid
 )
\ No newline at end of file
@@ -0,0 +1,23 @@
+,
+Page AS (
+    SELECT * FROM FilteredTrips
+    WHERE {filters}
+    ORDER BY {order}
+    LIMIT :limit {offset}
+),
+-- operators and logos are only looked up for the trips of the page
+PageOperators AS (
+    SELECT Page.*, o.uid AS operator_uid, o.short_name AS operator_name
+    FROM Page
+    LEFT JOIN operators o ON o.short_name = TRIM(SUBSTR(Page.operator, 1, INSTR(Page.operator || ',', ',') - 1))
+)
+SELECT
+    PageOperators.*,
+    (SELECT l.logo_url
+     FROM operator_logos l
+     WHERE l.operator_id = PageOperators.operator_uid
+       AND (l.effective_date <= PageOperators.utc_filtered_start_datetime OR l.effective_date IS NULL OR PageOperators.utc_filtered_start_datetime IN (1, -1))
+     ORDER BY l.effective_date DESC
+     LIMIT 1) AS logo_url
+FROM PageOperators
+ORDER BY {order}
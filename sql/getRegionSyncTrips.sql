@@ -0,0 +1,28 @@
+WITH UTC_Filtered AS (
+    SELECT trip.uid, trip.type, region_trips.trip_id, region_trips.counted,
+    region_trips.regions_version,
+    CASE
+        WHEN utc_start_datetime IS NOT NULL
+        THEN utc_start_datetime
+        ELSE start_datetime
+    END AS 'utc_filtered_start_datetime'
+    FROM trip
+    LEFT JOIN region_trips ON region_trips.trip_id = trip.uid
+    WHERE trip.username = :username
+    AND (
+        region_trips.trip_id IS NULL
+        OR region_trips.counted = 0
+        OR region_trips.regions_version IS NOT :regions_version
+    )
+)
+
+SELECT uid,
+trip_id IS NULL OR regions_version IS NOT :regions_version AS 'outdated'
+FROM UTC_Filtered
+WHERE trip_id IS NULL
+OR regions_version IS NOT :regions_version
+OR (
+    type IN ('train', 'tram', 'metro')
+    AND utc_filtered_start_datetime != 1
+    AND NOT COALESCE(julianday('now') <= julianday(utc_filtered_start_datetime), 0)
+)
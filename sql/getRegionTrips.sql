@@ -0,0 +1,20 @@
+WITH UTC_Filtered AS (
+    SELECT uid, username, type, countries,
+    CASE
+        WHEN utc_start_datetime IS NOT NULL
+        THEN utc_start_datetime
+        ELSE start_datetime
+    END AS 'utc_filtered_start_datetime'
+    FROM trip
+    WHERE uid IN ({trip_ids})
+)
+
+SELECT uid, username, type, countries,
+CASE
+    WHEN type IN ('train', 'tram', 'metro')
+    AND utc_filtered_start_datetime != 1
+    AND NOT COALESCE(julianday('now') <= julianday(utc_filtered_start_datetime), 0)
+    THEN 1
+    ELSE 0
+END AS 'counted'
+FROM UTC_Filtered
@@ -0,0 +1,6 @@
+SELECT count
+FROM trip_counts
+WHERE username = :username
+AND past = :past
+AND filter_types = :filter_types
+AND (valid_until IS NULL OR julianday('now') <= julianday(valid_until))
@@ -9,6 +9,7 @@ WITH UTC_Filtered AS (
         ELSE end_datetime 
     END AS utc_filtered_end_datetime
     FROM trip
+    WHERE username = :username
 ),
 YearlyFiltered AS (
     SELECT *,
@@ -42,13 +43,27 @@ SELECT *,
            THEN 1
            ELSE 0 
        END AS future,
-       count(*) AS count
+       count(*) AS count,
+       -- the only min() makes the other columns those of the smallest uid
+       min(uid) AS first_uid,
+       group_concat(uid) AS group_uids
 FROM YearlyFiltered 
 WHERE username = :username
-  AND (:lastLocal = 'all' OR julianday(last_modified) > julianday(:lastLocal))
+  -- trips crossing a tile, see src/trip_tiles.py
+  AND (:min_lat IS NULL OR uid IN (
+      SELECT trip_id FROM trip_tile_bounds
+      WHERE username = :username
+        AND max_lat >= :min_lat AND min_lat <= :max_lat
+        AND max_lng >= :min_lng AND min_lng <= :max_lng
+  ))
   AND (
       :public = 0 
       OR type IN ('train', 'air', 'bus', 'ferry', 'aerialway', 'tram', 'metro')
   )
 GROUP BY origin_station, destination_station, trip_length, trip_year, past, current, plannedFuture, future
+-- groups are made over all the trips, then only those with a changed trip kept
+HAVING :since IS NULL OR sum(uid IN (
+      SELECT trip_id FROM trip_revisions
+      WHERE username = :username AND revision > :since
+  )) > 0
 ORDER BY start_datetime = 1 DESC, start_datetime DESC;
\ No newline at end of file
@@ -0,0 +1,11 @@
+SELECT trip_id, COALESCE(
+    (
+        SELECT path_lods.path FROM path_lods
+        WHERE path_lods.trip_id = paths.trip_id AND path_lods.lod <= ?
+        ORDER BY path_lods.lod DESC
+        LIMIT 1
+    ),
+    path
+) AS path
+FROM paths
+WHERE trip_id IN ({trip_ids})
@@ -0,0 +1,6 @@
+CREATE TABLE IF NOT EXISTS path_lods (
+        trip_id INTEGER NOT NULL,
+        lod INTEGER NOT NULL,
+        path BLOB NOT NULL,
+        PRIMARY KEY (trip_id, lod)
+    )
@@ -0,0 +1,15 @@
+CREATE TABLE IF NOT EXISTS path_meta (
+        trip_id INTEGER NOT NULL,
+        point_count INTEGER NOT NULL,
+        min_lat FLOAT,
+        min_lng FLOAT,
+        max_lat FLOAT,
+        max_lng FLOAT,
+        length FLOAT NOT NULL,
+        start_lat FLOAT,
+        start_lng FLOAT,
+        end_lat FLOAT,
+        end_lng FLOAT,
+        squares BLOB,
+        PRIMARY KEY (trip_id)
+    )
\ No newline at end of file
@@ -0,0 +1,8 @@
+INSERT OR REPLACE INTO path_meta (
+    trip_id, point_count, min_lat, min_lng, max_lat, max_lng, length,
+    start_lat, start_lng, end_lat, end_lng, squares
+)
+VALUES (
+    :trip_id, :point_count, :min_lat, :min_lng, :max_lat, :max_lng, :length,
+    :start_lat, :start_lng, :end_lat, :end_lng, :squares
+)
\ No newline at end of file
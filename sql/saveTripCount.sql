@@ -0,0 +1,2 @@
+INSERT OR REPLACE INTO trip_counts (username, past, filter_types, count, valid_until)
+VALUES (:username, :past, :filter_types, :count, :valid_until)
@@ -0,0 +1,6 @@
+SELECT stats
+FROM stats_snapshots
+WHERE username = :username
+AND type = :tripType
+AND year = :year
+AND (valid_until IS NULL OR julianday('now') <= julianday(valid_until))
@@ -0,0 +1,2 @@
+INSERT OR REPLACE INTO stats_snapshots (username, type, year, stats, valid_until)
+VALUES (:username, :tripType, :year, :stats, :valid_until)
@@ -0,0 +1,21 @@
+
+-- one row per trip with everything the stats sections need, aggregated in py/stats.py
+SELECT
+	c.trip_length,
+	c.past,
+	c.plannedFuture,
+	c.future,
+	c.operator,
+	CASE
+		WHEN :tripType IN ('air', 'helicopter') AND a.iata IS NOT NULL THEN a.manufacturer || ' ' || a.model
+		ELSE c.material_type
+	END AS material,
+	c.material_type,
+	c.countries,
+	c.origin_station,
+	c.destination_station,
+	strftime('%Y', c.start_datetime) AS start_year,
+	c.start_datetime = 1 AS undated
+FROM counted c
+LEFT JOIN airliners a ON c.material_type = a.iata
+WHERE (:username IS NULL OR c.username = :username)
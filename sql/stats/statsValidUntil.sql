@@ -0,0 +1,19 @@
+WITH UTC_Filtered AS (
+	SELECT
+		CASE
+			WHEN utc_start_datetime IS NOT NULL
+			THEN utc_start_datetime
+			ELSE start_datetime
+		END AS utc_filtered_start_datetime
+	FROM trip
+	WHERE username = :username
+	AND type = :tripType
+	AND (:year IS NULL OR strftime('%Y', utc_filtered_start_datetime) = :year)
+)
+
+-- the first planned trip to become past, which changes the stats
+SELECT utc_filtered_start_datetime AS valid_until
+FROM UTC_Filtered
+WHERE julianday('now') <= julianday(utc_filtered_start_datetime)
+ORDER BY julianday(utc_filtered_start_datetime)
+LIMIT 1
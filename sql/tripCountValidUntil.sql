@@ -0,0 +1,7 @@
+-- the first planned trip to become past, which moves it between the counts
+SELECT COALESCE(utc_start_datetime, start_datetime) AS valid_until
+FROM trip
+WHERE username = :username
+AND julianday('now') <= julianday(COALESCE(utc_start_datetime, start_datetime))
+ORDER BY julianday(COALESCE(utc_start_datetime, start_datetime))
+LIMIT 1
@@ -0,0 +1,120 @@
+"""
+Connections to the SQLite databases, one per thread and request
+
+mainConn, pathConn and authConn used to be single connections shared by every
+thread, so that the commit of a request could commit the half done writes of
+another one. They are now Database objects, with the same cursor(), execute(),
+commit() and rollback() methods, which run on a connection borrowed by the
+current thread from a small pool on its first use. The connection is given back
+at the end of the request by release(), which commits what the request left
+uncommitted, or rolls it back if the request failed.
+
+The databases use WAL, so that readers don't wait for the writer. Connections
+start their write transactions with BEGIN IMMEDIATE, so that a single writer
+at a time holds the write lock and the others wait for it for up to
+BUSY_TIMEOUT, instead of failing when upgrading a read transaction.
+"""
+
+import logging
+import queue
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+# idle connections kept per database, more are opened when needed
+POOL_SIZE = 8
+# seconds a writer waits for the write lock
+BUSY_TIMEOUT = 30
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    # durable at each checkpoint rather than at each commit, safe with WAL
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA mmap_size = 268435456",
+    # in KiB when negative
+    "PRAGMA cache_size = -16384",
+    "PRAGMA temp_store = MEMORY",
+)
+
+
+class Database:
+    def __init__(self, path, pool_size=POOL_SIZE):
+        self.path = path
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._local = threading.local()
+
+    def _connect(self):
+        connection = sqlite3.connect(
+            self.path,
+            timeout=BUSY_TIMEOUT,
+            isolation_level="IMMEDIATE",
+            check_same_thread=False,
+        )
+        connection.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            connection.execute(pragma)
+        return connection
+
+    @property
+    def connection(self):
+        """
+        Connection of the current thread, borrowed from the pool if needed
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            try:
+                connection = self._pool.get_nowait()
+            except queue.Empty:
+                connection = self._connect()
+            self._local.connection = connection
+        return connection
+
+    def release(self, commit=True):
+        """
+        Give the connection of the current thread back to the pool, ending its
+        transaction if one is still open
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            return
+        self._local.connection = None
+        try:
+            if connection.in_transaction:
+                if commit:
+                    connection.commit()
+                else:
+                    logger.info(f"Rolling back an unfinished transaction on {self.path}")
+                    connection.rollback()
+        except sqlite3.Error:
+            logger.exception(f"Could not end the transaction on {self.path}")
+            connection.close()
+            return
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    @property
+    def in_transaction(self):
+        return self.connection.in_transaction
+
+    def cursor(self):
+        return self.connection.cursor()
+
+    def execute(self, *args, **kwargs):
+        return self.connection.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self.connection.executemany(*args, **kwargs)
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+
+def release_connections(databases, commit=True):
+    for database in databases:
+        database.release(commit=commit)
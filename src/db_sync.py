@@ -1,15 +1,33 @@
 import csv
+import datetime
+import hashlib
 import io
+import json
 import logging
 import logging.config
+import sys
 
+from sqlalchemy import text
+
+from src.drift import (
+    COMPARED_COLUMNS,
+    canonical_values,
+    compare_trip_range,
+    describe_drift,
+    normalize_sqlite_trip,
+    parse_date,
+)
 from src.pg import get_or_create_pg_session, pg_session
-from src.trips import Trip, compare_trip, parse_date
-from src.utils import get_user_id, mainConn, managed_cursor
+from src.trips import Trip
+from src.utils import authConn, get_user_id, mainConn, managed_cursor
 
 logging.config.fileConfig("logging.conf", disable_existing_loggers=False)
 logger = logging.getLogger(__name__)
 
+# trips hashed together when comparing SQLite and PG
+COMPARE_CHUNK_SIZE = 1000
+COMPARE_FETCH_SIZE = 5000
+
 
 def sync_db_from_sqlite():
     """
@@ -172,37 +190,128 @@ def sync_trips_from_sqlite(pg_session=None):
     logger.info("Finished migrating trips from sqlite to pg!")
 
 
-def compare_all_trips():
-    # Fetch trip IDs from SQLite
+def _chunk_hashes(rows):
+    """
+    {chunk: [hash, number of trips]} of (trip_id, values) rows ordered by id,
+    where chunk is trip_id // COMPARE_CHUNK_SIZE
+    """
+    hashes = {}
+    chunk = digest = None
+    for trip_id, values in rows:
+        if trip_id // COMPARE_CHUNK_SIZE != chunk:
+            if digest is not None:
+                hashes[chunk] = [digest.hexdigest(), count]
+            chunk = trip_id // COMPARE_CHUNK_SIZE
+            digest = hashlib.blake2b(digest_size=16)
+            count = 0
+        digest.update(repr((trip_id, values)).encode())
+        count += 1
+    if digest is not None:
+        hashes[chunk] = [digest.hexdigest(), count]
+    return hashes
+
+
+def _sqlite_compare_rows(user_ids):
     with managed_cursor(mainConn) as cursor:
-        cursor.execute("SELECT uid FROM trip ORDER BY uid")
-        sqlite_trips = {row[0] for row in cursor.fetchall()}
+        cursor.execute("SELECT * FROM trip ORDER BY uid")
+        while True:
+            rows = cursor.fetchmany(COMPARE_FETCH_SIZE)
+            if not rows:
+                return
+            for row in rows:
+                try:
+                    values = canonical_values(
+                        normalize_sqlite_trip(row, user_ids.get(row["username"]))
+                    )
+                except Exception:
+                    # never equal to the PG hash, diff_trip reports it
+                    values = None
+                yield row["uid"], values
+
 
-    # Fetch trip IDs from PostgreSQL
+def _pg_compare_rows():
     with pg_session() as pg:
-        pg_trips = {row[0] for row in pg.execute("SELECT trip_id FROM trips ORDER BY trip_id").fetchall()}
-
-    # Compare the counts
-    if len(sqlite_trips) != len(pg_trips):
-        only_in_sqlite = sqlite_trips - pg_trips
-        only_in_pg = pg_trips - sqlite_trips
-
-        msg = (
-            f"Mismatch in trip counts! "
-            f"SQLite has {len(sqlite_trips)} trips, PG has {len(pg_trips)} trips.\n"
-            f"Trips only in SQLite: {sorted(only_in_sqlite)}\n"
-            f"Trips only in PG: {sorted(only_in_pg)}"
+        result = pg.execute(
+            text(
+                f"""
+                SELECT trip_id, {", ".join(COMPARED_COLUMNS)}
+                FROM trips
+                ORDER BY trip_id
+                """
+            ).execution_options(stream_results=True)
+        )
+        while True:
+            rows = result.fetchmany(COMPARE_FETCH_SIZE)
+            if not rows:
+                return
+            for row in rows:
+                yield row["trip_id"], canonical_values(row)
+
+
+def compare_all_trips(report_path=None):
+    """
+    Compare every trip of SQLite and PG, and return a drift report.
+
+    Both tables are read once, in id order, and their normalized rows are hashed
+    by chunks of COMPARE_CHUNK_SIZE ids. Only the trips of the chunks whose hash
+    or number of trips differ are read again and compared one by one. The report
+    is also written as JSON to report_path if given.
+    """
+    started = datetime.datetime.now()
+
+    with managed_cursor(authConn) as cursor:
+        user_ids = {
+            row["username"]: row["uid"]
+            for row in cursor.execute("SELECT username, uid FROM user").fetchall()
+        }
+
+    logger.info("Hashing the trips of SQLite...")
+    sqlite_hashes = _chunk_hashes(_sqlite_compare_rows(user_ids))
+    logger.info("Hashing the trips of PG...")
+    pg_hashes = _chunk_hashes(_pg_compare_rows())
+
+    drifted_chunks = sorted(
+        chunk
+        for chunk in set(sqlite_hashes) | set(pg_hashes)
+        if sqlite_hashes.get(chunk) != pg_hashes.get(chunk)
+    )
+    logger.info(
+        f"{len(drifted_chunks)} chunks of {COMPARE_CHUNK_SIZE} trips differ, "
+        "comparing their trips"
+    )
+
+    drifts = []
+    for chunk in drifted_chunks:
+        drifts.extend(
+            compare_trip_range(
+                chunk * COMPARE_CHUNK_SIZE,
+                (chunk + 1) * COMPARE_CHUNK_SIZE - 1,
+                user_ids,
+            )
         )
-        logger.error(msg)
-        raise Exception(msg)
-
-    # If counts match, do full comparison
-    try:
-        for i, trip_id in enumerate(sorted(sqlite_trips)):
-            if i % 20000 == 0:
-                logger.info(f"Checking consistency of trip {i}/{len(sqlite_trips)}")
-            compare_trip(trip_id)
-    except Exception:
-        logger.error(f"Found exception while processing trip {trip_id}")
-        raise
 
+    report = {
+        "started": started.isoformat(),
+        "finished": datetime.datetime.now().isoformat(),
+        "chunk_size": COMPARE_CHUNK_SIZE,
+        "sqlite_trips": sum(count for _, count in sqlite_hashes.values()),
+        "pg_trips": sum(count for _, count in pg_hashes.values()),
+        "drifted_chunks": drifted_chunks,
+        "drifts": drifts,
+    }
+    for drift in drifts:
+        logger.error(describe_drift(drift))
+    logger.info(
+        f"Compared {report['sqlite_trips']} SQLite trips with {report['pg_trips']} "
+        f"PG trips, {len(drifts)} have drifted"
+    )
+
+    if report_path is not None:
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    report = compare_all_trips(sys.argv[1] if len(sys.argv) > 1 else None)
+    sys.exit(1 if report["drifts"] else 0)
@@ -0,0 +1,376 @@
+"""
+Background check that the trips have the same data in SQLite and PG
+
+Every trip write used to compare the trip in both databases before returning,
+with a read on each side and possibly an email to the owner. The writes now
+queue the trip ids with check_trips_later() once they are committed, and a
+worker thread compares them in batches, with one query on each side.
+
+A trip can look drifted while the transaction writing it on the other side is
+still running, so drifted trips are compared again after RECHECK_DELAY and
+only reported if they still differ.
+"""
+
+import datetime
+import logging
+import queue
+import threading
+import time
+from decimal import Decimal
+
+from flask import has_request_context, request
+
+from py.utils import load_config
+from src.db import release_connections
+from src.pg import pg_session
+from src.utils import (
+    authConn,
+    get_user_ids,
+    getUser,
+    mainConn,
+    managed_cursor,
+    sendEmail,
+)
+
+logger = logging.getLogger(__name__)
+
+# seconds the worker waits for more trips after the first one of a batch
+BATCH_DELAY = 2
+BATCH_SIZE = 500
+RECHECK_DELAY = 10
+
+COMPARED_COLUMNS = (
+    "user_id",
+    "origin_station",
+    "destination_station",
+    "start_datetime",
+    "end_datetime",
+    "is_project",
+    "utc_start_datetime",
+    "utc_end_datetime",
+    "estimated_trip_duration",
+    "manual_trip_duration",
+    "trip_length",
+    "operator",
+    "countries",
+    "line_name",
+    "created",
+    "last_modified",
+    "trip_type",
+    "material_type",
+    "seat",
+    "reg",
+    "waypoints",
+    "notes",
+    "price",
+    "currency",
+    "ticket_id",
+    "purchase_date",
+)
+DATETIME_COLUMNS = (
+    "start_datetime",
+    "utc_start_datetime",
+    "created",
+    "last_modified",
+    "purchase_date",
+)
+# formats of the SQLite dates that datetime.fromisoformat may not read
+FALLBACK_DATE_FORMATS = (
+    "%Y-%m-%d %H:%M:%S.%f",
+    "%Y/%m/%d %H:%M:%S",
+    "%d/%m/%Y %H:%M",
+)
+
+_QUEUE = queue.Queue()
+_WORKER = None
+_WORKER_LOCK = threading.Lock()
+
+
+def values_equal(sqlite_val, pg_val, property_name):
+    if sqlite_val is None and pg_val is None:
+        return True
+    try:
+        if property_name in DATETIME_COLUMNS:
+            return abs(pg_val - sqlite_val) <= datetime.timedelta(seconds=1)
+        return pg_val == sqlite_val
+    except TypeError:
+        return False
+
+
+def parse_date(date: str):
+    try:
+        return datetime.datetime.fromisoformat(date)
+    except Exception:
+        pass
+    for date_format in FALLBACK_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(date, date_format)
+        except Exception:
+            pass
+    logger.error(f"Date format not recognized: {date} ({type(date)})")
+    raise ValueError(f"Date format not recognized: {date}")
+
+
+def normalize_sqlite_trip(sqlite_trip, user_id):
+    """
+    Convert a trip row of SQLite to the columns and types of PG
+    """
+    sqlite_trip = dict(sqlite_trip)
+    sqlite_trip["trip_id"] = sqlite_trip["uid"]
+    sqlite_trip["user_id"] = user_id
+    sqlite_trip["is_project"] = (
+        sqlite_trip["start_datetime"] == 1 or sqlite_trip["end_datetime"] == 1
+    )
+    for column in ("start_datetime", "end_datetime"):
+        if sqlite_trip[column] in [-1, 1]:
+            sqlite_trip[column] = None
+        else:
+            sqlite_trip[column] = parse_date(sqlite_trip[column])
+    for column in ("utc_start_datetime", "utc_end_datetime", "created", "last_modified"):
+        if sqlite_trip[column] is not None:
+            sqlite_trip[column] = parse_date(sqlite_trip[column])
+    if sqlite_trip["operator"] == "":
+        sqlite_trip["operator"] = None
+    if sqlite_trip["operator"] is not None:
+        sqlite_trip["operator"] = str(sqlite_trip["operator"])
+    sqlite_trip["trip_type"] = sqlite_trip["type"]
+    for column in (
+        "line_name",
+        "material_type",
+        "seat",
+        "reg",
+        "waypoints",
+        "notes",
+        "price",
+        "ticket_id",
+    ):
+        if sqlite_trip[column] == "":
+            sqlite_trip[column] = None
+    sqlite_trip["purchase_date"] = sqlite_trip["purchasing_date"]
+    if sqlite_trip["purchase_date"] == "":
+        sqlite_trip["purchase_date"] = None
+    if sqlite_trip["purchase_date"] is not None:
+        sqlite_trip["purchase_date"] = parse_date(sqlite_trip["purchase_date"])
+    return sqlite_trip
+
+
+def diff_trip(trip_id, sqlite_trip, pg_trip, user_ids):
+    """
+    Differences of a trip between SQLite and PG, as a JSON serializable dict, or
+    None if it is the same in both
+    """
+    if sqlite_trip is None and pg_trip is None:
+        return None
+    if sqlite_trip is None:
+        return {"trip_id": trip_id, "kind": "missing_in_sqlite"}
+    if pg_trip is None:
+        return {"trip_id": trip_id, "kind": "missing_in_pg"}
+
+    try:
+        sqlite_trip = normalize_sqlite_trip(
+            sqlite_trip, user_ids.get(sqlite_trip["username"])
+        )
+    except Exception as e:
+        return {"trip_id": trip_id, "kind": "invalid_in_sqlite", "error": str(e)}
+
+    columns = {
+        column: [str(sqlite_trip[column]), str(pg_trip[column])]
+        for column in COMPARED_COLUMNS
+        if not values_equal(sqlite_trip[column], pg_trip[column], column)
+    }
+    if not columns:
+        return None
+    return {"trip_id": trip_id, "kind": "different", "columns": columns}
+
+
+def describe_drift(drift):
+    if drift["kind"] == "missing_in_sqlite":
+        return f"Trip {drift['trip_id']} exists in pg but not in sqlite"
+    if drift["kind"] == "missing_in_pg":
+        return f"Trip {drift['trip_id']} exists in sqlite but not in pg"
+    if drift["kind"] == "invalid_in_sqlite":
+        return f"Trip {drift['trip_id']} can't be read in sqlite: {drift['error']}"
+    return "\n".join(
+        f"Trip {drift['trip_id']} has different values on {column}: "
+        f"{sqlite_val} (sqlite) vs {pg_val} (pg)"
+        for column, (sqlite_val, pg_val) in drift["columns"].items()
+    )
+
+
+def _diff_trips(sqlite_trips, pg_trips, user_ids):
+    drifts = []
+    for trip_id in sorted(set(sqlite_trips) | set(pg_trips)):
+        drift = diff_trip(
+            trip_id, sqlite_trips.get(trip_id), pg_trips.get(trip_id), user_ids
+        )
+        if drift is not None:
+            drifts.append(drift)
+    return drifts
+
+
+def compare_trips(trip_ids):
+    """
+    Compare the given trips in SQLite and PG, with one query on each side.
+    Returns {trip_id: description of the differences} of the trips which differ.
+    """
+    trip_ids = sorted({int(trip_id) for trip_id in trip_ids})
+    if not trip_ids:
+        return {}
+
+    with managed_cursor(mainConn) as cursor:
+        sqlite_trips = {
+            row["uid"]: row
+            for row in cursor.execute(
+                f"SELECT * FROM trip WHERE uid IN ({', '.join(('?',) * len(trip_ids))})",
+                trip_ids,
+            ).fetchall()
+        }
+    user_ids = get_user_ids(trip["username"] for trip in sqlite_trips.values())
+
+    with pg_session() as pg:
+        pg_trips = {
+            row["trip_id"]: row
+            for row in pg.execute(
+                "SELECT * FROM trips WHERE trip_id = ANY(:trip_ids)",
+                {"trip_ids": trip_ids},
+            ).fetchall()
+        }
+
+    return {
+        drift["trip_id"]: describe_drift(drift)
+        for drift in _diff_trips(sqlite_trips, pg_trips, user_ids)
+    }
+
+
+def compare_trip_range(first_trip_id, last_trip_id, user_ids):
+    """
+    Differences of the trips with ids from first_trip_id to last_trip_id, given
+    {username: user_id} of their owners
+    """
+    with managed_cursor(mainConn) as cursor:
+        sqlite_trips = {
+            row["uid"]: row
+            for row in cursor.execute(
+                "SELECT * FROM trip WHERE uid BETWEEN ? AND ?",
+                (first_trip_id, last_trip_id),
+            ).fetchall()
+        }
+
+    with pg_session() as pg:
+        pg_trips = {
+            row["trip_id"]: row
+            for row in pg.execute(
+                "SELECT * FROM trips WHERE trip_id BETWEEN :first AND :last",
+                {"first": first_trip_id, "last": last_trip_id},
+            ).fetchall()
+        }
+
+    return _diff_trips(sqlite_trips, pg_trips, user_ids)
+
+
+def canonical_values(trip):
+    """
+    Values of the compared columns of a normalized SQLite trip or a PG trip, in a
+    form which is the same on both sides when the trip has not drifted.
+    Datetimes are truncated to the second, so values less than a second apart can
+    still differ, and are left to diff_trip.
+    """
+    values = []
+    for column in COMPARED_COLUMNS:
+        value = trip[column]
+        if isinstance(value, bool) or value is None:
+            values.append(value)
+        elif isinstance(value, datetime.datetime):
+            values.append(value.replace(microsecond=0).isoformat())
+        elif isinstance(value, (int, float, Decimal)):
+            values.append(float(value))
+        else:
+            values.append(str(value))
+    return tuple(values)
+
+
+def check_trips_later(trip_ids):
+    """
+    Queue the given trips for the drift check, after they were written and
+    committed in both databases
+    """
+    if has_request_context():
+        context = {"url": request.url, "user": getUser()}
+    else:
+        context = {"url": None, "user": None}
+    for trip_id in trip_ids:
+        _QUEUE.put((int(trip_id), context))
+    _ensure_worker()
+
+
+def _ensure_worker():
+    global _WORKER
+    with _WORKER_LOCK:
+        if _WORKER is None or not _WORKER.is_alive():
+            _WORKER = threading.Thread(
+                target=_work, name="drift-checker", daemon=True
+            )
+            _WORKER.start()
+
+
+def _next_batch():
+    """
+    Trips queued during BATCH_DELAY after the first one, with the context of
+    their last write
+    """
+    trip_id, context = _QUEUE.get()
+    batch = {trip_id: context}
+    deadline = time.monotonic() + BATCH_DELAY
+    while len(batch) < BATCH_SIZE:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            trip_id, context = _QUEUE.get(timeout=timeout)
+        except queue.Empty:
+            break
+        batch[trip_id] = context
+    return batch
+
+
+def _is_local(url):
+    return url is not None and ("127.0.0.1" in url or "localhost" in url)
+
+
+def _report_drifts(drifts, batch):
+    for trip_id, differences in drifts.items():
+        context = batch[trip_id]
+        logger.error(
+            f"""
+            Trip {trip_id} has drifted between SQLite and PG!
+            URL : {context["url"]}
+            Logged in user : {context["user"]}
+            Differences :
+            {differences}
+            """
+        )
+
+    if all(_is_local(batch[trip_id]["url"]) for trip_id in drifts):
+        return
+    trip_ids = ", ".join(str(trip_id) for trip_id in sorted(drifts))
+    sendEmail(
+        load_config()["owner"]["email"],
+        f"Error : trips {trip_ids} have drifted between SQLite and PG",
+        "",
+    )
+
+
+def _work():
+    while True:
+        batch = _next_batch()
+        try:
+            drifts = compare_trips(batch)
+            if drifts:
+                time.sleep(RECHECK_DELAY)
+                drifts = compare_trips(drifts)
+            if drifts:
+                _report_drifts(drifts, batch)
+        except Exception:
+            logger.exception(f"Could not check the drift of trips {sorted(batch)}")
+        finally:
+            release_connections((mainConn, authConn))
@@ -0,0 +1,170 @@
+"""
+Binary encoding of trip paths stored in path.db
+
+A path used to be stored as the text of a python list (`str([[lat, lng], ...])`),
+which every reader had to parse with `json.loads`. It is now stored as a blob:
+
+    header  magic (4 bytes), point count (uint32), bbox as min_lat, min_lng,
+            max_lat, max_lng (int32 micro-degrees), total length in meters (float64)
+    body    point_count int32 latitudes, then point_count int32 longitudes, in
+            micro-degrees, the first value of each column being absolute and the
+            following ones deltas from the previous point
+
+All integers are little-endian. Rows that were not migrated yet are still text and
+are transparently parsed by the decoding functions.
+"""
+
+import json
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+from py.geo_kernels import path_length, to_coords
+
+MAGIC = b"TLP1"
+HEADER = struct.Struct("<4sIiiiid")
+SCALE = 1_000_000
+
+PathHeader = namedtuple(
+    "PathHeader", ["point_count", "min_lat", "min_lng", "max_lat", "max_lng", "length"]
+)
+
+
+def is_encoded(raw):
+    """
+    Return True if the raw value read from the paths table is a binary path
+    """
+    return isinstance(raw, (bytes, memoryview)) and bytes(raw[:4]) == MAGIC
+
+
+def encode_path(path):
+    """
+    Encode a path (list of [lat, lng], list of {"lat", "lng"} or array) into the
+    binary format described in this module
+    """
+    coords = to_coords(path)
+    point_count = len(coords)
+    fixed = np.rint(coords * SCALE).astype(np.int64)
+
+    if point_count:
+        min_lat, min_lng = fixed.min(axis=0)
+        max_lat, max_lng = fixed.max(axis=0)
+    else:
+        min_lat = min_lng = max_lat = max_lng = 0
+
+    deltas = np.diff(fixed, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+    header = HEADER.pack(
+        MAGIC,
+        point_count,
+        int(min_lat),
+        int(min_lng),
+        int(max_lat),
+        int(max_lng),
+        path_length(coords),
+    )
+    return (
+        header
+        + deltas[:, 0].astype("<i4").tobytes()
+        + deltas[:, 1].astype("<i4").tobytes()
+    )
+
+
+def read_header(raw):
+    """
+    Read the summary of a path without decoding its coordinates
+    """
+    if not is_encoded(raw):
+        coords = to_coords(json.loads(raw))
+        if len(coords) == 0:
+            return PathHeader(0, 0.0, 0.0, 0.0, 0.0, 0.0)
+        min_lat, min_lng = coords.min(axis=0)
+        max_lat, max_lng = coords.max(axis=0)
+        return PathHeader(
+            len(coords),
+            float(min_lat),
+            float(min_lng),
+            float(max_lat),
+            float(max_lng),
+            path_length(coords),
+        )
+
+    _, point_count, min_lat, min_lng, max_lat, max_lng, length = HEADER.unpack_from(raw)
+    return PathHeader(
+        point_count,
+        min_lat / SCALE,
+        min_lng / SCALE,
+        max_lat / SCALE,
+        max_lng / SCALE,
+        length,
+    )
+
+
+def decode_path(raw):
+    """
+    Decode a raw value from the paths table into a (n, 2) float64 array of
+    [lat, lng]
+    """
+    if not is_encoded(raw):
+        return to_coords(json.loads(raw))
+
+    point_count = HEADER.unpack_from(raw)[1]
+    columns = np.frombuffer(
+        raw, dtype="<i4", count=2 * point_count, offset=HEADER.size
+    ).reshape(2, point_count)
+    return np.cumsum(columns, axis=1, dtype=np.int64).T / SCALE
+
+
+def path_to_list(raw):
+    """
+    Decode a raw value from the paths table into a list of [lat, lng], which is
+    what is sent to the frontend
+    """
+    if raw is None:
+        return []
+    return decode_path(raw).tolist()
+
+
+def squares_of(coords):
+    """
+    Sorted unique ids of the 1° squares of the world grid containing the nodes of
+    a (n, 2) coordinates array. The id of a square is
+    (floor(lat) + 90) * 360 + (floor(lng) + 180), between 0 and 64799.
+    """
+    if len(coords) == 0:
+        return np.zeros(0, dtype=np.uint16)
+    cells = np.floor(coords).astype(np.int64)
+    lat = np.clip(cells[:, 0] + 90, 0, 179)
+    lng = np.clip(cells[:, 1] + 180, 0, 359)
+    return np.unique(lat * 360 + lng).astype(np.uint16)
+
+
+def encode_squares(coords):
+    return encode_square_ids(squares_of(coords))
+
+
+def encode_square_ids(ids):
+    return np.asarray(ids, dtype="<u2").tobytes()
+
+
+def decode_square_ids(raw):
+    """
+    Return the square ids of a blob written by encode_squares as an int64 array
+    """
+    if raw is None:
+        return np.zeros(0, dtype=np.int64)
+    return np.frombuffer(raw, dtype="<u2").astype(np.int64)
+
+
+def square_corners(ids):
+    """
+    Return the (lat, lng) of the south-west corner of each square id
+    """
+    return list(zip((ids // 360 - 90).tolist(), (ids % 360 - 180).tolist()))
+
+
+def decode_squares(raw):
+    """
+    Return the (lat, lng) of the south-west corner of each square id in the blob
+    """
+    return square_corners(decode_square_ids(raw))
@@ -1,3 +1,23 @@
+import json
+import logging
+
+from py.geo_kernels import simplify
+from py.sql import saveMetaQuery
+from src.path_codec import (
+    decode_path,
+    encode_path,
+    encode_squares,
+    is_encoded,
+    read_header,
+)
+
+logger = logging.getLogger(__name__)
+
+# Douglas-Peucker tolerance in degrees of each simplified level of the paths,
+# the level 0 being the stored path. Level 3 is for maps of a whole continent.
+LOD_TOLERANCES = {1: 0.0005, 2: 0.005, 3: 0.05}
+
+
 class Node:
     def __init__(self, trip_id, node_order, lat, lng):
         self.trip_id = trip_id
@@ -25,4 +45,162 @@ class Path:
         return ("trip_id", "path")
 
     def values(self):
-        return [self.list[0].trip_id, str([[node.lat, node.lng] for node in self.list])]
+        return [
+            self.list[0].trip_id,
+            encode_path([[node.lat, node.lng] for node in self.list]),
+        ]
+
+
+def save_path_meta(cursor, trip_id, raw):
+    """
+    Insert or refresh the path_meta row of a trip from its stored path
+    """
+    header = read_header(raw)
+    coords = decode_path(raw)
+    start = coords[0] if len(coords) else (None, None)
+    end = coords[-1] if len(coords) else (None, None)
+    cursor.execute(
+        saveMetaQuery,
+        {
+            "trip_id": trip_id,
+            "point_count": header.point_count,
+            "min_lat": header.min_lat,
+            "min_lng": header.min_lng,
+            "max_lat": header.max_lat,
+            "max_lng": header.max_lng,
+            "length": header.length,
+            "start_lat": start[0],
+            "start_lng": start[1],
+            "end_lat": end[0],
+            "end_lng": end[1],
+            "squares": encode_squares(coords),
+        },
+    )
+    save_path_lods(cursor, trip_id, coords)
+
+
+def save_path_lods(cursor, trip_id, coords):
+    """
+    Store the simplified levels of a path given as a (n, 2) array. A level is only
+    stored when it has fewer points than the previous one, readers fall back to
+    the closest lower level, see sql/getUserLinesLod.sql.
+    """
+    cursor.execute("DELETE FROM path_lods WHERE trip_id = ?", (trip_id,))
+    rows = []
+    point_count = len(coords)
+    for lod, tolerance in sorted(LOD_TOLERANCES.items()):
+        simplified = simplify(coords, tolerance)
+        if len(simplified) < point_count:
+            rows.append((trip_id, lod, encode_path(simplified)))
+            point_count = len(simplified)
+    cursor.executemany(
+        "INSERT INTO path_lods (trip_id, lod, path) VALUES (?, ?, ?)", rows
+    )
+
+
+def delete_path_meta(cursor, trip_ids):
+    placeholders = ", ".join(["?"] * len(trip_ids))
+    cursor.execute(
+        f"DELETE FROM path_meta WHERE trip_id IN ({placeholders})", tuple(trip_ids)
+    )
+    cursor.execute(
+        f"DELETE FROM path_lods WHERE trip_id IN ({placeholders})", tuple(trip_ids)
+    )
+
+
+def _paths_to_binary(conn, batch_size=500):
+    """
+    Convert the paths stored as text into the binary format of src.path_codec
+    """
+    logger.info("Converting paths to the binary format...")
+    uids = [
+        row[0]
+        for row in conn.execute(
+            "SELECT uid FROM paths WHERE typeof(path) = 'text'"
+        ).fetchall()
+    ]
+    for i in range(0, len(uids), batch_size):
+        batch = uids[i : i + batch_size]
+        placeholders = ", ".join(["?"] * len(batch))
+        rows = conn.execute(
+            f"SELECT uid, path FROM paths WHERE uid IN ({placeholders})", batch
+        ).fetchall()
+        conn.executemany(
+            "UPDATE paths SET path = ? WHERE uid = ?",
+            [
+                (encode_path(json.loads(row[1])), row[0])
+                for row in rows
+                if not is_encoded(row[1])
+            ],
+        )
+    logger.info(f"Converted {len(uids)} paths to the binary format")
+
+
+def _fill_path_meta(conn, batch_size=500):
+    """
+    Compute the path_meta rows of all the trips that don't have one yet
+    """
+    logger.info("Filling path_meta...")
+    trip_ids = [
+        row[0]
+        for row in conn.execute(
+            """
+            SELECT trip_id FROM paths
+            WHERE trip_id NOT IN (SELECT trip_id FROM path_meta)
+            """
+        ).fetchall()
+    ]
+    cursor = conn.cursor()
+    for i in range(0, len(trip_ids), batch_size):
+        batch = trip_ids[i : i + batch_size]
+        placeholders = ", ".join(["?"] * len(batch))
+        rows = conn.execute(
+            f"SELECT trip_id, path FROM paths WHERE trip_id IN ({placeholders})",
+            batch,
+        ).fetchall()
+        for row in rows:
+            save_path_meta(cursor, row[0], row[1])
+    cursor.close()
+    logger.info(f"Filled path_meta for {len(trip_ids)} trips")
+
+
+def _fill_path_lods(conn, batch_size=500):
+    """
+    Compute the simplified levels of the paths stored before they existed
+    """
+    logger.info("Filling path_lods...")
+    trip_ids = [row[0] for row in conn.execute("SELECT trip_id FROM paths").fetchall()]
+    cursor = conn.cursor()
+    for i in range(0, len(trip_ids), batch_size):
+        batch = trip_ids[i : i + batch_size]
+        placeholders = ", ".join(["?"] * len(batch))
+        rows = conn.execute(
+            f"SELECT trip_id, path FROM paths WHERE trip_id IN ({placeholders})",
+            batch,
+        ).fetchall()
+        for row in rows:
+            save_path_lods(cursor, row[0], decode_path(row[1]))
+    cursor.close()
+    logger.info(f"Filled path_lods for {len(trip_ids)} trips")
+
+
+# one-shot migrations of path.db, in order. The index of the last applied
+# migration + 1 is stored in `PRAGMA user_version`
+PATHS_MIGRATIONS = [
+    _paths_to_binary,
+    _fill_path_meta,
+    _fill_path_lods,
+]
+
+
+def migrate_paths(conn):
+    """
+    Apply the path.db migrations that have not been applied yet
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for index, migration in enumerate(PATHS_MIGRATIONS):
+        if index < version:
+            continue
+        migration(conn)
+        conn.execute(f"PRAGMA user_version = {index + 1}")
+        conn.commit()
@@ -4,24 +4,47 @@ import re
 import threading
 from contextlib import contextmanager
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import NullPool
 
+from py.utils import load_config
 from src import sql
 from src.consts import Env
 
 logger = logging.getLogger(__name__)
 threadlocal = threading.local()
 
+# Defaults of the `pool` section of `pg` in config.yaml
+POOL_DEFAULTS = {
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_timeout": 30,
+    "pool_recycle": 1800,
+    "pool_pre_ping": True,
+    # in milliseconds, no limit when null
+    "statement_timeout": None,
+    # let pgbouncer pool the connections, in transaction pooling mode
+    "pgbouncer": False,
+}
+
 
 @contextmanager
 def pg_session():
-    # prevent nested sessions to avoid difficult bugs
+    """
+    Session of the current thread, committed at the end of the outermost block.
+
+    Blocks nested in another one reuse its session inside a savepoint, so that
+    helpers called while a session is open don't need it passed to them, and an
+    exception in them only rolls back their own statements.
+    """
+    session = Session()
     if getattr(threadlocal, "inside_pg_session", False):
-        raise Exception("Cannot open a pg session while already in a pg session")
+        with session.begin_nested():
+            yield session
+        return
 
     threadlocal.inside_pg_session = True
-    session = Session()
 
     # roll back the transaction if any exception is raised
     try:
@@ -36,6 +59,13 @@ def pg_session():
         threadlocal.inside_pg_session = False
 
 
+def remove_pg_session(exception=None):
+    """
+    Forget the session of the thread at the end of a request
+    """
+    Session.remove()
+
+
 @contextmanager
 def get_or_create_pg_session(session=None):
     """
@@ -161,6 +191,46 @@ def get_db_connection_string():
     return f"postgresql+psycopg2://{pg_user}:{pg_password}@{pg_host}:{pg_port}/{pg_db}"
 
 
-# setup to easily create database sessions
-pg_session_engine = create_engine(get_db_connection_string())
-Session = sessionmaker(bind=pg_session_engine)
+def get_pool_config():
+    """
+    Pool settings from the optional `pool` section of `pg` in config.yaml
+    """
+    pool_config = dict(POOL_DEFAULTS)
+    pool_config.update((load_config().get("pg") or {}).get("pool") or {})
+    return pool_config
+
+
+def create_pg_engine(pool_config):
+    statement_timeout = pool_config["statement_timeout"]
+
+    if pool_config["pgbouncer"]:
+        # pgbouncer rejects startup options, and keeps its server connections
+        # between transactions, so the timeout is set on each transaction
+        engine = create_engine(get_db_connection_string(), poolclass=NullPool)
+        if statement_timeout:
+
+            @event.listens_for(engine, "begin")
+            def set_statement_timeout(connection):
+                connection.execute(
+                    f"SET LOCAL statement_timeout = {int(statement_timeout)}"
+                )
+
+        return engine
+
+    connect_args = {}
+    if statement_timeout:
+        connect_args["options"] = f"-c statement_timeout={int(statement_timeout)}"
+    return create_engine(
+        get_db_connection_string(),
+        pool_size=pool_config["pool_size"],
+        max_overflow=pool_config["max_overflow"],
+        pool_timeout=pool_config["pool_timeout"],
+        pool_recycle=pool_config["pool_recycle"],
+        pool_pre_ping=pool_config["pool_pre_ping"],
+        connect_args=connect_args,
+    )
+
+
+# setup to easily create database sessions, one per thread
+pg_session_engine = create_pg_engine(get_pool_config())
+Session = scoped_session(sessionmaker(bind=pg_session_engine))
@@ -0,0 +1,340 @@
+"""
+Traveled railway polygons of the regions of country_percent, per user
+
+The region page used to look up every node of every rail trip of the user in the
+polygons of the region on each visit. The polygons touched by a trip are now
+computed once, when the trip is written, and stored in region_trip_polygons.
+region_polygons keeps, for each user and region, the number of counted trips
+touching each polygon, so that deleting a trip only removes the polygons no other
+trip touches.
+
+A trip is counted when it is a past rail trip, which are the trips the region page
+used to select. Planned trips are stored uncounted and are counted by the next
+sync of the user's regions after their start date.
+
+The polygons of a trip are stored with the version of the region files they were
+computed from (see regions_version). When files are added, removed or replaced,
+the next sync of a user computes the polygons of their trips again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+from py import region_index
+from py.sql import getRegionSyncTrips, getRegionTrips, getUserLines, upsertPercent
+from src.path_codec import decode_path
+from src.utils import mainConn, managed_cursor, pathConn
+
+logger = logging.getLogger(__name__)
+
+RAIL_TYPES = ("train", "tram", "metro")
+# countries whose trips count in the regions of each other, see getTripsCountry
+COUNTRY_GROUPS = [{"CN", "HK", "MO"}]
+
+# (modification time of the directory, regions by country, geojson file names)
+_REGIONS = None
+
+
+def _load_regions():
+    """
+    Regions of the processed geojson files, listed again when the directory
+    changes, which happens when a file is added or removed
+    """
+    global _REGIONS
+    stamp = os.stat(region_index.SOURCE_DIR).st_mtime_ns
+    if _REGIONS is not None and _REGIONS[0] == stamp:
+        return _REGIONS
+
+    regions = {}
+    names = []
+    for name in sorted(os.listdir(region_index.SOURCE_DIR)):
+        if name.endswith(".geojson"):
+            cc = name[: -len(".geojson")]
+            regions.setdefault(cc.split("-")[0].upper(), []).append(cc)
+            names.append(name)
+
+    _REGIONS = (stamp, regions, names)
+    return _REGIONS
+
+
+def regions_by_country():
+    """
+    Region codes of the processed geojson files, by upper case country code
+    """
+    return _load_regions()[1]
+
+
+def regions_version():
+    """
+    Version of the region files, which changes with any of them. The files are
+    looked at on every call, as /removePolygons rewrites them in place, which
+    doesn't change the directory.
+    """
+    files = []
+    for name in _load_regions()[2]:
+        try:
+            stat = os.stat(os.path.join(region_index.SOURCE_DIR, name))
+        except FileNotFoundError:
+            continue
+        files.append([name, stat.st_mtime_ns, stat.st_size])
+    return hashlib.sha1(
+        json.dumps([region_index.VERSION, files]).encode()
+    ).hexdigest()[:16]
+
+
+def region_codes(countries):
+    """
+    Codes of the regions a trip can count in, from its countries column
+    """
+    if not countries:
+        return []
+    country_codes = {code.upper() for code in json.loads(countries)}
+    for group in COUNTRY_GROUPS:
+        if country_codes & group:
+            country_codes |= group
+
+    regions = regions_by_country()
+    return [cc for code in sorted(country_codes) for cc in regions.get(code, [])]
+
+
+def trip_polygons(countries, raw_path):
+    """
+    (cc, polygon id) of every regional polygon containing a node of the path or
+    the middle of one of its segments
+    """
+    nodes = decode_path(raw_path)
+    points = np.unique(np.concatenate((nodes, (nodes[:-1] + nodes[1:]) / 2)), axis=0)
+    return [
+        (cc, str(polygon_id))
+        for cc in region_codes(countries)
+        for polygon_id in sorted(region_index.lookup_ids(cc, points), key=str)
+    ]
+
+
+def _count_trip(cursor, trip_id, username):
+    cursor.execute(
+        """
+        INSERT INTO region_polygons (username, cc, polygon_id, trips)
+        SELECT :username, cc, polygon_id, 1
+        FROM region_trip_polygons
+        WHERE trip_id = :trip_id
+        ON CONFLICT (username, cc, polygon_id) DO UPDATE SET trips = trips + 1
+        """,
+        {"trip_id": trip_id, "username": username},
+    )
+
+
+def _uncount_trip(cursor, trip_id, username):
+    cursor.execute(
+        """
+        UPDATE region_polygons
+        SET trips = trips - 1
+        WHERE username = :username
+        AND (cc, polygon_id) IN (
+            SELECT cc, polygon_id FROM region_trip_polygons WHERE trip_id = :trip_id
+        )
+        """,
+        {"trip_id": trip_id, "username": username},
+    )
+    cursor.execute(
+        "DELETE FROM region_polygons WHERE username = :username AND trips <= 0",
+        {"username": username},
+    )
+
+
+def _trip_regions(cursor, trip_id):
+    return {
+        row["cc"]
+        for row in cursor.execute(
+            "SELECT DISTINCT cc FROM region_trip_polygons WHERE trip_id = :trip_id",
+            {"trip_id": trip_id},
+        ).fetchall()
+    }
+
+
+def _forget_trip(cursor, trip_id, changed):
+    """
+    Remove the stored polygons of a trip, adding the regions whose percent
+    changes to `changed`
+    """
+    row = cursor.execute(
+        "SELECT username, counted FROM region_trips WHERE trip_id = :trip_id",
+        {"trip_id": trip_id},
+    ).fetchone()
+    if row is None:
+        return
+
+    if row["counted"]:
+        _uncount_trip(cursor, trip_id, row["username"])
+        changed.setdefault(row["username"], set()).update(
+            _trip_regions(cursor, trip_id)
+        )
+    cursor.execute(
+        "DELETE FROM region_trip_polygons WHERE trip_id = :trip_id",
+        {"trip_id": trip_id},
+    )
+    cursor.execute(
+        "DELETE FROM region_trips WHERE trip_id = :trip_id", {"trip_id": trip_id}
+    )
+
+
+def _store_trip(cursor, trip, raw_path, version, changed):
+    """
+    Compute and store the polygons of a trip with the version of the region
+    files, adding the regions whose percent changes to `changed`
+    """
+    polygons = []
+    if trip["type"] in RAIL_TYPES and raw_path is not None:
+        polygons = trip_polygons(trip["countries"], raw_path)
+
+    cursor.execute(
+        """
+        INSERT INTO region_trips (trip_id, username, counted, regions_version)
+        VALUES (:trip_id, :username, :counted, :regions_version)
+        """,
+        {
+            "trip_id": trip["uid"],
+            "username": trip["username"],
+            "counted": trip["counted"],
+            "regions_version": version,
+        },
+    )
+    cursor.executemany(
+        "INSERT INTO region_trip_polygons (trip_id, cc, polygon_id) VALUES (?, ?, ?)",
+        [(trip["uid"], cc, polygon_id) for cc, polygon_id in polygons],
+    )
+    if trip["counted"] and polygons:
+        _count_trip(cursor, trip["uid"], trip["username"])
+        changed.setdefault(trip["username"], set()).update(cc for cc, _ in polygons)
+
+
+def _update_percents(cursor, changed):
+    existing = {cc for ccs in regions_by_country().values() for cc in ccs}
+    for username, ccs in changed.items():
+        for cc in ccs:
+            # the region file was removed
+            if cc not in existing:
+                cursor.execute(
+                    "DELETE FROM percents WHERE username = :username AND cc = :cc",
+                    {"username": username, "cc": cc},
+                )
+                continue
+            cursor.execute(
+                upsertPercent,
+                {
+                    "username": username,
+                    "cc": cc,
+                    "percent": region_index.traveled_percent(
+                        cc, traveled_polygons(username, cc, cursor)
+                    ),
+                },
+            )
+
+
+def _refresh_trips(cursor, trip_ids, changed):
+    """
+    Forget the stored polygons of the trips, then store them again for the trips
+    that still exist
+    """
+    if not trip_ids:
+        return
+    placeholders = ", ".join(("?",) * len(trip_ids))
+    trips = cursor.execute(
+        getRegionTrips.format(trip_ids=placeholders), tuple(trip_ids)
+    ).fetchall()
+    with managed_cursor(pathConn) as path_cursor:
+        paths = {
+            row["trip_id"]: row["path"]
+            for row in path_cursor.execute(
+                getUserLines.format(trip_ids=placeholders), tuple(trip_ids)
+            ).fetchall()
+        }
+
+    for trip_id in trip_ids:
+        _forget_trip(cursor, trip_id, changed)
+    version = regions_version()
+    for trip in trips:
+        _store_trip(cursor, trip, paths.get(trip["uid"]), version, changed)
+
+
+def update_trip_regions(trip_ids):
+    """
+    Refresh the traveled polygons and the region percents after trips were
+    created, updated or deleted
+    """
+    changed = {}
+    with managed_cursor(mainConn) as cursor:
+        _refresh_trips(cursor, [int(trip_id) for trip_id in trip_ids], changed)
+        _update_percents(cursor, changed)
+    mainConn.commit()
+
+
+def sync_user_regions(username):
+    """
+    Store the polygons of the trips of the user written before the polygons were
+    tracked or computed from other region files, and count the planned trips that
+    are now in the past
+    """
+    changed = {}
+    with managed_cursor(mainConn) as cursor:
+        rows = cursor.execute(
+            getRegionSyncTrips,
+            {"username": username, "regions_version": regions_version()},
+        ).fetchall()
+        _refresh_trips(cursor, [row["uid"] for row in rows if row["outdated"]], changed)
+
+        for row in rows:
+            if row["outdated"]:
+                continue
+            cursor.execute(
+                "UPDATE region_trips SET counted = 1 WHERE trip_id = :trip_id",
+                {"trip_id": row["uid"]},
+            )
+            _count_trip(cursor, row["uid"], username)
+            changed.setdefault(username, set()).update(
+                _trip_regions(cursor, row["uid"])
+            )
+
+        _update_percents(cursor, changed)
+    if rows:
+        logger.info(f"Synced the regions of {len(rows)} trips of {username}")
+    mainConn.commit()
+
+
+def traveled_polygons(username, cc, cursor=None):
+    """
+    Set of the ids of the polygons of a region touched by the counted trips of
+    the user
+    """
+    query = """
+        SELECT polygon_id FROM region_polygons
+        WHERE username = :username AND cc = :cc
+    """
+    params = {"username": username, "cc": cc}
+    if cursor is not None:
+        return {row["polygon_id"] for row in cursor.execute(query, params)}
+    with managed_cursor(mainConn) as cursor:
+        return {row["polygon_id"] for row in cursor.execute(query, params)}
+
+
+def delete_user_regions(cursor, username):
+    cursor.execute(
+        "DELETE FROM region_polygons WHERE username = :username",
+        {"username": username},
+    )
+    cursor.execute(
+        """
+        DELETE FROM region_trip_polygons WHERE trip_id IN (
+            SELECT trip_id FROM region_trips WHERE username = :username
+        )
+        """,
+        {"username": username},
+    )
+    cursor.execute(
+        "DELETE FROM region_trips WHERE username = :username",
+        {"username": username},
+    )
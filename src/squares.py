@@ -0,0 +1,219 @@
+"""
+Visited 1° squares of the world grid, per trip
+
+The visited squares map used to walk every node of every past trip of the user on
+each visit, interpolating the great circle of every air segment. The squares of
+a trip are now computed when the trip is written and stored in trip_squares as
+three sets of square ids (see src.path_codec.squares_of):
+
+    stopped     squares of the first and last node
+    land        squares of the nodes of a trip that is not a flight
+    air         squares of the nodes of a flight and of the great circles between
+                them, every 50 km
+
+The map of a user is the union of the sets of their past trips, a square taking
+the strongest status among stopped, passed (land) and air.
+"""
+
+import datetime
+import logging
+
+import numpy as np
+
+from py.geo_kernels import slerp
+from py.sql import getUserLines, upsertPercent
+from src.path_codec import (
+    decode_path,
+    decode_square_ids,
+    encode_square_ids,
+    square_corners,
+    squares_of,
+)
+from src.utils import mainConn, managed_cursor, pathConn
+
+logger = logging.getLogger(__name__)
+
+AIR_TYPES = ("air", "helicopter")
+GRID_SIZE = 180 * 360
+# status of a square in the union, a stronger status wins
+NONE, AIR, PASSED, STOPPED = range(4)
+STATUS_NAMES = {AIR: "air", PASSED: "passed", STOPPED: "stopped"}
+
+
+def trip_squares(coords, trip_type):
+    """
+    (stopped, land, air) square id arrays of a trip
+    """
+    empty = np.zeros(0, dtype=np.uint16)
+    if len(coords) == 0:
+        return empty, empty, empty
+
+    stopped = squares_of(coords[[0, -1]])
+    if trip_type not in AIR_TYPES:
+        return stopped, squares_of(coords), empty
+
+    # paths of two nodes are drawn straight, so they are not interpolated
+    if len(coords) > 2:
+        coords = np.concatenate((coords, slerp(coords)[0]))
+    return stopped, empty, squares_of(coords)
+
+
+def update_trip_squares(trip_ids):
+    """
+    Recompute the stored squares of trips after they were created, updated or
+    deleted, and refresh the world_squares percent of their owners
+    """
+    for username in _store_trip_squares([int(trip_id) for trip_id in trip_ids]):
+        user_squares(username)
+
+
+def _store_trip_squares(trip_ids):
+    """
+    Replace the stored squares of the trips, returning the usernames whose
+    squares changed
+    """
+    if not trip_ids:
+        return set()
+    placeholders = ", ".join(("?",) * len(trip_ids))
+    with managed_cursor(pathConn) as cursor:
+        paths = {
+            row["trip_id"]: row["path"]
+            for row in cursor.execute(
+                getUserLines.format(trip_ids=placeholders), tuple(trip_ids)
+            ).fetchall()
+        }
+
+    with managed_cursor(mainConn) as cursor:
+        usernames = {
+            row["username"]
+            for row in cursor.execute(
+                f"SELECT username FROM trip_squares WHERE trip_id IN ({placeholders})",
+                tuple(trip_ids),
+            ).fetchall()
+        }
+        cursor.execute(
+            f"DELETE FROM trip_squares WHERE trip_id IN ({placeholders})",
+            tuple(trip_ids),
+        )
+
+        trips = cursor.execute(
+            f"SELECT uid, username, type FROM trip WHERE uid IN ({placeholders})",
+            tuple(trip_ids),
+        ).fetchall()
+        rows = []
+        for trip in trips:
+            raw_path = paths.get(trip["uid"])
+            coords = decode_path(raw_path) if raw_path is not None else np.zeros((0, 2))
+            stopped, land, air = trip_squares(coords, trip["type"])
+            rows.append(
+                (
+                    trip["uid"],
+                    trip["username"],
+                    encode_square_ids(stopped),
+                    encode_square_ids(land),
+                    encode_square_ids(air),
+                )
+            )
+            usernames.add(trip["username"])
+        cursor.executemany(
+            """
+            INSERT INTO trip_squares (trip_id, username, stopped, land, air)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            rows,
+        )
+    mainConn.commit()
+    return usernames
+
+
+def delete_user_squares(cursor, username):
+    cursor.execute(
+        "DELETE FROM trip_squares WHERE username = :username", {"username": username}
+    )
+
+
+def _past_trip_squares(username):
+    query = """
+        SELECT trip.uid, trip_squares.trip_id, stopped, land, air
+        FROM trip
+        LEFT JOIN trip_squares ON trip_squares.trip_id = trip.uid
+        WHERE trip.username = :username
+        AND start_datetime NOT IN (1)
+        AND (
+            CASE
+                WHEN utc_start_datetime IS NOT NULL THEN utc_start_datetime
+                ELSE start_datetime
+            END
+        ) < :now
+    """
+    params = {"username": username, "now": datetime.datetime.now()}
+    with managed_cursor(mainConn) as cursor:
+        rows = cursor.execute(query, params).fetchall()
+
+    # trips written before the squares were stored
+    missing = [row["uid"] for row in rows if row["trip_id"] is None]
+    if missing:
+        logger.info(f"Computing the squares of {len(missing)} trips of {username}")
+        _store_trip_squares(missing)
+        with managed_cursor(mainConn) as cursor:
+            rows = cursor.execute(query, params).fetchall()
+    return rows
+
+
+def user_squares(username):
+    """
+    Status of every square of the world grid for the past trips of the user, as
+    an int8 array indexed by square id. Also refreshes the world_squares percent
+    of the user.
+    """
+    rows = _past_trip_squares(username)
+    status = np.zeros(GRID_SIZE, dtype=np.int8)
+    # weakest status first, so that stronger ones overwrite it
+    for column, square_status in (("air", AIR), ("land", PASSED), ("stopped", STOPPED)):
+        for row in rows:
+            status[decode_square_ids(row[column])] = square_status
+
+    with managed_cursor(mainConn) as cursor:
+        cursor.execute(
+            upsertPercent,
+            {
+                "username": username,
+                "cc": "world_squares",
+                "percent": round(land_percentage(status), 2),
+            },
+        )
+    mainConn.commit()
+    return status
+
+
+def land_percentage(status):
+    return np.count_nonzero(status >= PASSED) / GRID_SIZE * 100
+
+
+def air_percentage(status):
+    return np.count_nonzero(status == AIR) / GRID_SIZE * 100
+
+
+def squares_geojson(status):
+    features = []
+    ids = np.flatnonzero(status)
+    for (lat, lng), square_status in zip(square_corners(ids), status[ids].tolist()):
+        features.append(
+            {
+                "type": "Feature",
+                "geometry": {
+                    "type": "Polygon",
+                    "coordinates": [
+                        [
+                            [lng, lat],
+                            [lng + 1, lat],
+                            [lng + 1, lat + 1],
+                            [lng, lat + 1],
+                            [lng, lat],
+                        ]
+                    ],
+                },
+                "properties": {"status": STATUS_NAMES[square_status]},
+            }
+        )
+    return {"type": "FeatureCollection", "features": features}
@@ -0,0 +1,120 @@
+"""
+Stored results of fetch_stats, per user, trip type and year
+
+Computing the stats page of a user reads and aggregates all their trips.
+The result is stored in stats_snapshots the first time it is computed, and read
+from there until either:
+
+- a trip of the user is written, which deletes all their snapshots
+- the first planned trip of the snapshot starts, which moves it from the planned
+  to the past columns. The snapshot stores that date in valid_until.
+
+The years section is stored with FUTURE_YEAR as the label of the year of the
+trips without a date, and localized when read.
+"""
+
+import json
+import logging
+
+from py.sql import getStatsSnapshot, saveStatsSnapshot, statsValidUntil
+from src.utils import mainConn, managed_cursor
+
+logger = logging.getLogger(__name__)
+
+FUTURE_YEAR = "future"
+# stats stored for all years use this key, since the primary key cannot be NULL
+ALL_YEARS = ""
+
+
+def get_stats_snapshot(username, trip_type, year=None):
+    """
+    Return the stored stats of the user, or None if there are none or they are
+    outdated
+    """
+    with managed_cursor(mainConn) as cursor:
+        row = cursor.execute(
+            getStatsSnapshot,
+            {
+                "username": username,
+                "tripType": trip_type,
+                "year": year or ALL_YEARS,
+            },
+        ).fetchone()
+    if row is None:
+        return None
+    return json.loads(row["stats"])
+
+
+def save_stats_snapshot(username, trip_type, year, stats):
+    with managed_cursor(mainConn) as cursor:
+        valid_until = cursor.execute(
+            statsValidUntil,
+            {"username": username, "tripType": trip_type, "year": year},
+        ).fetchone()
+        cursor.execute(
+            saveStatsSnapshot,
+            {
+                "username": username,
+                "tripType": trip_type,
+                "year": year or ALL_YEARS,
+                "stats": json.dumps(stats),
+                "valid_until": valid_until["valid_until"] if valid_until else None,
+            },
+        )
+    mainConn.commit()
+
+
+def localize_stats(stats, lang):
+    """
+    Replace the FUTURE_YEAR label of the years section by its translation
+    """
+    for section in stats.get("years", {}).values():
+        for year in section or []:
+            if year["year"] == FUTURE_YEAR:
+                year["year"] = lang["future"]
+    return stats
+
+
+def delete_user_stats(cursor, username):
+    cursor.execute(
+        "DELETE FROM stats_snapshots WHERE username = :username",
+        {"username": username},
+    )
+
+
+def invalidate_stats_snapshots(username):
+    with managed_cursor(mainConn) as cursor:
+        delete_user_stats(cursor, username)
+    mainConn.commit()
+
+
+def invalidate_trip_stats(trip_ids):
+    """
+    Delete the snapshots of the owners of the given trips
+    """
+    trip_ids = [int(trip_id) for trip_id in trip_ids]
+    if not trip_ids:
+        return
+    with managed_cursor(mainConn) as cursor:
+        cursor.execute(
+            f"""
+            DELETE FROM stats_snapshots WHERE username IN (
+                SELECT username FROM trip WHERE uid IN ({", ".join(("?",) * len(trip_ids))})
+            )
+            """,
+            tuple(trip_ids),
+        )
+    mainConn.commit()
+
+
+def invalidate_type_stats(trip_types):
+    """
+    Delete the snapshots of every user for the given trip types, after a change
+    of data shared by all users such as the airliners
+    """
+    with managed_cursor(mainConn) as cursor:
+        cursor.execute(
+            f"DELETE FROM stats_snapshots WHERE type IN ({', '.join(('?',) * len(trip_types))})",
+            tuple(trip_types),
+        )
+    mainConn.commit()
@@ -0,0 +1,263 @@
+"""
+Disk cache of the map tiles of the /tile proxy
+
+The tiles of Jawg and Thunderforest, which are paid per request, used to be
+cached in a SimpleCache of Flask-Caching, which each gunicorn worker had its own
+copy of, lost on every restart, and limited in number of tiles only. They are
+now stored on disk in TILE_CACHE_DIR, shared by the workers:
+
+- the images are stored by the hash of their content in blobs/, so that the
+  many identical tiles of the seas and of empty land are stored once
+- index.db maps the key of each tile to its image, with the ETag and
+  Last-Modified of the upstream answer, and counts the tiles of each image
+- when the images take more than max_size_mb (see config-example.yaml), the
+  least recently served tiles are evicted until they take EVICTION_TARGET of it
+- a tile older than MAX_AGE is revalidated with If-None-Match and
+  If-Modified-Since, and is still served if the upstream server fails
+
+Upstream requests go through a single requests.Session, which keeps its HTTPS
+connections open between tiles.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter, Retry
+
+from py.utils import load_config
+from src.db import Database
+
+logger = logging.getLogger(__name__)
+
+TILE_CACHE_DIR = "cache/tiles"
+DEFAULT_MAX_SIZE_MB = 1024
+# fraction of the maximum size the cache is brought back to by an eviction
+EVICTION_TARGET = 0.9
+# seconds during which a cached tile is served without asking upstream
+MAX_AGE = 7 * 24 * 3600
+# the last access of a tile is only written again after this many seconds
+ACCESS_RESOLUTION = 3600
+UPSTREAM_TIMEOUT = 10
+
+_INDEX = None
+_SESSION = None
+_LOCK = threading.Lock()
+
+
+def _index():
+    global _INDEX
+    with _LOCK:
+        if _INDEX is None:
+            os.makedirs(TILE_CACHE_DIR, exist_ok=True)
+            _INDEX = Database(os.path.join(TILE_CACHE_DIR, "index.db"))
+            _INDEX.connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS tiles (
+                    key TEXT NOT NULL PRIMARY KEY,
+                    digest TEXT NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    fetched_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS tiles_accessed_at ON tiles (accessed_at);
+                CREATE TABLE IF NOT EXISTS blobs (
+                    digest TEXT NOT NULL PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    refs INTEGER NOT NULL
+                );
+                """
+            )
+            _INDEX.release()
+    return _INDEX
+
+
+def _session():
+    global _SESSION
+    with _LOCK:
+        if _SESSION is None:
+            _SESSION = requests.Session()
+            retries = Retry(
+                total=2, backoff_factor=0.5, status_forcelist=[502, 503, 504]
+            )
+            _SESSION.mount(
+                "https://", HTTPAdapter(pool_maxsize=16, max_retries=retries)
+            )
+    return _SESSION
+
+
+def _max_size():
+    config = load_config().get("tile_cache") or {}
+    return config.get("max_size_mb", DEFAULT_MAX_SIZE_MB) * 1024 * 1024
+
+
+def _blob_path(digest):
+    return os.path.join(TILE_CACHE_DIR, "blobs", digest[:2], f"{digest}.png")
+
+
+def _read_blob(digest):
+    try:
+        with open(_blob_path(digest), "rb") as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+
+def _write_blob(digest, content):
+    path = _blob_path(digest)
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # written next to the image then renamed, so that readers never see half of it
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path), suffix=".tmp", delete=False
+    ) as file:
+        file.write(content)
+    os.replace(file.name, path)
+
+
+def _remove_tile(cursor, key):
+    """
+    Remove a tile from the index, returning the digest and size of its image if
+    no other tile uses it anymore
+    """
+    row = cursor.execute("SELECT digest FROM tiles WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        return None
+    cursor.execute("DELETE FROM tiles WHERE key = ?", (key,))
+    cursor.execute(
+        "UPDATE blobs SET refs = refs - 1 WHERE digest = ?", (row["digest"],)
+    )
+    return cursor.execute(
+        "DELETE FROM blobs WHERE digest = ? AND refs <= 0 RETURNING digest, size",
+        (row["digest"],),
+    ).fetchone()
+
+
+def _evict(cursor):
+    """
+    Remove the least recently served tiles while the images take more than the
+    maximum size, returning the digests of the images to delete
+    """
+    max_size = _max_size()
+    size = cursor.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+    if size <= max_size:
+        return []
+    target = max_size * EVICTION_TARGET
+    unused = []
+    for row in cursor.execute("SELECT key FROM tiles ORDER BY accessed_at").fetchall():
+        blob = _remove_tile(cursor, row["key"])
+        if blob is not None:
+            unused.append(blob["digest"])
+            size -= blob["size"]
+            if size <= target:
+                break
+    logger.info(f"Evicted {len(unused)} tile images from the cache")
+    return unused
+
+
+def _store(key, content, etag, last_modified):
+    digest = hashlib.sha256(content).hexdigest()
+    _write_blob(digest, content)
+    index = _index()
+    now = time.time()
+    unused = []
+    try:
+        cursor = index.cursor()
+        previous = _remove_tile(cursor, key)
+        if previous is not None and previous["digest"] != digest:
+            unused.append(previous["digest"])
+        cursor.execute(
+            """
+            INSERT INTO blobs (digest, size, refs) VALUES (?, ?, 1)
+            ON CONFLICT (digest) DO UPDATE SET refs = refs + 1
+            """,
+            (digest, len(content)),
+        )
+        cursor.execute(
+            """
+            INSERT INTO tiles
+            (key, digest, etag, last_modified, fetched_at, accessed_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (key, digest, etag, last_modified, now, now),
+        )
+        unused += _evict(cursor)
+        index.commit()
+    except Exception:
+        index.rollback()
+        raise
+    finally:
+        index.release()
+    for digest in unused:
+        try:
+            os.remove(_blob_path(digest))
+        except FileNotFoundError:
+            pass
+
+
+def _touch(key, fetched=False):
+    index = _index()
+    now = time.time()
+    try:
+        if fetched:
+            index.execute(
+                "UPDATE tiles SET fetched_at = ?, accessed_at = ? WHERE key = ?",
+                (now, now, key),
+            )
+        else:
+            index.execute(
+                "UPDATE tiles SET accessed_at = ? WHERE key = ? AND accessed_at < ?",
+                (now, key, now - ACCESS_RESOLUTION),
+            )
+        index.commit()
+    finally:
+        index.release()
+
+
+def get_tile(key, url):
+    """
+    Image of a tile, from the cache or from url, None if it can't be found.
+    The key identifies the tile, url holding the API keys.
+    """
+    index = _index()
+    try:
+        cached = index.execute("SELECT * FROM tiles WHERE key = ?", (key,)).fetchone()
+    finally:
+        index.release()
+    content = _read_blob(cached["digest"]) if cached else None
+
+    if content is not None and time.time() - cached["fetched_at"] < MAX_AGE:
+        _touch(key)
+        return content
+
+    headers = {}
+    if content is not None:
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+    try:
+        response = _session().get(url, headers=headers, timeout=UPSTREAM_TIMEOUT)
+    except requests.RequestException:
+        logger.exception(f"Could not fetch the tile {key}")
+        return content
+
+    if response.status_code == 304 and content is not None:
+        _touch(key, fetched=True)
+        return content
+    if response.status_code == 200:
+        _store(
+            key,
+            response.content,
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+        )
+        return response.content
+    logger.warning(f"Tile {key} answered {response.status_code} upstream")
+    return content
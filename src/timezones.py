@@ -0,0 +1,79 @@
+"""
+Time zone of coordinates, from a single TimezoneFinder of the process
+
+A TimezoneFinder loads its polygon data when it is created, which used to happen
+on every conversion between local and UTC times, twice per flight of a flight
+search. It is now created on the first lookup and shared, behind a lock as its
+lookups are not thread safe.
+
+Lookups are cached by coordinates rounded to COORDINATE_DECIMALS, about 10 m,
+as the same stations and airports come back on most trips.
+"""
+
+import logging
+import threading
+from functools import lru_cache
+
+import pytz
+from timezonefinder import TimezoneFinder
+
+logger = logging.getLogger(__name__)
+
+COORDINATE_DECIMALS = 4
+CACHE_SIZE = 65536
+
+# Zones using the time of Beijing rather than their official UTC+6
+FIXED_OFFSETS = {"Asia/Urumqi": 480, "Asia/Kashgar": 480}
+
+_FINDER = None
+_LOCK = threading.Lock()
+
+
+def _finder():
+    global _FINDER
+    if _FINDER is None:
+        logger.info("Loading the time zone polygons")
+        _FINDER = TimezoneFinder()
+    return _FINDER
+
+
+def _key(lat, lng):
+    return (
+        round(float(lat), COORDINATE_DECIMALS),
+        round(float(lng), COORDINATE_DECIMALS),
+    )
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _timezone_at(key):
+    lat, lng = key
+    with _LOCK:
+        return _finder().timezone_at(lat=lat, lng=lng)
+
+
+def timezone_at(lat, lng):
+    """
+    Name of the time zone of the coordinates, None when there is none
+    """
+    return _timezone_at(_key(lat, lng))
+
+
+def get_tzinfo(timezone_str):
+    if timezone_str in FIXED_OFFSETS:
+        return pytz.FixedOffset(FIXED_OFFSETS[timezone_str])
+    return pytz.timezone(timezone_str)
+
+
+def to_utc(timezone_str, dateTime):
+    """
+    UTC naive datetime of a naive local datetime of the time zone
+    """
+    localized_datetime = get_tzinfo(timezone_str).localize(dateTime)
+    return localized_datetime.astimezone(pytz.utc).replace(tzinfo=None)
+
+
+def to_local(timezone_str, dateTime):
+    """
+    Local naive datetime in the time zone of an aware datetime
+    """
+    return dateTime.astimezone(get_tzinfo(timezone_str)).replace(tzinfo=None)
@@ -0,0 +1,82 @@
+"""
+Stored number of trips of the trips table, per user, tab and type filter
+
+The trips table shows the number of trips matching its filters on every page,
+which used to be counted again for each page. Without a search, that number is
+stored in trip_counts the first time it is counted, and read from there until
+either:
+
+- a trip of the user is written, which deletes all their counts
+- the first planned trip of the user starts, which moves it from the projects
+  to the past trips. The count stores that date in valid_until.
+"""
+
+import logging
+
+from py.sql import getTripCount, saveTripCount, tripCountValidUntil
+from src.utils import mainConn, managed_cursor
+
+logger = logging.getLogger(__name__)
+
+
+def get_trip_count(username, past, filter_types):
+    """
+    Return the stored count, or None if there is none or it is outdated
+    """
+    with managed_cursor(mainConn) as cursor:
+        row = cursor.execute(
+            getTripCount,
+            {"username": username, "past": past, "filter_types": filter_types},
+        ).fetchone()
+    if row is None:
+        return None
+    return row["count"]
+
+
+def save_trip_count(username, past, filter_types, count):
+    with managed_cursor(mainConn) as cursor:
+        valid_until = cursor.execute(
+            tripCountValidUntil, {"username": username}
+        ).fetchone()
+        cursor.execute(
+            saveTripCount,
+            {
+                "username": username,
+                "past": past,
+                "filter_types": filter_types,
+                "count": count,
+                "valid_until": valid_until["valid_until"] if valid_until else None,
+            },
+        )
+    mainConn.commit()
+
+
+def delete_user_trip_counts(cursor, username):
+    cursor.execute(
+        "DELETE FROM trip_counts WHERE username = :username", {"username": username}
+    )
+
+
+def invalidate_user_trip_counts(username):
+    with managed_cursor(mainConn) as cursor:
+        delete_user_trip_counts(cursor, username)
+    mainConn.commit()
+
+
+def invalidate_trip_counts(trip_ids):
+    """
+    Delete the counts of the owners of the given trips
+    """
+    trip_ids = [int(trip_id) for trip_id in trip_ids]
+    if not trip_ids:
+        return
+    with managed_cursor(mainConn) as cursor:
+        cursor.execute(
+            f"""
+            DELETE FROM trip_counts WHERE username IN (
+                SELECT username FROM trip WHERE uid IN ({", ".join(("?",) * len(trip_ids))})
+            )
+            """,
+            tuple(trip_ids),
+        )
+    mainConn.commit()
@@ -0,0 +1,178 @@
+"""
+Revisions of the trips of each user, for the incremental loading of the map
+
+The map keeps the trips and paths of the user in the browser, and used to ask
+for the trips modified after its last load, along with the ids of all the
+trips of the user to find the deleted ones. Each user now has a revision in
+user_revisions, increased on every write of their trips:
+
+- trip_revisions stores the revision of the last write of each trip. Trips
+  without one have not changed since the revisions were introduced.
+- trip_tombstones stores the revision at which each deleted trip was deleted.
+- the other trips of the map group of a trip updated or deleted get a new
+  revision too, so that the map receives the group again.
+
+The map sends the revision of its data and receives the trips changed and
+deleted since, and the current revision. When nothing changed, answering only
+takes a read of user_revisions.
+"""
+
+import logging
+
+from src.utils import mainConn, managed_cursor
+
+logger = logging.getLogger(__name__)
+
+
+def get_user_revision(username):
+    with managed_cursor(mainConn) as cursor:
+        row = cursor.execute(
+            "SELECT revision FROM user_revisions WHERE username = :username",
+            {"username": username},
+        ).fetchone()
+    return row["revision"] if row else 0
+
+
+def _next_revision(cursor, username):
+    return cursor.execute(
+        """
+        INSERT INTO user_revisions (username, revision) VALUES (:username, 1)
+        ON CONFLICT (username) DO UPDATE SET revision = revision + 1
+        RETURNING revision
+        """,
+        {"username": username},
+    ).fetchone()["revision"]
+
+
+def bump_trip_revisions(trip_ids):
+    """
+    Give a new revision of their owner to trips after they were created or
+    updated. Trip ids which don't exist anymore are ignored, see
+    add_trip_tombstones.
+    """
+    trip_ids = [int(trip_id) for trip_id in trip_ids]
+    if not trip_ids:
+        return
+    with managed_cursor(mainConn) as cursor:
+        owners = {}
+        for row in cursor.execute(
+            f"""
+            SELECT uid, username FROM trip
+            WHERE uid IN ({", ".join(("?",) * len(trip_ids))})
+            """,
+            tuple(trip_ids),
+        ).fetchall():
+            owners.setdefault(row["username"], []).append(row["uid"])
+
+        for username, user_trip_ids in owners.items():
+            _set_revisions(cursor, username, user_trip_ids)
+    mainConn.commit()
+
+
+def bump_group_revisions(cursor, trip_id):
+    """
+    Give a new revision to the other trips of the group of a trip on the map,
+    see sql/getUniqueUserTrips.sql, before it is updated or deleted with the
+    same cursor. A group is drawn with its smallest uid, so the map has to
+    receive the group again when that trip leaves it.
+    """
+    rows = cursor.execute(
+        """
+        SELECT other.uid, other.username FROM trip AS other
+        JOIN trip AS this ON this.uid = :trip_id
+        WHERE other.username = this.username
+          AND other.uid != this.uid
+          AND other.origin_station IS this.origin_station
+          AND other.destination_station IS this.destination_station
+          AND other.trip_length IS this.trip_length
+          AND strftime(
+              '%Y', COALESCE(other.utc_start_datetime, other.start_datetime)
+          ) IS strftime(
+              '%Y', COALESCE(this.utc_start_datetime, this.start_datetime)
+          )
+        """,
+        {"trip_id": int(trip_id)},
+    ).fetchall()
+    if rows:
+        _set_revisions(cursor, rows[0]["username"], [row["uid"] for row in rows])
+
+
+def _set_revisions(cursor, username, trip_ids):
+    revision = _next_revision(cursor, username)
+    cursor.executemany(
+        """
+        INSERT INTO trip_revisions (trip_id, username, revision)
+        VALUES (?, ?, ?)
+        ON CONFLICT (trip_id) DO UPDATE
+        SET username = excluded.username, revision = excluded.revision
+        """,
+        [(trip_id, username, revision) for trip_id in trip_ids],
+    )
+    cursor.execute(
+        f"""
+        DELETE FROM trip_tombstones
+        WHERE trip_id IN ({", ".join(("?",) * len(trip_ids))})
+        """,
+        tuple(trip_ids),
+    )
+
+
+def add_trip_tombstones(username, trip_ids):
+    """
+    Record the deletion of trips of the user
+    """
+    trip_ids = [int(trip_id) for trip_id in trip_ids]
+    if not trip_ids:
+        return
+    with managed_cursor(mainConn) as cursor:
+        revision = _next_revision(cursor, username)
+        cursor.executemany(
+            """
+            INSERT OR REPLACE INTO trip_tombstones (trip_id, username, revision)
+            VALUES (?, ?, ?)
+            """,
+            [(trip_id, username, revision) for trip_id in trip_ids],
+        )
+        cursor.execute(
+            f"""
+            DELETE FROM trip_revisions
+            WHERE trip_id IN ({", ".join(("?",) * len(trip_ids))})
+            """,
+            tuple(trip_ids),
+        )
+    mainConn.commit()
+
+
+def get_changes(username, since):
+    """
+    Ids of the trips of the user changed and deleted after the given revision
+    """
+    with managed_cursor(mainConn) as cursor:
+        changed = [
+            row["trip_id"]
+            for row in cursor.execute(
+                """
+                SELECT trip_id FROM trip_revisions
+                WHERE username = :username AND revision > :since
+                """,
+                {"username": username, "since": since},
+            ).fetchall()
+        ]
+        deleted = [
+            row["trip_id"]
+            for row in cursor.execute(
+                """
+                SELECT trip_id FROM trip_tombstones
+                WHERE username = :username AND revision > :since
+                """,
+                {"username": username, "since": since},
+            ).fetchall()
+        ]
+    return changed, deleted
+
+
+def delete_user_revisions(cursor, username):
+    for table in ("user_revisions", "trip_revisions", "trip_tombstones"):
+        cursor.execute(
+            f"DELETE FROM {table} WHERE username = :username", {"username": username}
+        )
@@ -0,0 +1,177 @@
+"""
+Full-text index of the trips, for the search box of the trips table
+
+The search used to compare remove_diacritics(LOWER(...)) of 15 columns of every
+trip of the user with the searched text, calling the Python function for each of
+them. The same columns, with the names of the tags of the trip and the airliner
+of its material, are now lowercased, stripped of their diacritics and stored
+once per trip in the trip_search FTS5 table. It uses the trigram tokenizer, so
+that `text LIKE '%search%'` is answered by the index for searches of
+MIN_INDEXED_LENGTH characters or more, like the former substring search. Shorter
+searches can't use the index, and only read the texts of the trips of the user.
+
+The text of a trip is rewritten when the trip, its tags or its airliner change.
+Trips written before the index existed are added on the first search of their
+owner.
+"""
+
+import logging
+
+from py.utils import remove_diacritics
+from src.utils import mainConn, managed_cursor
+
+logger = logging.getLogger(__name__)
+
+# shortest search answered by the trigram index
+MIN_INDEXED_LENGTH = 3
+
+TRIP_COLUMNS = (
+    "origin_station",
+    "destination_station",
+    "operator",
+    "countries",
+    "line_name",
+    "start_datetime",
+    "end_datetime",
+    "type",
+    "notes",
+    "reg",
+    "material_type",
+)
+SEARCHED_COLUMNS = TRIP_COLUMNS + (
+    "airliner_iata",
+    "manufacturer",
+    "model",
+    "tag_names",
+)
+
+
+def normalize(text):
+    return remove_diacritics(str(text).lower())
+
+
+def search_pattern(search_value):
+    """
+    LIKE pattern of a search on trip_search, None when there is nothing to search
+    """
+    if not search_value:
+        return None
+    return f"%{normalize(search_value)}%"
+
+
+def uses_index(pattern):
+    """
+    Whether the trigram index can answer a pattern of search_pattern
+    """
+    return len(pattern.strip("%")) >= MIN_INDEXED_LENGTH
+
+
+def _search_text(trip):
+    return "\n".join(
+        normalize(trip[column])
+        for column in SEARCHED_COLUMNS
+        if trip[column] is not None
+    )
+
+
+def update_trip_search(trip_ids):
+    """
+    Rewrite the indexed text of trips after they were created, updated or
+    deleted, or after a change of their tags or airliner
+    """
+    trip_ids = [int(trip_id) for trip_id in trip_ids]
+    if not trip_ids:
+        return
+    placeholders = ", ".join(("?",) * len(trip_ids))
+    with managed_cursor(mainConn) as cursor:
+        cursor.execute(
+            f"DELETE FROM trip_search WHERE rowid IN ({placeholders})",
+            tuple(trip_ids),
+        )
+        trips = cursor.execute(
+            f"""
+            SELECT
+                trip.uid,
+                trip.username,
+                {", ".join(f"trip.{column}" for column in TRIP_COLUMNS)},
+                airliners.iata AS airliner_iata,
+                airliners.manufacturer,
+                airliners.model,
+                group_concat(tags.name, char(10)) AS tag_names
+            FROM trip
+            LEFT JOIN airliners ON trip.material_type = airliners.iata
+            LEFT JOIN tags_associations ON trip.uid = tags_associations.trip_id
+            LEFT JOIN tags ON tags_associations.tag_id = tags.uid
+            WHERE trip.uid IN ({placeholders})
+            GROUP BY trip.uid
+            """,
+            tuple(trip_ids),
+        ).fetchall()
+        cursor.executemany(
+            "INSERT INTO trip_search (rowid, username, text) VALUES (?, ?, ?)",
+            [(trip["uid"], trip["username"], _search_text(trip)) for trip in trips],
+        )
+    mainConn.commit()
+
+
+def update_tag_search(tag_id):
+    """
+    Rewrite the indexed text of the trips of a tag after it was renamed
+    """
+    with managed_cursor(mainConn) as cursor:
+        trip_ids = [
+            row["trip_id"]
+            for row in cursor.execute(
+                "SELECT trip_id FROM tags_associations WHERE tag_id = ?", (tag_id,)
+            ).fetchall()
+        ]
+    update_trip_search(trip_ids)
+
+
+def update_airliner_search(iatas):
+    """
+    Rewrite the indexed text of the trips whose material is one of the given
+    airliners, after they were edited
+    """
+    iatas = [iata for iata in iatas if iata]
+    if not iatas:
+        return
+    with managed_cursor(mainConn) as cursor:
+        trip_ids = [
+            row["uid"]
+            for row in cursor.execute(
+                f"""
+                SELECT uid FROM trip
+                WHERE material_type IN ({", ".join(("?",) * len(iatas))})
+                """,
+                tuple(iatas),
+            ).fetchall()
+        ]
+    update_trip_search(trip_ids)
+
+
+def index_user_trips(username):
+    """
+    Add the trips of the user written before the index existed
+    """
+    with managed_cursor(mainConn) as cursor:
+        missing = [
+            row["uid"]
+            for row in cursor.execute(
+                """
+                SELECT uid FROM trip
+                WHERE username = :username
+                AND NOT EXISTS (SELECT 1 FROM trip_search WHERE rowid = trip.uid)
+                """,
+                {"username": username},
+            ).fetchall()
+        ]
+    if missing:
+        logger.info(f"Indexing the text of {len(missing)} trips of {username}")
+        update_trip_search(missing)
+
+
+def delete_user_trip_search(cursor, username):
+    cursor.execute(
+        "DELETE FROM trip_search WHERE username = :username", {"username": username}
+    )
@@ -0,0 +1,468 @@
+"""
+Vector tiles (MVT) of the trips of a user, cached on disk
+
+The map used to receive every trip and path of the user at once from
+getTripsPaths. It can instead load the tiles of the trips layer in view, each
+one holding the part of the paths crossing it, simplified to its zoom (see
+LOD_TOLERANCES in src.paths), with the uid, type, status and count of the trip.
+
+Tiles are cached in TILE_CACHE_DIR/<username>/<public|private>/<z>/<x>/<y>.mvt
+and deleted when a trip crossing them is written:
+
+- trip_tile_bounds stores the bounding box of each trip as of its last write.
+  When a trip is written, the cached tiles touching its former and new boxes
+  are deleted. Trips written before the table existed are added to it by
+  sync_tile_bounds on the first tile of their owner.
+- the status of a trip changes when it starts and ends, so a cached tile starts
+  with the first date at which one of its trips changes status, and is rendered
+  again after it.
+"""
+
+import datetime
+import logging
+import math
+import os
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+
+from py.sql import getUniqueUserTrips, getUserLinesLod
+from src.path_codec import decode_path
+from src.utils import mainConn, managed_cursor, pathConn
+
+logger = logging.getLogger(__name__)
+
+TILE_CACHE_DIR = "cache/trip_tiles"
+LAYER_NAME = "trips"
+MAX_ZOOM = 18
+TILE_EXTENT = 4096
+# pixels of the paths kept around the tile, so that lines are not cut at its edge
+TILE_BUFFER = 64
+# highest zoom of each simplified level of the paths, see src.paths
+LOD_ZOOMS = ((3, 3), (6, 2), (9, 1))
+MAX_LAT = 85.0511287798
+STATUSES = ("current", "plannedFuture", "future", "past")
+# cache header: the unix time after which the tile is outdated, 0 for never
+VALID_UNTIL = struct.Struct("<q")
+
+
+def tile_lod(z):
+    for max_zoom, lod in LOD_ZOOMS:
+        if z <= max_zoom:
+            return lod
+    return 0
+
+
+def _tile_lat(y, n):
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+
+def tile_bounds(z, x, y, buffer=0):
+    """
+    (min_lat, min_lng, max_lat, max_lng) of a tile, widened by buffer pixels
+    """
+    n = 2**z
+    margin = buffer / TILE_EXTENT
+    return (
+        _tile_lat(min(y + 1 + margin, n), n),
+        (x - margin) / n * 360 - 180,
+        _tile_lat(max(y - margin, 0), n),
+        (x + 1 + margin) / n * 360 - 180,
+    )
+
+
+def _tile_ranges(min_lat, min_lng, max_lat, max_lng, z):
+    """
+    Ranges of the x and y of the tiles of zoom z crossing a bounding box
+    """
+    n = 2**z
+
+    def tile_x(lng):
+        return min(max(int((lng + 180) / 360 * n), 0), n - 1)
+
+    def tile_y(lat):
+        lat = math.radians(min(max(lat, -MAX_LAT), MAX_LAT))
+        y = (1 - math.asinh(math.tan(lat)) / math.pi) / 2 * n
+        return min(max(int(y), 0), n - 1)
+
+    return (
+        range(tile_x(min_lng), tile_x(max_lng) + 1),
+        range(tile_y(max_lat), tile_y(min_lat) + 1),
+    )
+
+
+def _to_tile(coords, z, x, y):
+    """
+    Integer coordinates in a tile of a (n, 2) array of [lat, lng]
+    """
+    scale = 2**z * TILE_EXTENT
+    lat = np.radians(np.clip(coords[:, 0], -MAX_LAT, MAX_LAT))
+    px = (coords[:, 1] + 180) / 360 * scale - x * TILE_EXTENT
+    py = (1 - np.arcsinh(np.tan(lat)) / np.pi) / 2 * scale - y * TILE_EXTENT
+    return np.rint(np.column_stack((px, py))).astype(np.int64)
+
+
+def _clip_lines(points):
+    """
+    Parts of a line of tile coordinates whose segments cross the tile and its
+    buffer, without repeated points
+    """
+    if len(points) < 2:
+        return []
+    low, high = -TILE_BUFFER, TILE_EXTENT + TILE_BUFFER
+    starts, ends = points[:-1], points[1:]
+    inside = (
+        (np.minimum(starts, ends) <= high) & (np.maximum(starts, ends) >= low)
+    ).all(axis=1)
+
+    lines = []
+    line = []
+    for index in range(len(inside)):
+        if not inside[index]:
+            if len(line) > 1:
+                lines.append(np.array(line))
+            line = []
+            continue
+        if not line:
+            line.append(starts[index])
+        if (ends[index] != line[-1]).any():
+            line.append(ends[index])
+    if len(line) > 1:
+        lines.append(np.array(line))
+    return lines
+
+
+def _varint(value):
+    data = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return bytes(data)
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _field(number, value):
+    """
+    Protocol buffer field: a varint for an int, length delimited for bytes
+    """
+    if isinstance(value, int):
+        return _varint(number << 3) + _varint(value)
+    return _varint(number << 3 | 2) + _varint(len(value)) + value
+
+
+def _packed(number, values):
+    return _field(number, b"".join(_varint(value) for value in values))
+
+
+def _geometry(lines):
+    commands = []
+    cursor = np.zeros(2, dtype=np.int64)
+    for line in lines:
+        deltas = np.diff(line, axis=0, prepend=cursor[None, :])
+        cursor = line[-1]
+        commands.append(1 | 1 << 3)  # MoveTo 1 point
+        commands.extend(_zigzag(int(value)) for value in deltas[0])
+        commands.append(2 | (len(line) - 1) << 3)  # LineTo the other points
+        commands.extend(_zigzag(int(value)) for value in deltas[1:].ravel())
+    return commands
+
+
+def _value(value):
+    if isinstance(value, str):
+        return _field(1, value.encode())
+    # sint64 value
+    return _field(6, _zigzag(value))
+
+
+def encode_tile(features):
+    """
+    MVT of a single layer of lines, from (id, properties, lines) features
+    """
+    keys, values = {}, {}
+    encoded = []
+    for feature_id, properties, lines in features:
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault(value, len(values)))
+        encoded.append(
+            _field(
+                2,
+                _field(1, feature_id)
+                + _packed(2, tags)
+                + _field(3, 2)  # LINESTRING
+                + _packed(4, _geometry(lines)),
+            )
+        )
+    layer = (
+        _field(15, 2)
+        + _field(1, LAYER_NAME.encode())
+        + b"".join(encoded)
+        + b"".join(_field(3, key.encode()) for key in keys)
+        + b"".join(_field(4, _value(value)) for value in values)
+        + _field(5, TILE_EXTENT)
+    )
+    return _field(3, layer)
+
+
+def _status(trip):
+    for status in STATUSES:
+        if trip[status]:
+            return status
+    return "past"
+
+
+def _status_change(trip):
+    """
+    Unix time at which the status of a trip changes, None if it won't
+    """
+    if trip["plannedFuture"]:
+        date = trip["utc_filtered_start_datetime"]
+    elif trip["current"]:
+        date = trip["utc_filtered_end_datetime"]
+    else:
+        return None
+    try:
+        date = datetime.datetime.fromisoformat(str(date))
+    except ValueError:
+        return None
+    return int(date.replace(tzinfo=datetime.timezone.utc).timestamp()) + 1
+
+
+def sync_tile_bounds(username):
+    """
+    Store the bounding boxes of the trips of the user written before
+    trip_tile_bounds existed
+    """
+    with managed_cursor(mainConn) as cursor:
+        trip_ids = [
+            row["uid"]
+            for row in cursor.execute(
+                """
+                SELECT uid FROM trip
+                WHERE username = :username
+                AND uid NOT IN (SELECT trip_id FROM trip_tile_bounds)
+                """,
+                {"username": username},
+            ).fetchall()
+        ]
+    if trip_ids:
+        _store_tile_bounds(trip_ids)
+        logger.info(f"Stored the tile bounds of {len(trip_ids)} trips of {username}")
+
+
+def _path_bounds(trip_ids):
+    placeholders = ", ".join(("?",) * len(trip_ids))
+    with managed_cursor(pathConn) as cursor:
+        return {
+            row["trip_id"]: (
+                row["min_lat"],
+                row["min_lng"],
+                row["max_lat"],
+                row["max_lng"],
+            )
+            for row in cursor.execute(
+                f"""
+                SELECT trip_id, min_lat, min_lng, max_lat, max_lng FROM path_meta
+                WHERE trip_id IN ({placeholders}) AND point_count > 0
+                """,
+                tuple(trip_ids),
+            ).fetchall()
+        }
+
+
+def _store_tile_bounds(trip_ids):
+    """
+    Replace the stored bounding boxes of the trips, returning the former and new
+    ones as (username, bounds) pairs
+    """
+    placeholders = ", ".join(("?",) * len(trip_ids))
+    new_bounds = _path_bounds(trip_ids)
+    with managed_cursor(mainConn) as cursor:
+        boxes = [
+            (row["username"], tuple(row)[2:])
+            for row in cursor.execute(
+                f"SELECT * FROM trip_tile_bounds WHERE trip_id IN ({placeholders})",
+                tuple(trip_ids),
+            ).fetchall()
+        ]
+        cursor.execute(
+            f"DELETE FROM trip_tile_bounds WHERE trip_id IN ({placeholders})",
+            tuple(trip_ids),
+        )
+        rows = []
+        for trip in cursor.execute(
+            f"SELECT uid, username FROM trip WHERE uid IN ({placeholders})",
+            tuple(trip_ids),
+        ).fetchall():
+            if trip["uid"] in new_bounds:
+                rows.append((trip["uid"], trip["username"], *new_bounds[trip["uid"]]))
+                boxes.append((trip["username"], new_bounds[trip["uid"]]))
+        cursor.executemany(
+            """
+            INSERT INTO trip_tile_bounds
+            (trip_id, username, min_lat, min_lng, max_lat, max_lng)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            rows,
+        )
+    mainConn.commit()
+    return boxes
+
+
+def _user_dir(username):
+    return os.path.join(TILE_CACHE_DIR, username)
+
+
+def _tile_path(username, public, z, x, y):
+    return os.path.join(
+        _user_dir(username),
+        "public" if public else "private",
+        str(z),
+        str(x),
+        f"{y}.mvt",
+    )
+
+
+def _delete_cached_tiles(username, bounds):
+    """
+    Delete the cached tiles of the user crossing a bounding box, looking at the
+    cached ones rather than at every tile of the box
+    """
+    for visibility in ("public", "private"):
+        visibility_dir = os.path.join(_user_dir(username), visibility)
+        if not os.path.isdir(visibility_dir):
+            continue
+        for z in os.listdir(visibility_dir):
+            x_range, y_range = _tile_ranges(*bounds, int(z))
+            z_dir = os.path.join(visibility_dir, z)
+            for x in os.listdir(z_dir):
+                if int(x) not in x_range:
+                    continue
+                x_dir = os.path.join(z_dir, x)
+                for tile in os.listdir(x_dir):
+                    if tile.endswith(".mvt") and int(tile[:-4]) in y_range:
+                        try:
+                            os.remove(os.path.join(x_dir, tile))
+                        except FileNotFoundError:
+                            pass
+
+
+def invalidate_trip_tiles(trip_ids):
+    """
+    Delete the cached tiles crossing trips after they were created, updated or
+    deleted
+    """
+    trip_ids = [int(trip_id) for trip_id in trip_ids]
+    if not trip_ids:
+        return
+    for username, bounds in _store_tile_bounds(trip_ids):
+        _delete_cached_tiles(username, bounds)
+
+
+def delete_user_trip_tiles(cursor, username):
+    cursor.execute(
+        "DELETE FROM trip_tile_bounds WHERE username = :username",
+        {"username": username},
+    )
+    shutil.rmtree(_user_dir(username), ignore_errors=True)
+
+
+def render_tile(username, public, z, x, y):
+    """
+    MVT of a tile of the trips of the user, and the unix time after which it is
+    outdated, None if it never is
+    """
+    min_lat, min_lng, max_lat, max_lng = tile_bounds(z, x, y, TILE_BUFFER)
+    # the trips of a group have the same stations and length, so the bounding
+    # box of any of them tells whether the group crosses the tile
+    with managed_cursor(mainConn) as cursor:
+        trips = cursor.execute(
+            getUniqueUserTrips,
+            {
+                "username": username,
+                "since": None,
+                "public": public,
+                "min_lat": min_lat,
+                "min_lng": min_lng,
+                "max_lat": max_lat,
+                "max_lng": max_lng,
+            },
+        ).fetchall()
+    if not trips:
+        return encode_tile([]), None
+
+    trip_ids = [trip["uid"] for trip in trips]
+    with managed_cursor(pathConn) as cursor:
+        paths = {
+            row["trip_id"]: row["path"]
+            for row in cursor.execute(
+                getUserLinesLod.format(trip_ids=", ".join(("?",) * len(trip_ids))),
+                (tile_lod(z), *trip_ids),
+            ).fetchall()
+        }
+
+    features = []
+    valid_until = None
+    # the map draws the planned trips over the past ones
+    for trip in reversed(trips):
+        raw_path = paths.get(trip["uid"])
+        if raw_path is None:
+            continue
+        lines = _clip_lines(_to_tile(decode_path(raw_path), z, x, y))
+        if not lines:
+            continue
+        features.append(
+            (
+                trip["uid"],
+                {
+                    "uid": trip["uid"],
+                    "type": trip["type"],
+                    "status": _status(trip),
+                    "count": trip["count"],
+                },
+                lines,
+            )
+        )
+        change = _status_change(trip)
+        if change is not None and (valid_until is None or change < valid_until):
+            valid_until = change
+    return encode_tile(features), valid_until
+
+
+def get_trip_tile(username, public, z, x, y):
+    """
+    MVT of a tile of the trips of the user, from the cache if it is up to date
+    """
+    path = _tile_path(username, public, z, x, y)
+    try:
+        with open(path, "rb") as file:
+            cached = file.read()
+        (valid_until,) = VALID_UNTIL.unpack_from(cached)
+        if not valid_until or valid_until > datetime.datetime.now().timestamp():
+            return cached[VALID_UNTIL.size :]
+    except (FileNotFoundError, struct.error):
+        pass
+
+    sync_tile_bounds(username)
+    tile, valid_until = render_tile(username, public, z, x, y)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # written next to the tile then renamed, so that readers never see half of it
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path), suffix=".tmp", delete=False
+    ) as file:
+        file.write(VALID_UNTIL.pack(valid_until or 0) + tile)
+    os.replace(file.name, path)
+    return tile
@@ -1,14 +1,26 @@
 import datetime
 import json
 import logging
-import traceback
 
-from flask import abort, request
+from flask import abort
 
 from py.sql import deletePathQuery, getUserLines, saveQuery, updatePath, updateTripQuery
 from py.utils import getCountriesFromPath
-from src.paths import Path
+from src.drift import check_trips_later
+from src.path_codec import encode_path, path_to_list
+from src.paths import Path, delete_path_meta, save_path_meta
 from src.pg import get_or_create_pg_session, pg_session
+from src.regions import update_trip_regions
+from src.squares import update_trip_squares
+from src.stats_snapshots import invalidate_stats_snapshots, invalidate_trip_stats
+from src.trip_counts import invalidate_trip_counts, invalidate_user_trip_counts
+from src.trip_revisions import (
+    add_trip_tombstones,
+    bump_group_revisions,
+    bump_trip_revisions,
+)
+from src.trip_search import update_trip_search
+from src.trip_tiles import invalidate_trip_tiles
 from src.sql.trips import (
     delete_trip_query,
     duplicate_trip_query,
@@ -19,14 +31,12 @@ from src.sql.trips import (
     attach_ticket_query
 )
 from src.utils import (
-    get_user_id,
     getUser,
     mainConn,
     managed_cursor,
     owner,
     pathConn,
     processDates,
-    sendOwnerEmail,
 )
 
 logger = logging.getLogger(__name__)
@@ -102,6 +112,20 @@ class Trip:
         return tuple(vars(self).values())
 
 
+def _refresh_trip_summaries(trip_ids):
+    """
+    Recompute what is derived from trips and stored next to them, after they
+    were written
+    """
+    update_trip_regions(trip_ids)
+    update_trip_squares(trip_ids)
+    invalidate_trip_stats(trip_ids)
+    update_trip_search(trip_ids)
+    invalidate_trip_counts(trip_ids)
+    bump_trip_revisions(trip_ids)
+    invalidate_trip_tiles(trip_ids)
+
+
 def create_trip(trip: Trip, pg_session=None):
     with get_or_create_pg_session(pg_session) as pg:
         if trip.trip_id is None:
@@ -141,7 +165,8 @@ def create_trip(trip: Trip, pg_session=None):
             },
         )
 
-    compare_trip(trip.trip_id)
+    check_trips_later([trip.trip_id])
+    _refresh_trip_summaries([trip.trip_id])
     logger.info(f"Successfully created trip {trip.trip_id}")
 
 
@@ -193,7 +218,7 @@ def _create_trip_in_sqlite(trip: Trip):
 
     try:
         # Begin transactions in both databases
-        mainConn.execute("BEGIN TRANSACTION")
+        mainConn.execute("BEGIN IMMEDIATE")
         with managed_cursor(mainConn) as cursor:
             cursor.execute(
                 saveTripQuery,
@@ -241,9 +266,11 @@ def _create_trip_in_sqlite(trip: Trip):
             values=", ".join(["?"] * len(path.keys())),
         )
 
-        pathConn.execute("BEGIN TRANSACTION")
+        pathConn.execute("BEGIN IMMEDIATE")
         with managed_cursor(pathConn) as cursor:
-            cursor.execute(savePathQuery, path.values())
+            path_values = path.values()
+            cursor.execute(savePathQuery, path_values)
+            save_path_meta(cursor, trip_id, path_values[1])
 
         # Commit both transactions
         mainConn.commit()
@@ -269,8 +296,8 @@ def duplicate_trip(trip_id: int):
             },
         )
 
-    compare_trip(trip_id)
-    compare_trip(new_trip_id)
+    check_trips_later([trip_id, new_trip_id])
+    _refresh_trip_summaries([new_trip_id])
     logger.info(f"Successfully duplicated trip {trip_id} into {new_trip_id}")
     return new_trip_id
 
@@ -304,6 +331,7 @@ def _duplicate_trip_in_sqlite(trip_id):
             "insert into paths (trip_id, path) VALUES (?, ?)",
             (new_trip_id, path_to_duplicate),
         )
+        save_path_meta(cursor, new_trip_id, path_to_duplicate)
     mainConn.commit()
     pathConn.commit()
     return new_trip_id
@@ -344,7 +372,8 @@ def update_trip(trip_id: int, trip: Trip, formData=None, updateCreated=False):
             },
         )
 
-    compare_trip(trip_id)
+    check_trips_later([trip_id])
+    _refresh_trip_summaries([trip_id])
     logger.info(f"Successfully updated trip {trip_id}")
 
 
@@ -375,7 +404,7 @@ def _update_trip_in_sqlite(
     if "path" in formData.keys():
         path = [[coord["lat"], coord["lng"]] for coord in json.loads(formData["path"])]
     else:
-        path = json.loads(pathResult["path"])
+        path = path_to_list(pathResult["path"])
 
     limits = [
         {
@@ -437,10 +466,13 @@ def _update_trip_in_sqlite(
     formattedUpdateQuery = updateTripQuery.format(values=", ".join(formatted_values))
 
     with managed_cursor(mainConn) as cursor:
+        bump_group_revisions(cursor, tripId)
         cursor.execute(formattedUpdateQuery, {**updateData})
     if path:
+        encoded_path = encode_path(path)
         with managed_cursor(pathConn) as cursor:
-            cursor.execute(updatePath, {"trip_id": int(tripId), "path": str(path)})
+            cursor.execute(updatePath, {"trip_id": int(tripId), "path": encoded_path})
+            save_path_meta(cursor, int(tripId), encoded_path)
         pathConn.commit()
     mainConn.commit()
 
@@ -450,7 +482,11 @@ def delete_trip(trip_id: int, username: str):
         _delete_trip_in_sqlite(username, trip_id)
         pg.execute(delete_trip_query(), {"trip_id": trip_id})
 
-    compare_trip(trip_id)
+    check_trips_later([trip_id])
+    add_trip_tombstones(username, [trip_id])
+    invalidate_stats_snapshots(username)
+    invalidate_user_trip_counts(username)
+    _refresh_trip_summaries([trip_id])
     logger.info(f"Successfully deleted trip {trip_id}")
 
 
@@ -469,6 +505,7 @@ def _delete_trip_in_sqlite(username, tripId):
             abort(404)  # Trip exists but doesn't belong to the user
 
         # Delete only if the trip exists and belongs to the user
+        bump_group_revisions(cursor, tripId)
         cursor.execute("DELETE FROM trip WHERE uid = :trip_id", {"trip_id": tripId})
         cursor.execute(
             "DELETE FROM tags_associations WHERE trip_id = :trip_id",
@@ -477,6 +514,7 @@ def _delete_trip_in_sqlite(username, tripId):
 
     with managed_cursor(pathConn) as cursor:
         cursor.execute(deletePathQuery, {"trip_id": tripId})
+        delete_path_meta(cursor, [tripId])
     mainConn.commit()
     pathConn.commit()
 
@@ -487,10 +525,12 @@ def update_trip_type(trip_id, new_type):
         pg.execute(
             update_trip_type_query(), {"trip_id": trip_id, "trip_type": new_type}
         )
+    _refresh_trip_summaries([trip_id])
 
 
 def update_trip_type_in_sqlite(trip_id, new_type):
     with managed_cursor(mainConn) as cursor:
+        bump_group_revisions(cursor, trip_id)
         cursor.execute(
             "UPDATE trip SET type = :newType WHERE uid = :tripId",
             {"newType": new_type, "tripId": trip_id},
@@ -529,10 +569,9 @@ def delete_ticket_from_db(username, ticket_id):
         with pg_session() as pg:
             for trip_id in trip_ids:
                 pg.execute(update_ticket_null_query(), {"trip_id": trip_id})
-        for trip_id in trip_ids:
-            compare_trip(trip_id)
 
         mainConn.commit()
+        check_trips_later(trip_ids)
         return True, None
     except Exception as e:
         mainConn.rollback()
@@ -577,185 +616,10 @@ def attach_ticket_to_trips(username, ticket_id, trip_ids):
                 pg.execute(
                     attach_ticket_query(), {"trip_id": trip_id, "ticket_id": ticket_id}
                 )
-        for trip_id in trip_ids:
-            compare_trip(trip_id)
 
         mainConn.commit()
+        check_trips_later(trip_ids)
         return True, None
     except Exception as e:
         mainConn.rollback()
         return False, str(e)
-
-
-def ensure_values_equal(sqlite_trip, pg_trip, property_name):
-    sqlite_val = sqlite_trip[property_name]
-    pg_val = pg_trip[property_name]
-
-    if sqlite_val is None and pg_val is None:
-        values_are_equal = True
-    elif property_name in [
-        "start_datetime",
-        "utc_start_datetime",
-        "created",
-        "last_modified",
-        "purchase_date",
-    ]:
-        values_are_equal = abs(pg_val - sqlite_val) <= datetime.timedelta(seconds=1)
-    else:
-        values_are_equal = pg_val == sqlite_val
-
-    if not values_are_equal:
-        msg = (
-            f"Trip {sqlite_trip['trip_id']} has different values on {property_name}: "
-            f"{sqlite_val} (sqlite) vs {pg_val} (pg)"
-        )
-        logger.error(msg)
-        raise Exception(msg)
-
-
-def parse_date(date: str):
-    try:
-        return datetime.datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
-    except Exception:
-        pass
-    try:
-        return datetime.datetime.strptime(date, "%Y-%m-%d %H:%M:%S.%f")
-    except Exception:
-        pass
-    try:
-        return datetime.datetime.strptime(date, "%Y/%m/%d %H:%M:%S")
-    except Exception:
-        pass
-    try:
-        return datetime.datetime.strptime(date, "%d/%m/%Y %H:%M")
-    except Exception:
-        pass
-    try:
-        return datetime.datetime.strptime(date, "%Y-%m-%d")
-    except Exception:
-        logger.error(f"Date format not recognized: {date} ({type(date)})")
-        raise
-
-
-def compare_trip(trip_id: int):
-    """
-    Check that the given trip has the same data in sqlite and pg
-    """
-    try:
-        with managed_cursor(mainConn) as cursor:
-            cursor.execute(
-                "SELECT * FROM trip WHERE uid = :trip_id", {"trip_id": trip_id}
-            )
-            sqlite_trip = cursor.fetchone()
-            sqlite_trip = dict(sqlite_trip) if sqlite_trip else None
-
-        with pg_session() as pg:
-            pg_trip = pg.execute(
-                "SELECT * FROM trips WHERE trip_id = :trip_id", {"trip_id": trip_id}
-            ).fetchone()
-
-        if sqlite_trip is None and pg_trip is None:
-            return
-        if sqlite_trip is None or pg_trip is None:
-            msg = (
-                f"Trip {trip_id} exists in one db but not the other: "
-                f"{sqlite_trip} (sqlite) vs {pg_trip} (pg)"
-            )
-            logger.error(msg)
-            raise Exception(msg)
-
-        sqlite_trip["trip_id"] = sqlite_trip["uid"]
-        sqlite_trip["user_id"] = get_user_id(sqlite_trip["username"])
-        sqlite_trip["is_project"] = (
-            sqlite_trip["start_datetime"] == 1 or sqlite_trip["end_datetime"] == 1
-        )
-        if sqlite_trip["start_datetime"] in [-1, 1]:
-            sqlite_trip["start_datetime"] = None
-        else:
-            sqlite_trip["start_datetime"] = parse_date(sqlite_trip["start_datetime"])
-        if sqlite_trip["end_datetime"] in [-1, 1]:
-            sqlite_trip["end_datetime"] = None
-        else:
-            sqlite_trip["end_datetime"] = parse_date(sqlite_trip["end_datetime"])
-        if sqlite_trip["utc_start_datetime"] is not None:
-            sqlite_trip["utc_start_datetime"] = parse_date(
-                sqlite_trip["utc_start_datetime"]
-            )
-        if sqlite_trip["utc_end_datetime"] is not None:
-            sqlite_trip["utc_end_datetime"] = parse_date(
-                sqlite_trip["utc_end_datetime"]
-            )
-        if sqlite_trip["operator"] == "":
-            sqlite_trip["operator"] = None
-        if sqlite_trip["operator"] is not None:
-            sqlite_trip["operator"] = str(sqlite_trip["operator"])
-        if sqlite_trip["line_name"] == "":
-            sqlite_trip["line_name"] = None
-        if sqlite_trip["created"] is not None:
-            sqlite_trip["created"] = parse_date(sqlite_trip["created"])
-        if sqlite_trip["last_modified"] is not None:
-            sqlite_trip["last_modified"] = parse_date(sqlite_trip["last_modified"])
-        sqlite_trip["trip_type"] = sqlite_trip["type"]
-        if sqlite_trip["material_type"] == "":
-            sqlite_trip["material_type"] = None
-        if sqlite_trip["seat"] == "":
-            sqlite_trip["seat"] = None
-        if sqlite_trip["reg"] == "":
-            sqlite_trip["reg"] = None
-        if sqlite_trip["waypoints"] == "":
-            sqlite_trip["waypoints"] = None
-        if sqlite_trip["notes"] == "":
-            sqlite_trip["notes"] = None
-        if sqlite_trip["price"] == "":
-            sqlite_trip["price"] = None
-        if sqlite_trip["ticket_id"] == "":
-            sqlite_trip["ticket_id"] = None
-        sqlite_trip["purchase_date"] = sqlite_trip["purchasing_date"]
-        if sqlite_trip["purchase_date"] == "":
-            sqlite_trip["purchase_date"] = None
-        if sqlite_trip["purchase_date"] is not None:
-            sqlite_trip["purchase_date"] = parse_date(sqlite_trip["purchase_date"])
-        ensure_values_equal(sqlite_trip, pg_trip, "user_id")
-        ensure_values_equal(sqlite_trip, pg_trip, "origin_station")
-        ensure_values_equal(sqlite_trip, pg_trip, "destination_station")
-        ensure_values_equal(sqlite_trip, pg_trip, "start_datetime")
-        ensure_values_equal(sqlite_trip, pg_trip, "end_datetime")
-        ensure_values_equal(sqlite_trip, pg_trip, "is_project")
-        ensure_values_equal(sqlite_trip, pg_trip, "utc_start_datetime")
-        ensure_values_equal(sqlite_trip, pg_trip, "utc_end_datetime")
-        ensure_values_equal(sqlite_trip, pg_trip, "estimated_trip_duration")
-        ensure_values_equal(sqlite_trip, pg_trip, "manual_trip_duration")
-        ensure_values_equal(sqlite_trip, pg_trip, "trip_length")
-        ensure_values_equal(sqlite_trip, pg_trip, "operator")
-        ensure_values_equal(sqlite_trip, pg_trip, "countries")
-        ensure_values_equal(sqlite_trip, pg_trip, "line_name")
-        ensure_values_equal(sqlite_trip, pg_trip, "created")
-        ensure_values_equal(sqlite_trip, pg_trip, "last_modified")
-        ensure_values_equal(sqlite_trip, pg_trip, "trip_type")
-        ensure_values_equal(sqlite_trip, pg_trip, "material_type")
-        ensure_values_equal(sqlite_trip, pg_trip, "seat")
-        ensure_values_equal(sqlite_trip, pg_trip, "reg")
-        ensure_values_equal(sqlite_trip, pg_trip, "waypoints")
-        ensure_values_equal(sqlite_trip, pg_trip, "notes")
-        ensure_values_equal(sqlite_trip, pg_trip, "price")
-        ensure_values_equal(sqlite_trip, pg_trip, "currency")
-        ensure_values_equal(sqlite_trip, pg_trip, "ticket_id")
-        ensure_values_equal(sqlite_trip, pg_trip, "purchase_date")
-    except Exception as e:
-        logger.exception(e)
-        trace = traceback.format_exc().replace("\n", "<br>")
-        msg = f"""
-            Trip {trip_id} has drifted between SQLite and PG!<br>
-            URL : {request.url} <br>
-            <br>
-            Logged in user : {getUser()}<br>
-            <br>
-            Trace : <br>
-            <br>
-            {trace}
-        """
-        logger.error(msg)
-
-        if "127.0.0.1" not in request.url and "localhost" not in request.url:
-            msg = ""
-            sendOwnerEmail("Error : " + str(e), msg)
@@ -1,29 +1,23 @@
 import json
 import re
 import smtplib
-import sqlite3
 from contextlib import contextmanager
 from datetime import datetime
 from email.mime.text import MIMEText
 from functools import wraps
 from glob import glob
 
-import pytz
 from flask import abort, request, session
-from timezonefinder import TimezoneFinder
 
 from py.sql import getCurrentTrip
 from py.utils import load_config
 from src.consts import DbNames
+from src.db import Database, release_connections
+from src.timezones import timezone_at, to_local, to_utc
 
-pathConn = sqlite3.connect(DbNames.PATH_DB, check_same_thread=False)
-pathConn.row_factory = sqlite3.Row
-
-mainConn = sqlite3.connect(DbNames.MAIN_DB, check_same_thread=False)
-mainConn.row_factory = sqlite3.Row
-
-authConn = sqlite3.connect(DbNames.AUTH_DB, check_same_thread=False)
-authConn.row_factory = sqlite3.Row
+pathConn = Database(DbNames.PATH_DB)
+mainConn = Database(DbNames.MAIN_DB)
+authConn = Database(DbNames.AUTH_DB)
 
 
 owner = load_config()["owner"]["username"]
@@ -44,6 +38,14 @@ def readLang():
 lang = readLang()
 
 
+def release_request_connections(exception=None):
+    """
+    End the transactions of the request, rolled back if it failed, and give its
+    connections back
+    """
+    release_connections((mainConn, pathConn, authConn), commit=exception is None)
+
+
 @contextmanager
 def managed_cursor(connection):
     cursor = connection.cursor()
@@ -111,32 +113,12 @@ def processDates(newTrip, newPath):
 
 
 def getUtcDatetime(lat, lng, dateTime):
-    tf = TimezoneFinder()
-    timezone_str = tf.timezone_at(lat=lat, lng=lng)
-
-    # Handle override for specific zones
-    if timezone_str in ['Asia/Urumqi', 'Asia/Kashgar']:
-        # Force UTC+8 manually
-        timezone = pytz.FixedOffset(480)  # 480 minutes = 8 hours
-        localized_datetime = timezone.localize(dateTime)
-    else:
-        timezone = pytz.timezone(timezone_str)
-        localized_datetime = timezone.localize(dateTime)
+    return to_utc(timezone_at(lat, lng), dateTime)
 
-    utc_datetime = localized_datetime.astimezone(pytz.utc).replace(tzinfo=None)
-    return utc_datetime
 
 def getLocalDatetime(lat, lng, dateTime):
-    # Instantiate TimezoneFinder and find timezone for given lat, lng
-    tf = TimezoneFinder()
-    timezone_str = tf.timezone_at(lat=lat, lng=lng)
+    return to_local(timezone_at(lat, lng), dateTime)
 
-    if timezone_str in ['Asia/Urumqi', 'Asia/Kashgar']:
-        local_timezone = pytz.FixedOffset(480)  # 480 minutes = 8 hours
-    else:
-        local_timezone = pytz.timezone(timezone_str)
-    local_datetime = dateTime.astimezone(local_timezone).replace(tzinfo=None)
-    return local_datetime
 
 def get_user_id(username):
     with managed_cursor(authConn) as cursor:
@@ -153,6 +135,24 @@ def get_user_id(username):
     return None
 
 
+def get_user_ids(usernames):
+    """
+    {username: uid} of the given users, in one query
+    """
+    usernames = list(set(usernames))
+    if not usernames:
+        return {}
+    with managed_cursor(authConn) as cursor:
+        cursor.execute(
+            f"""
+            SELECT username, uid FROM user
+            WHERE username IN ({", ".join(("?",) * len(usernames))})
+        """,
+            usernames,
+        )
+        return {row["username"]: row["uid"] for row in cursor.fetchall()}
+
+
 def sendEmail(address, subject, message):
     config = load_config()
 
@@ -942,3 +942,70 @@ function renderOperators(data, type, row) {
     // Fallback to operator name
     return row.operator;
 }
+
+// Decode a path sent in base64 in the binary format of src/path_codec.py:
+// a 32 bytes header with the point count at offset 4, then the latitudes and
+// the longitudes as int32 micro-degrees, each one a delta from the previous one
+function decodeStoredPath(base64) {
+    const binary = atob(base64);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    const view = new DataView(bytes.buffer);
+    const pointCount = view.getUint32(4, true);
+    const path = new Array(pointCount);
+    let lat = 0;
+    let lng = 0;
+    for (let i = 0; i < pointCount; i++) {
+        lat += view.getInt32(32 + 4 * i, true);
+        lng += view.getInt32(32 + 4 * (pointCount + i), true);
+        path[i] = [lat / 1e6, lng / 1e6];
+    }
+    return path;
+}
+
+// Read the NDJSON map data of getTripsPaths as it arrives, and give it to the
+// callback in the same form as the JSON answer
+function fetchTripsPathsStream(url, callback) {
+    const data = { trips: [], deleted: [] };
+    const readLine = function (line) {
+        if (!line) {
+            return;
+        }
+        const item = JSON.parse(line);
+        if ("trip" in item) {
+            data.trips.push({
+                trip: item.trip,
+                path: item.path === null ? {} : decodeStoredPath(item.path)
+            });
+        } else {
+            Object.assign(data, item);
+        }
+    };
+
+    fetch(url + (url.includes("?") ? "&" : "?") + "format=ndjson")
+        .then(function (response) {
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = "";
+            const read = function () {
+                return reader.read().then(function ({ done, value }) {
+                    if (done) {
+                        readLine(buffer + decoder.decode());
+                        callback(data);
+                        return;
+                    }
+                    buffer += decoder.decode(value, { stream: true });
+                    const lines = buffer.split("\n");
+                    buffer = lines.pop();
+                    lines.forEach(readLine);
+                    return read();
+                });
+            };
+            return read();
+        })
+        .catch(function (error) {
+            console.error("Failed to load the trips of the map:", error);
+        });
+}